@@ -11,15 +11,17 @@
 import os
 import platform
 import time
-import webbrowser
 import threading
-from hv500_server import *
-
-#Import GUI Tools
-from tkinter import *
-from tkinter import ttk
-from tkinter import filedialog
-from PIL import ImageTk, Image
+from supply_pool import SupplyPool
+from ramp_engine import RampEngine
+from recipe_runner import Recipe, RecipeRunner
+from control_loop import AdaptivePoller, LoopScheduler
+from electrode_state import ElectrodeState
+from hardware_map import HardwareMap, DEFAULT_PATH as HARDWARE_MAP_PATH
+from telemetry import TelemetryRecorder
+from telemetry_history import TelemetryHistory
+from live_plot import LivePlot
+from metrics import Registry, SnapshotWriter, MetricsServer
 
 #Import Math Tools
 import numpy as np
@@ -34,21 +36,39 @@ font_18 = ('Helvetica', 18)
 font_20 = ('Helvetica', 20)
 
 
-class mySpinbox(Spinbox):
-    def __init__(self, *args, **kwargs):
-        Spinbox.__init__(self, *args, **kwargs)
-        self.bind('<MouseWheel>', self.mouseWheel)
-        self.bind('<Button-4>', self.mouseWheel)
-        self.bind('<Button-5>', self.mouseWheel)
-
-    def mouseWheel(self, event):
-        if event.num == 5 or event.delta == -120:
-            self.invoke('buttondown')
-        elif event.num == 4 or event.delta == 120:
-            self.invoke('buttonup')
+#Imports the GUI Tools (tkinter and Pillow)
+#They are only needed once a GUI is made, so scripts that only use the control
+#logic do not pay for them at import time. The names are imported into the module
+#namespace, so the GUI methods use them as if they were imported at the top.
+def importGuiTools():
+    global Tk, Toplevel, Frame, Canvas, Label, Message, Button, Entry, Text, Listbox, Scrollbar, Menu
+    global TclError, BOTH, CENTER, DISABLED, END, LEFT, RIGHT, TOP, E, S, W, X, Y, NONE, MULTIPLE
+    global ttk, filedialog, ImageTk, Image, mySpinbox
+    if 'mySpinbox' in globals():
+        return
+    import tkinter
+    from tkinter import Tk, Toplevel, Frame, Canvas, Label, Message, Button, Entry, Text, Listbox, Scrollbar, Menu
+    from tkinter import TclError, BOTH, CENTER, DISABLED, END, LEFT, RIGHT, TOP, E, S, W, X, Y, NONE, MULTIPLE
+    from tkinter import ttk
+    from tkinter import filedialog
+    from PIL import ImageTk, Image
+
+    class mySpinbox(tkinter.Spinbox):
+        def __init__(self, *args, **kwargs):
+            tkinter.Spinbox.__init__(self, *args, **kwargs)
+            self.bind('<MouseWheel>', self.mouseWheel)
+            self.bind('<Button-4>', self.mouseWheel)
+            self.bind('<Button-5>', self.mouseWheel)
+
+        def mouseWheel(self, event):
+            if event.num == 5 or event.delta == -120:
+                self.invoke('buttondown')
+            elif event.num == 4 or event.delta == 120:
+                self.invoke('buttonup')
 
 #Opens a url in a new tab in the default webbrowser
 def callback(url):
+    import webbrowser
     webbrowser.open_new_tab(url)
 
 #Sorts all columns of a matrix by a single column
@@ -77,90 +97,30 @@ def multiThreading(function):
     t1=threading.Thread(target=function)
     t1.setDaemon(True)      #This is so the thread will terminate when the main program is terminated
     t1.start()
-
+    return t1
 
 #This is the EBIT class object, which contains everything related to the GUI control interface
 class Thorium():
-    def __init__(self):
+    def __init__(self, hardware_map=None):
         
 
-        #Dictionary which will store actual voltages of bender electrodes, as read from server
-        #All voltages are initialized as zero upon program start, but will be read by data reader
-        self.actual_voltages = {'U_TR_bender':0, 
-                           'U_TL_bender':0, 
-                           'U_BL_bender':0, 
-                           'U_BR_bender':0, 
-                           'U_TL_plate':0,
-                           'U_TR_plate':0, 
-                           'U_BL_plate':0, 
-                           'U_BR_plate':0, 
-                           'U_L_ablation':0, 
-                           'U_R_ablation':0,        #This is the last line which contains a quadrupole bender electrode
-                           'U_TR1_loading':0,       #This is the first line which contains a loading trap electrode
-                           'U_TL1_loading':0,
-                           'U_BL1_loading':0,
-                           'U_BR1_loading':0,
-                           'U_TR2_loading':0,
-                           'U_TL2_loading':0,
-                           'U_BL2_loading':0,
-                           'U_BR2_loading':0,
-                           'U_TR3_loading':0,
-                           'U_TL3_loading':0,
-                           'U_BL3_loading':0,
-                           'U_BR3_loading':0,
-                           'U_TR4_loading':0,
-                           'U_TL4_loading':0,
-                           'U_BL4_loading':0,
-                           'U_BR4_loading':0,
-                           'U_TR5_loading':0,
-                           'U_TL5_loading':0,
-                           'U_BL5_loading':0,
-                           'U_BR5_loading':0,
-                           'U_exit_bender':0,
-                           'U_exit_loading':0}
-        
+        #Power supplies and the location (supply, channel) of electrode voltages on them, loaded from
+        #hardware_map.json (or the given file) and checked for conflicting assignments
+        self.hardware = HardwareMap.load(hardware_map or HARDWARE_MAP_PATH)
+        self.v_location = self.hardware.electrodes
 
-        #Dictionary which will store set voltages of bender electrodes, as specified by user in program
-        #All set voltages are initialized as zero upon program start
-        self.set_voltages = self.actual_voltages.copy()
+        #Actual, set and entry voltages of all electrodes, stored in arrays indexed by electrode
+        #All voltages are initialized as zero upon program start, but will be read by data reader
+        self.state = ElectrodeState.from_hardware_map(self.hardware)
 
-        #Dictionary which will store voltages that user has typed into entry boxes
+        #Dictionary-like views of the state, keyed by electrode name
+        #actual_voltages stores the voltages as read from the servers
+        #set_voltages stores the set voltages, as specified by user in program
+        #entry_voltages stores voltages that user has typed into entry boxes
         #These are not necessarily the same as set voltages, since power buttons, etc. may be switched
-        self.entry_voltages = self.actual_voltages.copy()
-
-        #Location (server, channel) of electrode voltages on power supplies
-        self.v_location = {'U_TR_bender':(2, 3), 
-                           'U_TL_bender':(2, 13), 
-                           'U_BL_bender':(2, 2), 
-                           'U_BR_bender':(2, 11), 
-                           'U_TL_plate':(2, 10),
-                           'U_TR_plate':(2, 4), 
-                           'U_BL_plate':(2, 9), 
-                           'U_BR_plate':(2, 12), 
-                           'U_L_ablation':(2, 14), 
-                           'U_R_ablation':(2, 8),       #This is the last line which contains a quadrupole bender electrode
-                           'U_TR1_loading':(1, 6),     #This is the first line which contains a loading trap electrode
-                           'U_TL1_loading':(1, 1),
-                           'U_BL1_loading':(1, 7),
-                           'U_BR1_loading':(2, 5),
-                           'U_TR2_loading':(1, 14),
-                           'U_TL2_loading':(1, 9),
-                           'U_BL2_loading':(1, 10),
-                           'U_BR2_loading':(1, 12),
-                           'U_TR3_loading':(1, 15),
-                           'U_TL3_loading':(1, 2),
-                           'U_BL3_loading':(1, 8),
-                           'U_BR3_loading':(1, 16),
-                           'U_TR4_loading':(2, 15),
-                           'U_TL4_loading':(1, 3),
-                           'U_BL4_loading':(2, 6),
-                           'U_BR4_loading':(1, 11),
-                           'U_TR5_loading':(1, 4),
-                           'U_TL5_loading':(2, 7),
-                           'U_BL5_loading':(2, 16),
-                           'U_BR5_loading':(1, 5),
-                           'U_exit_bender':(1, 9),
-                           'U_exit_loading':(1, 12)}
+        self.actual_voltages = self.state.actual_view
+        self.set_voltages = self.state.setpoint_view
+        self.entry_voltages = self.state.entry_view
         
 
         
@@ -182,6 +142,7 @@ class Thorium():
         self.fig = None
         self.ax = None
         self.toolbar = None
+        self.live_plot = None
         self.filename = None
         self.work_dir = None
 
@@ -203,98 +164,291 @@ class Thorium():
 
         self.multiple = False
 
+        #Electrodes switched by each power and mode button, and set by each group entry
+        quad_names = ['U_TL_bender', 'U_TR_bender', 'U_BL_bender', 'U_BR_bender']
+        extraction_names = ['U_TL_plate', 'U_TR_plate', 'U_BL_plate', 'U_BR_plate', 'U_L_ablation', 'U_L_ablation']
+        self.control_electrodes = {'U_bender': quad_names, 'bender_mode': quad_names,
+                                   'U_extraction': extraction_names,
+                                   'U_loading_plate': ['U_exit_loading']}
+        for segment in range(1, 6):
+            names = [f'U_TR{segment}_loading', f'U_TL{segment}_loading', f'U_BR{segment}_loading', f'U_BL{segment}_loading']
+            for variable in (f'U_segment_{segment}', f'dU_segment_{segment}', f'segment_{segment}_mode'):
+                self.control_electrodes[variable] = names
+
+        #Polls fast while voltages are settling or the user is editing, slower when idle
+        self.poller = AdaptivePoller(min_interval=0.1, max_interval=2.0)
+
+        #Runs the data reader on absolute deadlines; the period comes from the poller unless
+        #a fixed period is set with setLoopPeriod. A poke of the poller also wakes the scheduler,
+        #which restarts its deadlines from then on, except with a fixed period
+        self.scheduler = LoopScheduler(period=self.poller.min_interval, policy='skip', wake=self.poller.wake)
+        self.fixed_period = None
+
+        #Counters, gauges and latency histograms of the supplies and loops; written to
+        #~/.thorium_control/metrics.json every 10 s while connected, and served as text
+        #on a local port after serveMetrics()
+        self.metrics = Registry()
+        self.metrics_file = SnapshotWriter(self.metrics)
+        self.metrics_server = None
+        self.loop_stats = {kind: self.metrics.histogram('loop_seconds', {'loop': kind}) for kind in ('set', 'get', 'update')}
+        self.metrics.gauge('loop_period_seconds', fn=lambda: self.scheduler.period)
+        self.metrics.gauge('loop_overruns', fn=lambda: self.scheduler.overruns)
+        self.metrics.gauge('loop_skipped', fn=lambda: self.scheduler.skipped)
+        self.metrics.gauge('telemetry_dropped', fn=lambda: self.telemetry.dropped)
+
+        #Set by any change of the set voltages; wakes the data writer
+        self.write_request = threading.Event()
+
+        #Ends the data reader and data writer loops (see stopLoops), which are kept in loop_threads
+        self.stop_event = threading.Event()
+        self.loop_threads = []
+
+        #Time of the oldest setpoint change not yet sent to the supplies, and the latency
+        #from a change (click, entry, import) until it was written and acknowledged
+        self.pending_change = None
+        self.change_lock = threading.Lock()
+        self.last_write_time = None
+        self.latency_stats = {stage: self.metrics.histogram('setpoint_latency_seconds', {'stage': stage}) for stage in ('wire', 'ack')}
+
+        #Actual voltage labels are refreshed on the Tk thread from the latest snapshot
+        #published by the data reader
+        self.actual_labels = {}
+        self.entry_widgets = {}
+        self.label_text = {}
+        self.label_snapshot = None
+        self.label_lock = threading.Lock()
+        self.label_refresh_ms = 100
+
+        #Power supplies by number, as used in v_location, each with its own worker thread
+        self.pool = None
+        self.servers = {}
+        #Longest wait in seconds for the reads and writes of one pass; a supply that has not answered
+        #by then counts as failed and is skipped for a while after repeated failures
+        self.io_timeout = 2.0
+
+        #Streams timed voltage ramps to the supplies and runs recipes, created on connect
+        self.ramps = None
+        self.recipes = None
+
+        #Keeps the set and actual voltages of every readback: the newest samples in memory,
+        #and hours of history in rotating log files in ~/.thorium_control/telemetry
+        self.telemetry = TelemetryRecorder(self.state.names, self.v_location, self.hardware.supplies)
+        #Looks up the logged telemetry by time, e.g. self.history.series('U_TL1_loading', t0, t1)
+        self.history = TelemetryHistory(self.telemetry.log.directory)
+
 
     def quitProgram(self):
         print('quit')
         #self.reactor.stop()
+        if self.live_plot is not None:
+            self.live_plot.stop()
+        self.stopLoops()
+        self.disconnect()
         self.root.quit()
         self.root.destroy()
 
 
-    def connect(self, port1, port2):       
-        self.server_1 = HV500Server()
-        self.server_1.port = port1
-        self.server_2 = HV500Server()
-        self.server_2.port = port2
-
-        try:
-            self.server_1.initServer()
-            self.server_2.initServer()
-        except:
-            print('Error connecting to servers')        
-
-
+    # Connects to every power supply in the hardware map
+    # Ports are taken from the map unless given here, in order of supply number
+    # fast_mode selects the 'DIS AUTO' + 'CH' fast-update mode of the supplies
+    def connect(self, *ports, fast_mode=False):
+        self.pool = SupplyPool(self.hardware, dict(zip(sorted(self.hardware.supplies), ports)), fast_mode, self.metrics, self.io_timeout)
+        self.servers = self.pool.servers
+        # Also available as self.server_1, self.server_2, ...
+        for supply, server in self.servers.items():
+            setattr(self, f'server_{supply}', server)
+        self.pool.connect()
+        # Electrodes a script or recipe does not touch keep the voltages the supplies already have
+        self.readInitialVoltages()
+        self.ramps = RampEngine(self.pool, self.state)
+        self.recipes = RecipeRunner(self.pool, self.state, self.ramps, on_change=self.poller.poke, read=self.readVoltagesIfIdle)
+        self.telemetry.start()
+        self.metrics_file.start()
+
+
+    def disconnect(self):
+        if self.pool is not None:
+            self.pool.close()
+        self.telemetry.stop()
+        self.metrics_file.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+
+    # Serves the metrics as text on http://127.0.0.1:port/metrics (JSON on /metrics.json)
+    def serveMetrics(self, port=9105):
+        if self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.metrics, port)
+            self.metrics_server.start()
+            print(f'Metrics served on http://127.0.0.1:{self.metrics_server.port}/metrics')
+        return self.metrics_server.port
+
+
+    # Reads all supplies in parallel; channels that could not be read (e.g. serial overload) keep their last value
+    # Every readback is recorded with the setpoints in the telemetry
     def getVoltages(self):
         try:
-            bender_v = self.server_2.get_all_voltages()
-            loading_v = self.server_1.get_all_voltages()
-
-            for name, entry in self.v_location.items():
-                if entry[0] == 2:
-                    self.actual_voltages[name] = bender_v[entry[1]-1]
-                elif entry[0] == 1:
-                    self.actual_voltages[name] = loading_v[entry[1]-1]
+            self.pool.read(self.state, self.io_timeout)
+            self.telemetry.record(self.state.setpoint, self.state.actual)
         except:
             print('Error getting voltages')
             
 
+    # Reads the voltages the supplies already have and takes them as the set and entry voltages
+    def readInitialVoltages(self):
+        self.getVoltages()
+        self.state.publish(self.state.actual.copy())
+        self.state.entry[:] = self.state.actual
+
+
+    # Reads all supplies unless the data reader does, e.g. while a recipe runs from a script
+    def readVoltagesIfIdle(self):
+        if not any(thread.is_alive() for thread in self.loop_threads):
+            self.getVoltages()
+
+
     def getVoltage(self, name):
-        supply = self.v_location[name][0]
-        channel = self.v_location[name][1]
-        if supply == 2:
-            voltage = self.server_2.get_voltage(channel)
-        elif supply == 1:
-            voltage = self.server_1.get_voltage(channel)
-        return voltage
+        if self.v_location[name] is None:
+            print(name, 'is not assigned to a power supply channel')
+            return None
+        supply, channel = self.v_location[name]
+        return self.servers[supply].get_voltage(channel)
     
 
     def setVoltage(self, name):
-        supply = self.v_location[name][0]
-        channel = self.v_location[name][1]
-        if supply == 2:
-            self.server_2.set_voltage(channel, self.set_voltages[name])
-        elif supply == 1:
-            self.server_1.set_voltage(channel, self.set_voltages[name])
+        if self.v_location[name] is None:
+            print(name, 'is not assigned to a power supply channel')
+            return
+        supply, channel = self.v_location[name]
+        self.servers[supply].set_voltage(channel, self.set_voltages[name])
 
     def setVoltages(self):
-        supply1_voltages = np.zeros(16)
-        supply2_voltages = np.zeros(16)
         try:
-            for name, entry in self.v_location.items():
-                if entry[0] == 1:
-                    supply1_voltages[entry[1]-1] = self.set_voltages[name]
-                elif entry[0] == 2:
-                    supply2_voltages[entry[1]-1] = self.set_voltages[name]
-            self.server_1.set_all_voltages(supply1_voltages)
-            self.server_2.set_all_voltages(supply2_voltages)
+            futures = self.pool.write(self.state)
+            self.last_write_time = time.perf_counter()
+            for supply, future in self.pool.wait(futures, self.io_timeout).items():
+                self.servers[supply].complete(future)
         except:
             print('Error setting voltages')
 
-    # This function is run in a separate thread and runs continuously
+    # Called whenever the user changes a setpoint; wakes the data writer so the change is written right away
+    # and speeds up the data reader so the result is shown soon after
+    def notifySetpointChange(self):
+        with self.change_lock:
+            if self.pending_change is None:
+                self.pending_change = time.perf_counter()
+        self.write_request.set()
+        self.poller.poke()
+
+
+    # Recomputes the set voltages and writes the channels that changed or no longer read back their setpoint
+    def applySetpoints(self):
+        with self.change_lock:
+            t_change = self.pending_change
+            self.pending_change = None
+        # Electrodes held by a ramp keep the ramp's final voltage
+        self.updateSetV()
+        self.setVoltages()
+        if t_change is not None:
+            if self.last_write_time is not None:
+                self.latency_stats['wire'].observe(self.last_write_time - t_change)
+            self.latency_stats['ack'].observe(time.perf_counter() - t_change)
+
+
+    # Ramps electrodes (dict of name -> voltage) to new voltages over duration seconds
+    # profile is 'linear', 'cosine' or 'rate' (rate in V/s); blocks until the ramp is done
+    # The ramped electrodes are held at their targets until released or edited in the GUI
+    def rampVoltages(self, targets, duration=None, profile='linear', rate=None):
+        reports = self.ramps.ramp(targets, duration, profile, rate)
+        for supply, report in reports.items():
+            if not report.ok or report.skipped:
+                print(f'Ramp on supply {supply}: {report}')
+        self.poller.poke()
+        return reports
+
+
+    # Returns held electrodes (default all) to the values set in the GUI
+    def releaseVoltages(self, names=None):
+        self.state.release(None if names is None else self.state.electrodes(names))
+        self.notifySetpointChange()
+
+
+    # Returns the electrode, or the electrodes of a button or group entry (see control_electrodes),
+    # to the values set in the GUI if a ramp or recipe holds them
+    def releaseControlled(self, name):
+        names = [name] if name in self.state.index else self.control_electrodes.get(name, [])
+        if names:
+            self.state.release(self.state.electrodes(names))
+
+
+    # Runs a recipe (a Recipe or the path of a recipe file) and prints its timing summary
+    # Blocks until all cycles are done; electrodes set by the recipe stay held afterwards
+    # If the recipe is stopped or fails, its electrodes are released and go back to their GUI values
+    def runRecipe(self, recipe):
+        if not isinstance(recipe, Recipe):
+            recipe = Recipe.load(recipe)
+        try:
+            report = self.recipes.run(recipe)
+        finally:
+            self.notifySetpointChange()
+        print(report.summary())
+        return report
+
+
+    # Stops the data reader and data writer after their current iteration and waits for their threads
+    def stopLoops(self, timeout=5.0):
+        self.stop_event.set()
+        self.write_request.set()
+        self.poller.wake.set()
+        for thread in self.loop_threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+        self.loop_threads = []
+
+
+    # This function is run in a separate thread and runs until stopLoops is called
+    # It writes the set voltages whenever they change, or when the data reader finds a supply
+    # that does not read back its setpoint, independently of the readback rate
+    def data_writer(self):
+        while not self.stop_event.is_set():
+            self.write_request.wait()
+            self.write_request.clear()
+            if self.stop_event.is_set():
+                break
+            t0 = time.perf_counter()
+            self.applySetpoints()
+            self.loop_stats['set'].observe(time.perf_counter()-t0)
+
+
+    # This function is run in a separate thread and runs until stopLoops is called
     # It reads values of all power supply voltages and updates them in the display
     def data_reader(self):
 
         # Reads existing voltages and updates the set and entry voltages accordingly upon first time booting software
-        self.getVoltages()
-        self.set_voltages = self.actual_voltages.copy()
-        self.entry_voltages = self.actual_voltages.copy()
-
-        # Continuously loops to both read the voltage values from the supplies and also to update those values if the user has entered a new one
-        while True:
-            t0 = time.time()
-            self.updateSetV()
-            print('Time to update set: ', time.time()-t0)
-            t0 = time.time()
+        self.readInitialVoltages()
+
+        # Applies the GUI setpoints once before the loops start, so the supplies match the buttons
+        # (e.g. 0 V on segments shown as off) from the start and not only after the first click
+        self.applySetpoints()
+
+        # Writes run in their own thread from here on, so a slow readback never delays them
+        self.loop_threads.append(multiThreading(self.data_writer))
+
+        # Continuously loops to read the voltage values from the supplies at the scheduler's period
+        self.scheduler.start()
+        while not self.stop_event.is_set():
+            self.scheduler.begin()
+            t0 = time.perf_counter()
             self.getVoltages()
-            print('Time to get: ', time.time()-t0)
+            self.loop_stats['get'].observe(time.perf_counter()-t0)
 
-            t0 = time.time()
+            t0 = time.perf_counter()
 
-            mask = abs(np.array(list(self.actual_voltages.values())) - np.array(list(self.set_voltages.values()))) > 0.2
+            mask = (np.abs(self.state.actual - self.state.setpoint) > 0.2) & self.state.wired
             if np.any(mask):
-                self.setVoltages()
-            for v in self.v_location:
-                self.updateActualV(v)
+                self.write_request.set()
+            self.publishActualV()
 
 
             # if self.multiple:
@@ -309,108 +463,133 @@ class Thorium():
             #         self.updateActualV(v)
 
                 
-            print('Time to update: ', time.time()-t0)
-        
-            time.sleep(0.5)
-
-
-    # This function updates the actual voltage labels in the GUI
-    def updateActualV(self, name):
-        if name == 'U_TL_bender':
-            self.TL_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TR_bender':
-            self.TR_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-        
-        elif name == 'U_BL_bender':
-            self.BL_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BR_bender':
-            self.BR_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-        
-        elif name == 'U_TL_plate':
-            self.TLP_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TR_plate':
-            self.TRP_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BL_plate':
-            self.BLP_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BR_plate':
-            self.BRP_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_L_ablation':
-            self.LA_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_R_ablation':
-            self.RA_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-        
-        elif name == 'U_TR1_loading':
-            self.TR1_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-        
-        elif name == 'U_TL1_loading':
-            self.TL1_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BL1_loading':
-            self.BL1_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-        
-        elif name == 'U_BR1_loading':
-            self.BR1_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TR2_loading':
-            self.TR2_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TL2_loading':
-            self.TL2_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BL2_loading':
-            self.BL2_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-        
-        elif name == 'U_BR2_loading':
-            self.BR2_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TR3_loading':
-            self.TR3_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TL3_loading':
-            self.TL3_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BL3_loading':
-            self.BL3_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BR3_loading':
-            self.BR3_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TR4_loading':
-            self.TR4_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TL4_loading':
-            self.TL4_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BL4_loading':
-            self.BL4_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BR4_loading':
-            self.BR4_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TR5_loading':
-            self.TR5_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_TL5_loading':
-            self.TL5_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BL5_loading':
-            self.BL5_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_BR5_loading':
-            self.BR5_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
-
-        elif name == 'U_exit_loading':
-            self.U_exit_loading_actual.config(text="{:.1f} V".format(self.actual_voltages[name]))
+            self.loop_stats['update'].observe(time.perf_counter()-t0)
+            self.scheduler.end()
+
+            if self.fixed_period is None:
+                self.scheduler.set_period(self.poller.next_interval(np.any(mask)))
+            self.scheduler.wait()
+
+
+    # Runs the data reader at a fixed period in seconds, or with the adaptive period if None
+    # A fixed period keeps the loop on its deadline grid when it is woken early
+    def setLoopPeriod(self, period=None):
+        self.fixed_period = period
+        self.scheduler.reanchor = period is None
+        self.scheduler.set_period(self.poller.min_interval if period is None else period)
+        self.poller.wake.set()
+
+
+    # Hands the latest actual voltages to the GUI thread
+    # Called from the data reader thread; only the newest snapshot is kept, so snapshots
+    # published faster than the GUI refreshes are coalesced into one
+    def publishActualV(self):
+        with self.label_lock:
+            self.label_snapshot = self.state.actual.copy()
+
+
+    # Runs on the Tk thread: applies the latest snapshot and reschedules itself
+    def refreshLabels(self):
+        with self.label_lock:
+            snapshot = self.label_snapshot
+            self.label_snapshot = None
+        if snapshot is not None:
+            for name, voltage in zip(self.state.names, snapshot.tolist()):
+                self.updateActualV(name, voltage)
+        self.root.after(self.label_refresh_ms, self.refreshLabels)
+
+
+    # Maps each electrode to the label showing its actual voltage and the entry of its set voltage
+    def registerActualLabels(self):
+        self.actual_labels = {'U_TL_bender': self.TL_actual,
+                              'U_TR_bender': self.TR_actual,
+                              'U_BL_bender': self.BL_actual,
+                              'U_BR_bender': self.BR_actual,
+                              'U_TL_plate': self.TLP_actual,
+                              'U_TR_plate': self.TRP_actual,
+                              'U_BL_plate': self.BLP_actual,
+                              'U_BR_plate': self.BRP_actual,
+                              'U_L_ablation': self.LA_actual,
+                              'U_R_ablation': self.RA_actual,
+                              'U_TR1_loading': self.TR1_actual,
+                              'U_TL1_loading': self.TL1_actual,
+                              'U_BL1_loading': self.BL1_actual,
+                              'U_BR1_loading': self.BR1_actual,
+                              'U_TR2_loading': self.TR2_actual,
+                              'U_TL2_loading': self.TL2_actual,
+                              'U_BL2_loading': self.BL2_actual,
+                              'U_BR2_loading': self.BR2_actual,
+                              'U_TR3_loading': self.TR3_actual,
+                              'U_TL3_loading': self.TL3_actual,
+                              'U_BL3_loading': self.BL3_actual,
+                              'U_BR3_loading': self.BR3_actual,
+                              'U_TR4_loading': self.TR4_actual,
+                              'U_TL4_loading': self.TL4_actual,
+                              'U_BL4_loading': self.BL4_actual,
+                              'U_BR4_loading': self.BR4_actual,
+                              'U_TR5_loading': self.TR5_actual,
+                              'U_TL5_loading': self.TL5_actual,
+                              'U_BL5_loading': self.BL5_actual,
+                              'U_BR5_loading': self.BR5_actual,
+                              'U_exit_loading': self.U_exit_loading_actual}
+        self.entry_widgets = {'U_TL_bender': self.TL_entry,
+                              'U_TR_bender': self.TR_entry,
+                              'U_BL_bender': self.BL_entry,
+                              'U_BR_bender': self.BR_entry,
+                              'U_TL_plate': self.TLP_entry,
+                              'U_TR_plate': self.TRP_entry,
+                              'U_BL_plate': self.BLP_entry,
+                              'U_BR_plate': self.BRP_entry,
+                              'U_L_ablation': self.LA_entry,
+                              'U_R_ablation': self.RA_entry,
+                              'U_TR1_loading': self.TR1_entry,
+                              'U_TL1_loading': self.TL1_entry,
+                              'U_BL1_loading': self.BL1_entry,
+                              'U_BR1_loading': self.BR1_entry,
+                              'U_TR2_loading': self.TR2_entry,
+                              'U_TL2_loading': self.TL2_entry,
+                              'U_BL2_loading': self.BL2_entry,
+                              'U_BR2_loading': self.BR2_entry,
+                              'U_TR3_loading': self.TR3_entry,
+                              'U_TL3_loading': self.TL3_entry,
+                              'U_BL3_loading': self.BL3_entry,
+                              'U_BR3_loading': self.BR3_entry,
+                              'U_TR4_loading': self.TR4_entry,
+                              'U_TL4_loading': self.TL4_entry,
+                              'U_BL4_loading': self.BL4_entry,
+                              'U_BR4_loading': self.BR4_entry,
+                              'U_TR5_loading': self.TR5_entry,
+                              'U_TL5_loading': self.TL5_entry,
+                              'U_BL5_loading': self.BL5_entry,
+                              'U_BR5_loading': self.BR5_entry,
+                              'U_exit_loading': self.U_exit_loading_entry}
+        self.label_text = {}
+
+
+    # Greys out the controls of electrodes that the hardware map does not wire to a supply channel
+    # Their entries are disabled and their actual voltage label shows 'not wired' instead of a readback
+    def markUnwired(self):
+        for name in self.state.unwired(self.state.names):
+            if name in self.entry_widgets:
+                self.entry_widgets[name].config(state=DISABLED)
+            if name in self.actual_labels:
+                self.actual_labels.pop(name).config(text='not wired', fg='grey50')
+
+
+    # This function updates the actual voltage label of an electrode in the GUI (Tk thread only)
+    # Labels are only reconfigured when their text changes
+    def updateActualV(self, name, voltage=None):
+        label = self.actual_labels.get(name)
+        if label is None:
+            return
+        if voltage is None:
+            voltage = self.actual_voltages[name]
+        text = "{:.1f} V".format(voltage)
+        if self.label_text.get(name) != text:
+            label.config(text=text)
+            self.label_text[name] = text
 
 
-    
     # Updates the entry voltage values in the GUI
     def updateEntryV(self, name):
         if name == 'U_bender':
@@ -623,6 +802,10 @@ class Thorium():
             self.U_exit_loading_entry.delete(0, END)
             self.U_exit_loading_entry.insert(0, int(round(self.entry_voltages[name],0)))
 
+        # A value typed for an electrode or group takes it back from a ramp or recipe that was holding it
+        self.releaseControlled(name)
+        self.notifySetpointChange()
+
     def populateEntryV(self):
         self.U_bender_entry.delete(0, END)
         self.U_bender_entry.insert(0, int(round(self.U_bender,0)))
@@ -752,110 +935,117 @@ class Thorium():
 
     # Updates the set voltage values
     def updateSetV(self):
-        quad_names = ['U_TL_bender', 'U_TR_bender', 'U_BL_bender', 'U_BR_bender']
-        extraction_names = ['U_TL_plate', 'U_TR_plate', 'U_BL_plate', 'U_BR_plate', 'U_L_ablation', 'U_L_ablation']
-        segment_1_names = ['U_TR1_loading', 'U_TL1_loading', 'U_BR1_loading', 'U_BL1_loading']
-        segment_2_names = ['U_TR2_loading', 'U_TL2_loading', 'U_BR2_loading', 'U_BL2_loading']
-        segment_3_names = ['U_TR3_loading', 'U_TL3_loading', 'U_BR3_loading', 'U_BL3_loading']
-        segment_4_names = ['U_TR4_loading', 'U_TL4_loading', 'U_BR4_loading', 'U_BL4_loading']
-        segment_5_names = ['U_TR5_loading', 'U_TL5_loading', 'U_BR5_loading', 'U_BL5_loading']
+        quad_names = self.control_electrodes['U_bender']
+        extraction_names = self.control_electrodes['U_extraction']
+        segment_1_names = self.control_electrodes['U_segment_1']
+        segment_2_names = self.control_electrodes['U_segment_2']
+        segment_3_names = self.control_electrodes['U_segment_3']
+        segment_4_names = self.control_electrodes['U_segment_4']
+        segment_5_names = self.control_electrodes['U_segment_5']
+
+        # The new set voltages are computed into a scratch copy and published at once with the
+        # holds applied, so a supply never gets the GUI value of an electrode held by a ramp
+        set_voltages = self.state.draft_view
+        set_voltages.array[:] = self.state.setpoint
 
         # Quadrupole bender button logic
         if self.U_bender_bool:
             if self.bender_mode_bool:
                 for name in quad_names:
-                    self.set_voltages[name] = self.entry_voltages[name]
+                    set_voltages[name] = self.entry_voltages[name]
             else:
-                self.set_voltages['U_TL_bender'] = -self.U_bender
-                self.set_voltages['U_TR_bender'] = self.U_bender
-                self.set_voltages['U_BL_bender'] = self.U_bender
-                self.set_voltages['U_BR_bender'] = -self.U_bender
+                set_voltages['U_TL_bender'] = -self.U_bender
+                set_voltages['U_TR_bender'] = self.U_bender
+                set_voltages['U_BL_bender'] = self.U_bender
+                set_voltages['U_BR_bender'] = -self.U_bender
         else:
             for name in quad_names:
-                self.set_voltages[name] = 0
+                set_voltages[name] = 0
 
         # Extraction electrode button logic
         if self.U_extraction_bool:
             for name in extraction_names:
-                self.set_voltages[name] = self.entry_voltages[name]
+                set_voltages[name] = self.entry_voltages[name]
         else:
             for name in extraction_names:
-                self.set_voltages[name] = 0
+                set_voltages[name] = 0
         
         # Segment 1 button logic
         if self.U_segment_1_bool:
             if self.segment_1_mode_bool:
                 for name in segment_1_names:
-                    self.set_voltages[name] = self.entry_voltages[name]
+                    set_voltages[name] = self.entry_voltages[name]
             else:
                 i = 1
                 for name in segment_1_names:
-                    self.set_voltages[name] = self.U_segment_1 + (-1)**i*self.dU_segment_1
+                    set_voltages[name] = self.U_segment_1 + (-1)**i*self.dU_segment_1
                     i = i + 1     
         else:
             for name in segment_1_names:
-                self.set_voltages[name] = 0
+                set_voltages[name] = 0
 
         # Segment 2 button logic
         if self.U_segment_2_bool:
             if self.segment_2_mode_bool:
                 for name in segment_2_names:
-                    self.set_voltages[name] = self.entry_voltages[name]
+                    set_voltages[name] = self.entry_voltages[name]
             else:
                 i = 1
                 for name in segment_2_names:
-                    self.set_voltages[name] = self.U_segment_2 + (-1)**i*self.dU_segment_2
+                    set_voltages[name] = self.U_segment_2 + (-1)**i*self.dU_segment_2
                     i = i + 1
         else:
             for name in segment_2_names:
-                self.set_voltages[name] = 0
+                set_voltages[name] = 0
 
         # Segment 3 button logic
         if self.U_segment_3_bool:
             if self.segment_3_mode_bool:
                 for name in segment_3_names:
-                    self.set_voltages[name] = self.entry_voltages[name]
+                    set_voltages[name] = self.entry_voltages[name]
             else:
                 i = 1
                 for name in segment_3_names:
-                    self.set_voltages[name] = self.U_segment_3 + (-1)**i*self.dU_segment_3
+                    set_voltages[name] = self.U_segment_3 + (-1)**i*self.dU_segment_3
                     i = i + 1
         else:
             for name in segment_3_names:
-                self.set_voltages[name] = 0
+                set_voltages[name] = 0
 
         # Segment 4 button logic
         if self.U_segment_4_bool:
             if self.segment_4_mode_bool:
                 for name in segment_4_names:
-                    self.set_voltages[name] = self.entry_voltages[name]
+                    set_voltages[name] = self.entry_voltages[name]
             else:
                 i = 1
                 for name in segment_4_names:
-                    self.set_voltages[name] = self.U_segment_4 + (-1)**i*self.dU_segment_4
+                    set_voltages[name] = self.U_segment_4 + (-1)**i*self.dU_segment_4
                     i = i + 1
         else:
             for name in segment_4_names:
-                self.set_voltages[name] = 0
+                set_voltages[name] = 0
         
         # Segment 5 button logic
         if self.U_segment_5_bool:
             if self.segment_5_mode_bool:
                 for name in segment_5_names:
-                    self.set_voltages[name] = self.entry_voltages[name]
+                    set_voltages[name] = self.entry_voltages[name]
             else:
                 i = 1
                 for name in segment_5_names:
-                    self.set_voltages[name] = self.U_segment_5 + (-1)**i*self.dU_segment_5
+                    set_voltages[name] = self.U_segment_5 + (-1)**i*self.dU_segment_5
                     i = i + 1
         else:
             for name in segment_5_names:
-                self.set_voltages[name] = 0
+                set_voltages[name] = 0
 
         if self.U_loading_plate_bool:
-            self.set_voltages['U_exit_loading'] = self.entry_voltages['U_exit_loading']
+            set_voltages['U_exit_loading'] = self.entry_voltages['U_exit_loading']
         else:
-            self.set_voltages['U_exit_loading'] = 0
+            set_voltages['U_exit_loading'] = 0
+
+        self.state.publish()
                 
 
     # Defines what should happen when a button is clicked
@@ -920,7 +1110,11 @@ class Thorium():
         elif variable == 'U_loading_plate':
             self.U_loading_plate_bool = value
             print('Loading Plate power button pressed')
+        # The button takes its electrodes back from a ramp or recipe that was holding them,
+        # so a segment shown as off is off
+        self.releaseControlled(variable)
         self.multiple = True
+        self.notifySetpointChange()
 
 
     def saveParameters(self):
@@ -939,6 +1133,28 @@ class Thorium():
         f. close()
         print('Parameters saved to file: ', newfile)
 
+    # Asks for a recipe file and runs it in a separate thread
+    def openRecipe(self):
+        if self.recipes is None:
+            print('Not connected to the power supplies')
+            return
+        if self.recipes.running:
+            print('A recipe is already running')
+            return
+        try:
+            newfile = filedialog.askopenfilename(initialdir = self.work_dir,title = "Select recipe",filetypes = (("recipe files","*.json"),("all files","*.*")))
+        except:
+            newfile = filedialog.askopenfilename(initialdir = desktop,title = "Select recipe",filetypes = (("recipe files","*.json"),("all files","*.*")))
+        if newfile == '':
+            return
+        try:
+            recipe = Recipe.load(newfile)
+            self.recipes.check(recipe)
+        except ValueError as e:
+            print(e)
+            return
+        multiThreading(lambda: self.runRecipe(recipe))
+
     def importParameters(self):
         try:
             newfile = filedialog.askopenfilename(initialdir = self.work_dir,title = "Select file",filetypes = (("all files","*.*"),("all files","*.*")))
@@ -952,10 +1168,14 @@ class Thorium():
         with open(newfile, 'r') as f:
             for line in f:
                 name, value = line.split(': ')
+                if name not in self.state.index:
+                    print('Unknown electrode in parameter file: ', name)
+                    continue
                 self.set_voltages[name] = float(value)
         f.close()
-        self.entry_voltages = self.set_voltages.copy()
+        self.state.entry[:] = self.state.setpoint
         self.populateEntryV()
+        self.notifySetpointChange()
         print('Parameters imported from file: ', newfile)
 
     
@@ -1034,6 +1254,13 @@ class Thorium():
         #self.filemenu.add_command(label='New Window', command=lambda: startProgram(Toplevel(self.root)))
         self.filemenu.add_command(label='Exit', command=lambda: self.quitProgram())
 
+        #Recipe Menu
+        self.recipemenu = Menu(menu, tearoff=0)
+        menu.add_cascade(label='Recipes', menu=self.recipemenu)
+        self.recipemenu.add_command(label='Run Recipe...', command=lambda: self.openRecipe())
+        self.recipemenu.add_command(label='Stop Recipe', command=lambda: self.recipes.stop() if self.recipes is not None else None)
+        self.recipemenu.add_command(label='Release Held Voltages', command=lambda: self.releaseVoltages())
+
         #Creates Help menu
         self.helpmenu = Menu(menu, tearoff=0)
         menu.add_cascade(label='Help', menu=self.helpmenu)
@@ -2185,8 +2412,42 @@ class Thorium():
 
 
 
+    #Creates the live plot of set (dashed) and actual voltages in the precision trap tab
+    #Electrodes are selected in the list on the left; the plot only redraws while the tab is shown
+    def live_plot_controls(self, window=60, max_fps=10):
+        import importlib.util
+        if importlib.util.find_spec('matplotlib') is None:
+            print('matplotlib is not installed, the live voltage plot is disabled')
+            return
+
+        self.plot_panel = Frame(self.precision_tab, background='grey90', highlightbackground='black', highlightcolor='black', highlightthickness=1)
+        self.plot_panel.place(relx=0.5, rely=0.5, anchor=CENTER, relwidth=0.95, relheight=0.92)
+
+        selector_frame = Frame(self.plot_panel, background='grey90')
+        selector_frame.pack(side=LEFT, fill=Y, padx=5, pady=5)
+        Label(selector_frame, text='Electrodes', font=font_14, bg='grey90', fg='black').pack(side=TOP)
+        self.plot_selector = Listbox(selector_frame, selectmode=MULTIPLE, exportselection=False, font=font_12, width=18)
+        self.plot_selector.pack(side=TOP, fill=Y, expand=1)
+        for name in self.state.names:
+            self.plot_selector.insert(END, name)
+
+        plot_frame = Frame(self.plot_panel, background='grey90')
+        plot_frame.pack(side=LEFT, fill=BOTH, expand=1)
+        self.live_plot = LivePlot(plot_frame, self.telemetry.ring, self.state.names, window, max_fps)
+        self.live_plot.visible = lambda: self.tabControl.select() == str(self.precision_tab)
+        self.fig, self.ax, self.canvas, self.toolbar = self.live_plot.fig, self.live_plot.ax, self.live_plot.canvas, self.live_plot.toolbar
+
+        self.plot_selector.bind('<<ListboxSelect>>', lambda eff: self.live_plot.select([self.state.names[i] for i in self.plot_selector.curselection()]))
+        for name in ('U_TL1_loading', 'U_TR1_loading'):
+            if name in self.state.index:
+                self.plot_selector.selection_set(self.state.names.index(name))
+        self.live_plot.select([self.state.names[i] for i in self.plot_selector.curselection()])
+        self.live_plot.start()
+
+
     #Creates the main GUI window
     def makeGui(self, root=None):
+        importGuiTools()
         if root == None:
             self.root = Tk()
         else:
@@ -2228,9 +2489,13 @@ class Thorium():
 
         self.loading_plate_controls(0.65, 0.7)
 
+        self.live_plot_controls()
 
+        self.registerActualLabels()
+        self.markUnwired()
+        self.refreshLabels()
 
-        multiThreading(self.data_reader)
+        self.loop_threads.append(multiThreading(self.data_reader))
         self.root.mainloop()
 
 
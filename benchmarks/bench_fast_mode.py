@@ -0,0 +1,80 @@
+#Benchmark: fast-update mode ('DIS AUTO' + legacy 'CH') against the normal 'SET' command
+#
+#Function:  Measures the latency of single channel updates (write until ACK) in both
+#           modes. Runs against a simulated HV500 by default, or against a real
+#           supply with --port.
+#
+#           python benchmarks/bench_fast_mode.py --updates 200
+#           python benchmarks/bench_fast_mode.py --port COM15
+
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hv500_server import HV500Server
+from hv500_simulator import HV500Simulator
+
+
+def make_server(args, fast_mode):
+    server = HV500Server()
+    server.fast_mode = fast_mode
+    if args.port is None:
+        simulator = HV500Simulator(baudrate=args.baud, command_delay=args.delay, display_delay=args.display_delay, seed=0)
+        simulator.connect(server)
+    else:
+        server.port = args.port
+        server.baudrate = args.baud
+        server.initServer()
+    return server
+
+
+def measure(server, updates, channel):
+    latencies = np.empty(updates)
+    for i in range(updates):
+        voltage = (i % 20) - 10
+        t0 = time.perf_counter()
+        server.set_voltage(channel, voltage)
+        latencies[i] = time.perf_counter() - t0
+    return {'updates': updates,
+            'mean_ms': latencies.mean()*1e3,
+            'p50_ms': np.percentile(latencies, 50)*1e3,
+            'p95_ms': np.percentile(latencies, 95)*1e3,
+            'max_ms': latencies.max()*1e3,
+            'updates_per_s': updates/latencies.sum()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares single channel update latency with and without fast-update mode.')
+    parser.add_argument('--port', default=None, help='serial port of a real supply (default: simulator)')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--delay', type=float, default=0.002, help='simulated processing delay per command')
+    parser.add_argument('--display-delay', type=float, default=0.02, help='simulated display refresh time after a set')
+    parser.add_argument('--updates', type=int, default=100)
+    parser.add_argument('--channel', type=int, default=1)
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for label, fast_mode in (('SET', False), ('DIS AUTO + CH', True)):
+        server = make_server(args, fast_mode)
+        try:
+            results[label] = measure(server, args.updates, args.channel)
+        finally:
+            server.close()
+
+    for label, r in results.items():
+        print(f"{label:>14}: mean {r['mean_ms']:7.2f} ms  p50 {r['p50_ms']:7.2f} ms  "
+              f"p95 {r['p95_ms']:7.2f} ms  max {r['max_ms']:7.2f} ms  {r['updates_per_s']:7.1f} updates/s")
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#Benchmark: import time of the driver and control modules
+#
+#Function:  Imports each module in a fresh interpreter with 'python -X importtime' and
+#           checks that the import stays within its time budget, prints nothing and
+#           does not pull in GUI or port enumeration modules. Exits with status 1 if
+#           any check fails, so it can be used as a budget test.
+#
+#           python benchmarks/bench_import.py
+#           python benchmarks/bench_import.py --scale 2 --json import_times.json
+
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time budgets in ms (NumPy alone accounts for most of it)
+BUDGETS = {'hv500_server': 250,
+           'hv500_simulator': 50,
+           'Thorium_Control_Interface': 300}
+
+# Modules that must only be imported when they are actually used
+FORBIDDEN = ['tkinter', 'PIL', 'matplotlib', 'webbrowser', 'serial.tools.list_ports']
+
+
+def measure(module):
+    """
+    Returns:
+        (cumulative import time in ms, stdout printed during the import, list of forbidden modules imported)
+    """
+    code = f'import {module}, sys; print("\\0" + ",".join(sys.modules))'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    printed, _, modules = result.stdout.rpartition('\0')
+    cumulative = None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            cumulative = int(fields[1])/1e3
+    loaded = set(modules.strip().split(','))
+    return cumulative, printed, [name for name in FORBIDDEN if name in loaded]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks import time budgets of the driver and control modules.')
+    parser.add_argument('--repeat', type=int, default=5, help='imports per module, the fastest one is used')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies all budgets (for slow machines)')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    failed = False
+    for module, budget in BUDGETS.items():
+        runs = [measure(module) for i in range(args.repeat)]
+        best = min(run[0] for run in runs)
+        printed, forbidden = runs[0][1], runs[0][2]
+        ok = best <= budget*args.scale and not printed and not forbidden
+        failed = failed or not ok
+        results[module] = {'import_ms': best, 'budget_ms': budget*args.scale, 'printed': printed,
+                           'forbidden_imports': forbidden, 'ok': ok}
+        print(f"{module:>26}: {best:7.1f} ms (budget {budget*args.scale:.0f} ms)  {'ok' if ok else 'FAILED'}")
+        if printed:
+            print(f'    prints on import: {printed!r}')
+        if forbidden:
+            print(f'    imports {", ".join(forbidden)}')
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+#Benchmark: hot path of the driver and control loop
+#
+#Function:  Measures the pieces of the read/write cycle against simulated HV500 supplies
+#           (hv500_simulator) with emulated link speed and device processing time:
+#             - encoding ('voltages_to_hex', bulk 'A' packet) and readback parsing throughput,
+#             - updateSetV and the electrode state gather/scatter,
+#             - getVoltages and setVoltages end to end on all supplies of the hardware map,
+#             - click-to-ACK latency (setpoint change until the write is acknowledged),
+#             - data reader loop frequency.
+#           The results are written as JSON with the commit, versions and settings, and a
+#           previous result file can be given with --compare to print the change of every
+#           number.
+#
+#           python benchmarks/bench_suite.py
+#           python benchmarks/bench_suite.py --baud 9600 115200 --json after.json --compare before.json
+
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import Thorium_Control_Interface as control
+from hv500_simulator import HV500Simulator
+from supply_pool import SupplyPool
+
+
+def per_call(fn, min_time=0.2, rounds=5):
+    """Times fn in rounds of n calls, with n chosen so a round lasts min_time/rounds."""
+    n = 1
+    while True:
+        t0 = time.perf_counter()
+        for i in range(n):
+            fn()
+        if time.perf_counter() - t0 >= min_time/rounds:
+            break
+        n *= 2
+    times = []
+    for r in range(rounds):
+        t0 = time.perf_counter()
+        for i in range(n):
+            fn()
+        times.append((time.perf_counter() - t0)/n)
+    median = float(np.median(times))
+    return {'calls': n*rounds, 'best_us': min(times)*1e6, 'median_us': median*1e6, 'per_s': 1/median}
+
+
+def latency(samples):
+    """Summary of an array of durations in seconds."""
+    samples = np.asarray(samples)
+    return {'count': len(samples),
+            'mean_ms': samples.mean()*1e3,
+            'p50_ms': np.percentile(samples, 50)*1e3,
+            'p95_ms': np.percentile(samples, 95)*1e3,
+            'max_ms': samples.max()*1e3}
+
+
+def make_thorium(baud, delay, overload=0.0):
+    """A Thorium instance without GUI whose supplies are simulators."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        thorium = control.Thorium()
+        thorium.pool = SupplyPool(thorium.hardware, metrics=thorium.metrics)
+        thorium.servers = thorium.pool.servers
+        for supply, server in thorium.servers.items():
+            simulator = HV500Simulator(IDN=f'HV{300 + supply}', baudrate=baud, command_delay=delay,
+                                       overload_rate=overload, seed=supply)
+            simulator.connect(server)
+        thorium.pool.start()
+    return thorium
+
+
+def close_thorium(thorium):
+    """Stops and joins the data reader and writer threads, then closes the supplies."""
+    threads = list(thorium.loop_threads)
+    thorium.stopLoops()
+    for thread in threads:
+        if thread.is_alive():
+            raise RuntimeError(f'{thread.name} did not stop')
+    with contextlib.redirect_stdout(io.StringIO()):
+        thorium.pool.close()
+
+
+def bench_micro(args):
+    thorium = make_thorium(0, 0.0)
+    try:
+        server = thorium.servers[min(thorium.servers)]
+        voltages = np.linspace(-450, 450, len(server.spans))
+        reading = server.engine.query(f'{server.IDN} U00\r'.encode()).result()
+        readback = np.empty(len(server.spans))
+        mask = np.zeros(len(server.spans), dtype=bool)
+        frames = np.tile(voltages, (100, 1))
+
+        thorium.U_segment_1_bool = thorium.segment_1_mode_bool = True
+        thorium.U_bender_bool = True
+        supply = min(thorium.state.supplies)
+
+        benchmarks = {'voltages_to_hex': lambda: server.voltages_to_hex(voltages),
+                      'bulk_packet': lambda: server.bulk_packet(voltages),
+                      'bulk_packets_100_frames': lambda: server.bulk_packets(frames),
+                      'parse_all_voltages': lambda: server.parse_all_voltages(reading),
+                      'parse_all_voltages_into': lambda: server.parse_all_voltages_into(reading, readback, mask),
+                      'updateSetV': thorium.updateSetV,
+                      'state_gather': lambda: thorium.state.gather(supply, readback, mask),
+                      'state_scatter': lambda: thorium.state.scatter(supply)}
+        results = {}
+        for name, fn in benchmarks.items():
+            results[name] = per_call(fn, args.min_time)
+        results['parse_all_voltages']['bytes_per_s'] = len(reading)*results['parse_all_voltages']['per_s']
+        results['parse_all_voltages_into']['bytes_per_s'] = len(reading)*results['parse_all_voltages_into']['per_s']
+        return results
+    finally:
+        close_thorium(thorium)
+
+
+def bench_link(args, baud):
+    results = {}
+    thorium = make_thorium(baud, args.delay, args.overload)
+    try:
+        thorium.getVoltages()
+        thorium.state.setpoint[:] = thorium.state.actual
+        thorium.setVoltages()
+
+        samples = []
+        for i in range(args.samples):
+            t0 = time.perf_counter()
+            thorium.getVoltages()
+            samples.append(time.perf_counter() - t0)
+        results['getVoltages'] = latency(samples)
+
+        # One electrode changes per write, so the planner sends a single channel command
+        electrode = thorium.state.index['U_TL1_loading']
+        samples = []
+        for i in range(args.samples):
+            thorium.state.setpoint[electrode] = (i % 20) - 10
+            t0 = time.perf_counter()
+            thorium.setVoltages()
+            samples.append(time.perf_counter() - t0)
+        results['setVoltages_one_channel'] = latency(samples)
+
+        # Every wired electrode changes, so every supply gets a bulk 'A' command
+        samples = []
+        for i in range(args.samples):
+            thorium.state.setpoint[thorium.state.wired] = (i % 20) - 10
+            t0 = time.perf_counter()
+            thorium.setVoltages()
+            samples.append(time.perf_counter() - t0)
+        results['setVoltages_all_channels'] = latency(samples)
+
+        # A value typed into a segment, from the change until the supply acknowledged it
+        thorium.loop_threads.append(control.multiThreading(thorium.data_writer))
+        thorium.U_segment_1_bool = thorium.segment_1_mode_bool = True
+        acks = thorium.latency_stats['ack']
+        samples = []
+        for i in range(args.samples):
+            count = acks.count
+            thorium.entry_voltages['U_TL1_loading'] = (i % 20) - 10
+            t0 = time.perf_counter()
+            thorium.notifySetpointChange()
+            while acks.count == count and time.perf_counter() - t0 < 5:
+                time.sleep(0.0002)
+            samples.append(time.perf_counter() - t0)
+        results['click_to_ack'] = latency(samples)
+    finally:
+        close_thorium(thorium)
+
+    # Loop frequency of the data reader with no period to wait for
+    thorium = make_thorium(baud, args.delay, args.overload)
+    try:
+        thorium.setLoopPeriod(args.loop_period)
+        thorium.loop_threads.append(control.multiThreading(thorium.data_reader))
+        time.sleep(0.5)
+        start, t0 = thorium.scheduler.iterations, time.perf_counter()
+        time.sleep(args.duration)
+        iterations, elapsed = thorium.scheduler.iterations - start, time.perf_counter() - t0
+        results['data_reader_loop'] = {'iterations': iterations, 'hz': iterations/elapsed,
+                                       'get_p50_ms': thorium.loop_stats['get'].percentile(0.5)*1e3,
+                                       'get_p99_ms': thorium.loop_stats['get'].percentile(0.99)*1e3}
+    finally:
+        close_thorium(thorium)
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(results, baseline):
+    """Prints every timing and rate next to the baseline; a positive change is an improvement."""
+    now, before = flatten(results), flatten(baseline)
+    print(f'\n{"benchmark":<58} {"baseline":>12} {"now":>12} {"change":>8}')
+    for key, value in now.items():
+        old = before.get(key)
+        lower_is_better = key.endswith(('_us', '_ms'))
+        if old is None or not old or not (lower_is_better or key.endswith(('per_s', 'hz'))):
+            continue
+        change = (old/value - 1) if lower_is_better else (value/old - 1)
+        print(f'{key:<58} {old:>12.4g} {value:>12.4g} {change*100:>+7.1f}%')
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'settings': vars(args)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the driver and control loop against simulated supplies.')
+    parser.add_argument('--baud', type=int, nargs='+', default=[9600, 115200], help='emulated link speeds')
+    parser.add_argument('--delay', type=float, default=0.002, help='simulated processing delay per command')
+    parser.add_argument('--overload', type=float, default=0.0, help='fraction of readbacks the simulator drops')
+    parser.add_argument('--samples', type=int, default=30, help='repetitions of each end to end measurement')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds the data reader loop is run')
+    parser.add_argument('--loop-period', type=float, default=0.001, help='data reader period in seconds')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds spent on each micro benchmark')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    parser.add_argument('--compare', default=None, help='results file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = {'meta': metadata(args), 'micro': bench_micro(args), 'link': {}}
+    for name, r in results['micro'].items():
+        print(f"{name:>26}: {r['median_us']:9.2f} us  ({r['per_s']:10.0f} /s)")
+    for baud in args.baud:
+        results['link'][str(baud)] = r = bench_link(args, baud)
+        print(f'\n{baud} baud, {args.delay*1e3:g} ms device delay')
+        for name, value in r.items():
+            if 'p50_ms' in value and 'mean_ms' in value:
+                print(f"{name:>26}: p50 {value['p50_ms']:7.2f} ms  p95 {value['p95_ms']:7.2f} ms  max {value['max_ms']:7.2f} ms")
+        loop = r['data_reader_loop']
+        print(f"{'data_reader_loop':>26}: {loop['hz']:7.2f} Hz  get p50 {loop['get_p50_ms']:7.2f} ms  p99 {loop['get_p99_ms']:7.2f} ms")
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare({key: value for key, value in results.items() if key != 'meta'}, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
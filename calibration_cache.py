@@ -0,0 +1,68 @@
+#HV500 Calibration Cache
+#
+#Function:  Persists the IDN of the supply on each port and the calibration (spans and
+#           offsets) of each supply, keyed by IDN, so a supply can be addressed and
+#           programmed right away on startup without waiting for the slow 'IDN' and
+#           'RCORR' round trips.
+
+
+import json
+import os
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.thorium_control', 'hv500_calibration.json')
+
+
+class CalibrationCache():
+    """
+    Small JSON file of the form
+    {"ports": {port: IDN}, "devices": {IDN: {"spans": [...], "offsets": [...], "updated": ...}}}
+
+    Args:
+        path: str, location of the cache file.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        data.setdefault('ports', {})
+        data.setdefault('devices', {})
+        return data
+
+    def lookup(self, port):
+        """
+        Returns:
+            (IDN, spans, offsets) last seen on the port, or None if nothing is cached.
+        """
+        with self._lock:
+            data = self._read()
+        IDN = data['ports'].get(str(port))
+        device = data['devices'].get(IDN)
+        if device is None:
+            return None
+        return IDN, device['spans'], device['offsets']
+
+    def store(self, port, IDN, spans, offsets):
+        with self._lock:
+            data = self._read()
+            data['ports'][str(port)] = IDN
+            data['devices'][IDN] = {'spans': [float(s) for s in spans],
+                                    'offsets': [float(o) for o in offsets],
+                                    'updated': time.strftime('%Y-%m-%d %H:%M:%S')}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                # Written to a temporary file first so a crash never leaves a truncated cache
+                temp = self.path + '.tmp'
+                with open(temp, 'w') as f:
+                    json.dump(data, f, indent=2)
+                os.replace(temp, self.path)
+            except OSError:
+                print(f'Could not write calibration cache {self.path}')
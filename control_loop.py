@@ -0,0 +1,182 @@
+#Control Loop Tools
+#
+#Function:  Pacing for the data reader loop of the Thorium Control Interface: a scheduler
+#           that runs the loop on absolute deadlines and an adaptive poller that picks
+#           its period.
+
+
+import math
+import threading
+import time
+
+import numpy as np
+
+
+class AdaptivePoller():
+    """
+    Chooses the delay before the next readback.
+
+    The loop polls at min_interval while any electrode is still settling towards its
+    setpoint or the operator has edited something in the last activity_hold seconds.
+    Once the readbacks are stable the interval grows by a factor of backoff per
+    iteration, up to max_interval.
+
+    Args:
+        min_interval: float, fastest polling interval in seconds.
+        max_interval: float, slowest polling interval in seconds.
+        backoff: float, growth factor of the interval per stable iteration.
+        activity_hold: float, seconds after an edit during which the loop stays fast.
+    """
+
+    def __init__(self, min_interval=0.1, max_interval=2.0, backoff=1.5, activity_hold=5.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.activity_hold = activity_hold
+        self.interval = min_interval
+        self.last_activity = None
+        self.wake = threading.Event()
+
+    def poke(self):
+        """
+        Signals operator activity: polls fast again and cuts the current wait short.
+        A LoopScheduler sharing the wake event is woken as well.
+        """
+        self.last_activity = time.monotonic()
+        self.interval = self.min_interval
+        self.wake.set()
+
+    def editing(self):
+        return self.last_activity is not None and time.monotonic() - self.last_activity < self.activity_hold
+
+    def next_interval(self, settling):
+        """
+        Args:
+            settling: bool, True if any readback still differs from its setpoint.
+
+        Returns:
+            float, seconds to wait before the next iteration.
+        """
+        if settling or self.editing():
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval*self.backoff, self.max_interval)
+        return self.interval
+
+
+class LoopScheduler():
+    """
+    Runs a loop at a fixed period on absolute deadlines (time.monotonic), so the period
+    does not stretch by the time the work takes. An iteration that runs past the next
+    deadline is an overrun; the deadlines it missed are either skipped (the loop waits
+    for the next deadline on the original grid) or merged (the loop runs again at once,
+    once for all missed deadlines, and stays on the grid).
+
+    Usage:
+        scheduler.start()
+        while True:
+            scheduler.begin()
+            ...
+            scheduler.end()
+            scheduler.wait()
+
+    Args:
+        period: float, loop period in seconds. Can be changed at any time with set_period.
+        policy: str, 'skip' or 'merge'.
+        bins: list of floats, upper edges (seconds) of the iteration time histogram.
+        wake: optional threading.Event; setting it ends the current wait.
+        reanchor: bool, if True a wake restarts the deadline grid from that moment (for an
+            adaptive period). If False the woken iteration only runs early and the following
+            deadlines stay on the grid (for a fixed period).
+    """
+
+    default_bins = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0]
+
+    def __init__(self, period=0.5, policy='skip', bins=None, wake=None, reanchor=True):
+        if policy not in ('skip', 'merge'):
+            raise ValueError(f"Unknown policy {policy}, expected 'skip' or 'merge'")
+        self.period = period
+        self.policy = policy
+        self.bins = np.array(self.default_bins if bins is None else bins, dtype=float)
+        # Last bin counts iterations longer than the last edge
+        self.histogram = np.zeros(len(self.bins) + 1, dtype=np.int64)
+        self.wake = threading.Event() if wake is None else wake
+        self.reanchor = reanchor
+        self.iterations = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.wakeups = 0
+        self.last_time = 0.0
+        self.max_time = 0.0
+        self.total_time = 0.0
+        self._deadline = None
+        self._begin = None
+
+    def start(self):
+        """Anchors the deadline grid at the current time."""
+        self._deadline = time.monotonic()
+
+    def set_period(self, period):
+        """Changes the period from the next deadline on."""
+        self.period = period
+
+    def begin(self):
+        self._begin = time.monotonic()
+
+    def end(self):
+        """Records the time since begin() in the iteration statistics."""
+        dt = time.monotonic() - self._begin
+        self.iterations += 1
+        self.last_time = dt
+        self.total_time += dt
+        self.max_time = max(self.max_time, dt)
+        self.histogram[np.searchsorted(self.bins, dt)] += 1
+
+    def wait(self):
+        """
+        Waits until the next deadline.
+
+        Returns:
+            int, number of deadlines missed since the previous call (0 if on time).
+        """
+        if self._deadline is None:
+            self.start()
+        self._deadline += self.period
+        now = time.monotonic()
+        missed = 0
+        if now > self._deadline:
+            self.overruns += 1
+            missed = int(math.floor((now - self._deadline)/self.period)) + 1
+            self.skipped += missed
+            if self.policy == 'merge':
+                # Run again right away, on the last deadline that was missed
+                self._deadline += (missed - 1)*self.period
+                return missed
+            self._deadline += missed*self.period
+        if self.wake.wait(self._deadline - now):
+            self.wake.clear()
+            self.wakeups += 1
+            if self.reanchor:
+                self._deadline = time.monotonic()
+        return missed
+
+    @property
+    def mean_time(self):
+        return self.total_time/self.iterations if self.iterations else 0
+
+    def stats(self):
+        """Returns a dictionary with the period, overrun counters and iteration time histogram."""
+        edges = [f'<={edge*1e3:g} ms' for edge in self.bins] + [f'>{self.bins[-1]*1e3:g} ms']
+        return {'period': self.period,
+                'policy': self.policy,
+                'iterations': self.iterations,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'wakeups': self.wakeups,
+                'mean_time': self.mean_time,
+                'max_time': self.max_time,
+                'histogram': dict(zip(edges, self.histogram.tolist()))}
+
+    def __repr__(self):
+        return (f'period={self.period*1e3:.0f} ms iterations={self.iterations} overruns={self.overruns} '
+                f'skipped={self.skipped} mean={self.mean_time*1e3:.1f} ms max={self.max_time*1e3:.1f} ms')
@@ -0,0 +1,197 @@
+#Electrode State Store
+#
+#Function:  Keeps the actual, set and entry voltages of all electrodes in NumPy arrays
+#           indexed by electrode id, together with precomputed index arrays that map
+#           each power supply's channels to electrodes. Moving a readback into the
+#           electrode state, or the setpoints out to a supply, is then one indexed NumPy
+#           assignment per supply instead of a loop over a dictionary.
+
+
+import threading
+from collections.abc import MutableMapping
+
+import numpy as np
+
+
+class VoltageView(MutableMapping):
+    """
+    Dictionary-like view of one voltage array of an ElectrodeState, keyed by electrode
+    name. Reads and writes go straight to the array.
+    """
+
+    def __init__(self, state, array):
+        self._index = state.index
+        self._names = state.names
+        self.array = array
+
+    def __getitem__(self, name):
+        return float(self.array[self._index[name]])
+
+    def __setitem__(self, name, voltage):
+        self.array[self._index[name]] = voltage
+
+    def __delitem__(self, name):
+        raise TypeError('Electrodes cannot be removed')
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        """Returns a plain dictionary with the current voltages, like dict.copy()."""
+        return dict(zip(self._names, self.array.tolist()))
+
+
+class ElectrodeState():
+    """
+    Array-backed voltages of all electrodes.
+
+    Args:
+        v_location: dict, electrode name -> (supply, channel) with channels counted from 1,
+            or None for an electrode that is not wired to a supply.
+        channels: int, number of channels per supply, or a dict of supply -> channels.
+        supplies: optional list of supply numbers, by default the supplies used in v_location.
+    """
+
+    def __init__(self, v_location, channels=16, supplies=None):
+        self.names = list(v_location)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        n = len(self.names)
+
+        self.actual = np.zeros(n)
+        self.setpoint = np.zeros(n)
+        self.entry = np.zeros(n)
+        self.actual_view = VoltageView(self, self.actual)
+        self.setpoint_view = VoltageView(self, self.setpoint)
+        self.entry_view = VoltageView(self, self.entry)
+
+        # Setpoints held by e.g. a voltage ramp; NaN where the GUI controls the setpoint
+        self.held = np.full(n, np.nan)
+
+        # Scratch setpoints the GUI logic computes new values into before publish()
+        self.draft = np.zeros(n)
+        self.draft_view = VoltageView(self, self.draft)
+
+        # Taken by publish, hold, release and scatter, so a supply never gets a GUI value
+        # for an electrode that is held, or half of an update
+        self.lock = threading.RLock()
+
+        # Per supply: electrode ids and the (zero based) channel each one is wired to
+        wired = {name: location for name, location in v_location.items() if location is not None}
+        if supplies is None:
+            supplies = {location[0] for location in wired.values()}
+        self.supplies = sorted(supplies)
+        if not isinstance(channels, dict):
+            channels = {supply: channels for supply in self.supplies}
+        self.channels = channels
+        self.electrode_index = {}
+        self.channel_index = {}
+        for supply in self.supplies:
+            names = [name for name in wired if wired[name][0] == supply]
+            self.electrode_index[supply] = np.array([self.index[name] for name in names], dtype=np.intp)
+            self.channel_index[supply] = np.array([wired[name][1]-1 for name in names], dtype=np.intp)
+
+        # True for electrodes wired to a supply channel
+        self.wired = np.zeros(n, dtype=bool)
+        for supply in self.supplies:
+            self.wired[self.electrode_index[supply]] = True
+
+        # Channel vector of each supply handed out by scatter, reused between calls
+        self._setpoints = {supply: np.zeros(channels[supply]) for supply in self.supplies}
+
+    def electrodes(self, names):
+        """Returns the electrode ids of a list of names."""
+        return np.array([self.index[name] for name in names], dtype=np.intp)
+
+    def unwired(self, names):
+        """Returns the names, of those given, that are unknown or not wired to any supply."""
+        return [name for name in names if name not in self.index or not self.wired[self.index[name]]]
+
+    def hold(self, electrodes, voltages):
+        """
+        Sets and holds the setpoints of some electrodes, so that recomputing the setpoints
+        from the GUI (publish after updateSetV) does not revert them.
+
+        Args:
+            electrodes: array of electrode ids.
+            voltages: array of floats, setpoints in volts.
+        """
+        with self.lock:
+            self.held[electrodes] = voltages
+            self.setpoint[electrodes] = voltages
+
+    def release(self, electrodes=None):
+        """Returns the setpoints of the given electrode ids (default all) to the GUI."""
+        with self.lock:
+            if electrodes is None:
+                self.held[:] = np.nan
+            else:
+                self.held[electrodes] = np.nan
+
+    def apply_holds(self):
+        """Overwrites the setpoints of held electrodes with their held values."""
+        with self.lock:
+            np.copyto(self.setpoint, self.held, where=~np.isnan(self.held))
+
+    def publish(self, setpoints=None):
+        """
+        Replaces the setpoints with new values in one step. Held electrodes keep their
+        held values, so a write in progress sees either the old or the new setpoints,
+        never a GUI value of a held electrode.
+
+        Args:
+            setpoints: array of floats, new setpoints of all electrodes; defaults to
+                self.draft. Modified in place where electrodes are held.
+        """
+        if setpoints is None:
+            setpoints = self.draft
+        with self.lock:
+            np.copyto(setpoints, self.held, where=~np.isnan(self.held))
+            self.setpoint[:] = setpoints
+
+    @classmethod
+    def from_hardware_map(cls, hardware_map):
+        """Compiles a HardwareMap into the index arrays used by the I/O loop."""
+        return cls(hardware_map.electrodes, hardware_map.channels(), hardware_map.supplies)
+
+    def gather(self, supply, readback, mask=None):
+        """
+        Copies a supply's readback into the actual voltages of its electrodes.
+
+        Args:
+            supply: int, supply number.
+            readback: array of floats, voltage of each channel of the supply.
+            mask: optional array of bools, True for channels that could not be read.
+                Their electrodes keep the previous value.
+        """
+        electrodes = self.electrode_index[supply]
+        channels = self.channel_index[supply]
+        if mask is not None and mask.any():
+            valid = ~mask[channels]
+            electrodes = electrodes[valid]
+            channels = channels[valid]
+        self.actual[electrodes] = readback[channels]
+
+    def scatter(self, supply, source=None, out=None):
+        """
+        Returns the channel vector of a supply built from electrode voltages.
+        Channels without an electrode are 0.
+
+        Args:
+            supply: int, supply number.
+            source: array of electrode voltages, defaults to the setpoints.
+            out: optional array to fill. By default an array owned by the state is
+                returned, which is reused by the next call for the same supply.
+        """
+        if source is None:
+            source = self.setpoint
+        if out is None:
+            out = self._setpoints[supply]
+        with self.lock:
+            out[self.channel_index[supply]] = source[self.electrode_index[supply]]
+        return out
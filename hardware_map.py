@@ -0,0 +1,94 @@
+#Hardware Map
+#
+#Function:  Loads which HV500 power supply and channel drives each electrode, and the
+#           port of each supply, from a JSON file. The map is checked for conflicts
+#           (two electrodes on one channel, unknown supplies, channels out of range)
+#           before anything is connected, so a wiring mistake is reported at startup
+#           instead of one electrode silently overwriting another.
+
+
+import json
+import os
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hardware_map.json')
+
+
+class HardwareMapError(ValueError):
+    """Raised when a hardware map is malformed or has conflicting assignments."""
+
+
+class HardwareMap():
+    """
+    Electrode wiring of any number of HV500 supplies.
+
+    Args:
+        supplies: dict, supply number -> {'port': str, 'label': str, 'channels': int, 'baudrate': int}.
+            Only 'port' is required; channels defaults to 16.
+        electrodes: dict, electrode name -> (supply, channel) with channels counted from 1,
+            or None for an electrode that is not wired to any supply.
+    """
+
+    def __init__(self, supplies, electrodes):
+        self.supplies = {}
+        for number, supply in supplies.items():
+            supply = dict(supply)
+            supply.setdefault('channels', 16)
+            supply.setdefault('label', f'Supply {number}')
+            self.supplies[int(number)] = supply
+        self.electrodes = {name: None if location is None else tuple(location)
+                           for name, location in electrodes.items()}
+        self.validate()
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        """Reads a hardware map from a JSON file with 'supplies' and 'electrodes' sections."""
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise HardwareMapError(f'Could not read hardware map {path}: {e}')
+        if 'supplies' not in data or 'electrodes' not in data:
+            raise HardwareMapError(f'Hardware map {path} needs "supplies" and "electrodes" sections')
+        return cls(data['supplies'], data['electrodes'])
+
+    def validate(self):
+        """
+        Checks every assignment and raises HardwareMapError listing all problems found.
+        Electrodes that are not wired to a supply only produce a warning.
+        """
+        errors = []
+        owners = {}
+        for name, location in self.electrodes.items():
+            if location is None:
+                continue
+            if len(location) != 2:
+                errors.append(f'{name}: location must be [supply, channel], got {list(location)}')
+                continue
+            supply, channel = location
+            if supply not in self.supplies:
+                errors.append(f'{name}: unknown supply {supply}')
+                continue
+            if not 1 <= channel <= self.supplies[supply]['channels']:
+                errors.append(f'{name}: supply {supply} has no channel {channel}')
+                continue
+            if location in owners:
+                errors.append(f'{name}: supply {supply} channel {channel} is already assigned to {owners[location]}')
+                continue
+            owners[location] = name
+        if errors:
+            raise HardwareMapError('Invalid hardware map:\n  ' + '\n  '.join(errors))
+
+        for name in self.unassigned():
+            print(f'Warning: {name} is not assigned to a power supply channel')
+
+    def unassigned(self):
+        """Returns the names of electrodes not wired to any supply."""
+        return [name for name, location in self.electrodes.items() if location is None]
+
+    def ports(self):
+        """Returns a dict of supply number -> port."""
+        return {number: supply['port'] for number, supply in self.supplies.items()}
+
+    def channels(self):
+        """Returns a dict of supply number -> number of channels."""
+        return {number: supply['channels'] for number, supply in self.supplies.items()}
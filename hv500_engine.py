@@ -0,0 +1,318 @@
+#HV500 Command Engine
+#
+#Function:  Pipelined command engine for one HV500 serial port. Submitted commands wait
+#           in a priority queue and a sender thread writes them as soon as the port
+#           allows (up to a configurable number in flight), so setpoint writes can go
+#           ahead of queued readbacks. A dedicated reader thread frames the responses
+#           with a streaming parser and the responses are handed back to the callers
+#           through futures.
+
+
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+ACK = b'\x06\r'
+NAK = b'\x15\r'
+
+# Command priorities, lowest number is sent first
+HIGH = 0        # setpoint writes
+NORMAL = 1      # identification, calibration and other commands
+LOW = 2         # readbacks
+
+
+def chain(future, function):
+    """Returns a new future which resolves to function(future.result())."""
+    out = Future()
+
+    def done(f):
+        try:
+            out.set_result(function(f.result()))
+        except Exception as e:
+            out.set_exception(e)
+
+    future.add_done_callback(done)
+    return out
+
+
+def gather(futures, function=list):
+    """Returns a new future which resolves to function(results) once every future is done."""
+    out = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(f):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        try:
+            out.set_result(function([f.result() for f in futures]))
+        except Exception as e:
+            out.set_exception(e)
+
+    if not futures:
+        out.set_result(function([]))
+    for future in futures:
+        future.add_done_callback(done)
+    return out
+
+
+class ResponseParser():
+    """
+    Streaming parser for the HV500 response stream.
+
+    ACK and NAK are sent as '\\x06\\r' and '\\x15\\r', readings as text lines
+    terminated by '\\r\\n'. Frames are split on '\\r' and a '\\n' left over from
+    the previous line is dropped, so partial reads can be fed in any chunking.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Args:
+            data: bytes received from the port.
+
+        Returns:
+            list of complete frames as (kind, bytes) with kind 'ack', 'nak' or 'line'.
+        """
+        self.buffer += data
+        frames = []
+        while True:
+            index = self.buffer.find(b'\r')
+            if index < 0:
+                break
+            frame = bytes(self.buffer[:index]).lstrip(b'\n')
+            del self.buffer[:index+1]
+            if frame == b'\x06':
+                frames.append(('ack', ACK))
+            elif frame == b'\x15':
+                frames.append(('nak', NAK))
+            elif frame:
+                frames.append(('line', frame + b'\r\n'))
+        return frames
+
+    def clear(self):
+        self.buffer.clear()
+
+
+class _Request():
+    __slots__ = ('packet', 'kind', 'future', 'sent')
+
+    def __init__(self, packet, kind, future):
+        self.packet = packet
+        self.kind = kind
+        self.future = future
+        self.sent = None
+
+
+class CommandEngine():
+    """
+    Keeps several commands in flight on one serial port.
+
+    The device answers strictly in order, so responses are matched to the oldest
+    outstanding request. A request that gets no response within `timeout` seconds
+    (e.g. a readback dropped during serial overload) resolves to b'', the same value
+    readline() and read() return on a timeout.
+
+    Readings carry no channel tag, so a dropped reading could not be told apart from
+    the one behind it. Only one command answered with a line is therefore kept in
+    flight at a time, while any number of ACK/NAK commands are pipelined around it.
+
+    Commands are sent in order of priority (HIGH, NORMAL, LOW) and in submission order
+    within one priority. A command that cannot be sent yet (a reading while another one
+    is in flight) holds back the commands behind it in its priority only.
+
+    Args:
+        ser: open serial port (or any object with write, read and in_waiting).
+        max_in_flight: int, maximum number of unanswered commands on the wire.
+        timeout: float, seconds to wait for a response once it is next in line.
+        poll_interval: float, read timeout of the reader thread in seconds.
+    """
+
+    def __init__(self, ser, max_in_flight=8, timeout=1.0, poll_interval=0.02):
+        self.ser = ser
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.sent = 0
+        self.timeouts = 0
+        self.unsolicited = 0
+        # Optional callable(packet, seconds, response) run on the reader thread when a
+        # request completes; response is b'' for a request that timed out
+        self.on_response = None
+        self._parser = ResponseParser()
+        self._pending = collections.deque()
+        self._queues = [collections.deque() for _ in (HIGH, NORMAL, LOW)]
+        self._lines = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._last_rx = 0
+        self._running = False
+        self._thread = None
+        self._sender = None
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def start(self):
+        self.ser.timeout = self.poll_interval
+        self._running = True
+        self._thread = threading.Thread(target=self._reader, daemon=True)
+        self._thread.start()
+        self._sender = threading.Thread(target=self._send, daemon=True)
+        self._sender.start()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._ready.notify_all()
+        for thread in (self._thread, self._sender):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        self._thread = None
+        self._sender = None
+        with self._lock:
+            done = list(self._pending)
+            self._pending.clear()
+            self._lines = 0
+            for queue in self._queues:
+                done += queue
+                queue.clear()
+        for request in done:
+            request.future.set_result(b'')
+
+    def submit(self, packet, kind, priority=NORMAL):
+        """
+        Queues a command and returns a future for its response. Does not block.
+
+        Args:
+            packet: bytes, complete command including the trailing '\\r'.
+            kind: str, 'line' for commands answered with a reading, 'ack' for commands
+                answered with ACK/NAK.
+            priority: int, HIGH, NORMAL or LOW.
+
+        Returns:
+            concurrent.futures.Future resolving to the raw response bytes. If the engine
+            is not running the future has already failed with a RuntimeError.
+        """
+        request = _Request(bytes(packet), kind, Future())
+        with self._lock:
+            if self._running:
+                self._queues[priority].append(request)
+                self._ready.notify()
+                return request.future
+        request.future.set_exception(RuntimeError('Command engine is not running'))
+        return request.future
+
+    def query(self, packet, priority=NORMAL):
+        """Submits a command answered with a text line."""
+        return self.submit(packet, 'line', priority)
+
+    def command(self, packet, priority=NORMAL):
+        """Submits a command answered with ACK/NAK."""
+        return self.submit(packet, 'ack', priority)
+
+    def _next(self):
+        # Called with the lock held: the next request the port can take, or None
+        if len(self._pending) >= self.max_in_flight:
+            return None
+        for queue in self._queues:
+            if queue and not (queue[0].kind == 'line' and self._lines):
+                return queue.popleft()
+        return None
+
+    def _send(self):
+        while True:
+            with self._lock:
+                request = self._next()
+                while request is None and self._running:
+                    self._ready.wait()
+                    request = self._next()
+                if not self._running:
+                    if request is not None:
+                        self._queues[0].appendleft(request)
+                    return
+                request.sent = time.monotonic()
+                self._pending.append(request)
+                if request.kind == 'line':
+                    self._lines += 1
+            try:
+                self.ser.write(request.packet)
+            except Exception as e:
+                with self._lock:
+                    if request in self._pending:
+                        self._pending.remove(request)
+                        self._release(request)
+                request.future.set_exception(e)
+                continue
+            self.sent += 1
+
+    def _release(self, request):
+        # Called with the lock held after a request left the pending queue
+        if request.kind == 'line':
+            self._lines -= 1
+        self._ready.notify()
+
+    def _dispatch(self, kind, frame, now):
+        self._last_rx = now
+        expected = 'line' if kind == 'line' else 'ack'
+        done = []
+        with self._lock:
+            if expected == 'ack':
+                # Readings in front of an ACK were dropped by the device
+                while self._pending and self._pending[0].kind == 'line':
+                    self.timeouts += 1
+                    done.append((self._pending.popleft(), b''))
+            if self._pending and self._pending[0].kind == expected:
+                done.append((self._pending.popleft(), frame))
+            else:
+                # Late reading for a request which already timed out
+                self.unsolicited += 1
+            for request, response in done:
+                self._release(request)
+        # Futures are resolved outside the lock so callbacks may submit new commands
+        for request, response in done:
+            request.future.set_result(response)
+            self._completed(request, now, response)
+
+    def _expire(self, now):
+        done = []
+        with self._lock:
+            while self._pending and now - max(self._pending[0].sent, self._last_rx) > self.timeout:
+                self.timeouts += 1
+                request = self._pending.popleft()
+                self._release(request)
+                done.append(request)
+        for request in done:
+            request.future.set_result(b'')
+            self._completed(request, now, b'')
+
+    def _completed(self, request, now, response):
+        if self.on_response is not None:
+            try:
+                self.on_response(request.packet, now - request.sent, response)
+            except Exception as e:
+                print(f'Response callback failed: {e}')
+
+    def _reader(self):
+        while self._running:
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except Exception as e:
+                print(f'Serial read error: {e}')
+                time.sleep(self.poll_interval)
+                data = b''
+            now = time.monotonic()
+            if data:
+                for kind, frame in self._parser.feed(data):
+                    self._dispatch(kind, frame, now)
+            self._expire(now)
@@ -1,10 +1,28 @@
 import serial
-import serial.tools.list_ports
 import numpy as np
+import threading
 import time
+from hv500_engine import CommandEngine, chain, HIGH, LOW
+from write_planner import WritePlanner
+from calibration_cache import CalibrationCache
 
-print('Available ports:')
-print([comport.device for comport in serial.tools.list_ports.comports()])
+#Returns the names of the serial ports available on this machine
+def list_ports():
+    import serial.tools.list_ports
+    return [comport.device for comport in serial.tools.list_ports.comports()]
+
+#Returns the command of a packet without the IDN and channel, e.g. 'U' for b'HV264 U00\r'
+def command_name(packet):
+    fields = packet.split(b' ', 2)
+    field = fields[1] if len(fields) > 1 else fields[0]
+    return field.strip().rstrip(b'0123456789').decode(errors='replace')
+
+# Commands that change a setpoint
+WRITE_COMMANDS = ('SET', 'CH', 'A')
+
+# ASCII codes of the hex digits and the shifts that split a 16 bit DAC value into 4 nibbles
+HEX_DIGITS = np.frombuffer(b'0123456789ABCDEF', dtype=np.uint8)
+NIBBLE_SHIFTS = np.array([12, 8, 4, 0], dtype=np.uint16)
 
 
 #Attempts to establish a serial connection to the specified port
@@ -26,17 +44,167 @@ class HV500Server():
         self.IDN = None
         self.spans = None
         self.offsets = None
+        self.engine = None
+        self.planner = None
+        self.max_in_flight = 8
+
+        # Preallocated result of the last 'U00' readback. readback_mask is True for
+        # channels that were missing, malformed or dropped by a serial overload.
+        self.readback = np.full(16, np.nan)
+        self.readback_mask = np.ones(16, dtype=bool)
+        self.readback_errors = 0
+
+        # IDN and calibration are taken from this cache on startup (if present) and
+        # revalidated against the device in the background. None disables the cache.
+        self.calibration_cache = CalibrationCache()
+        self.calibration_valid = None
+
+        # Reusable buffers of the bulk 'A' packet, allocated once the IDN is known
+        self._bulk_packet = None
+        self._bulk_digits = None
+        self._bulk_lock = threading.Lock()
+        self._dac_scratch = None
+        self._dac_coefficients = (None, None, None, None)
+
+        # Fast-update mode puts the display in 'DIS AUTO' and sends single channel
+        # updates with the legacy 'CH' command, as recommended by the manual where a
+        # faster response is required. normal_display is restored on close().
+        self.fast_mode = False
+        self.normal_display = 'ON'
+
+        # When True, set commands return as soon as they are written and their ACK is
+        # checked by the engine's reader thread. Failures are counted in ack_failures
+        # and passed to on_ack_failure(server, command) if it is set.
+        self.deferred_ack = False
+        self.ack_failures = 0
+        self.on_ack_failure = None
+        self._last_ack = None
+
+        # Optional metrics.Registry. Round trip times per command, writes, timeouts, ACK
+        # failures and overloaded readbacks are recorded with the labels in metrics_labels
+        self.metrics = None
+        self.metrics_labels = {}
+        self._metric = {}
 
     def initServer(self):
-        if self.port == None:
+        if self.port == None and self.ser == None:
             print('No port specified')
             print('Available ports:')
-            print([comport.device for comport in serial.tools.list_ports.comports()])
+            print(list_ports())
         else:
-            self.ser = establishConnection(self.port, self.baudrate)
-            self.get_ID()
-            print(f'IDN: {self.IDN}')
-            self.get_calibration(0)
+            # A transport may already be attached (e.g. the loopback of hv500_simulator)
+            if self.ser == None:
+                self.ser = establishConnection(self.port, self.baudrate)
+                if self.ser == None:
+                    raise ConnectionError(f'Could not open {self.port} at {self.baudrate} baud')
+            # The engine is only kept once its threads run, so a failed start leaves no
+            # half-built engine behind for later commands to queue on
+            engine = CommandEngine(self.ser, max_in_flight=self.max_in_flight)
+            engine.start()
+            self.engine = engine
+            if self.metrics is not None:
+                self.instrument()
+            self.planner = WritePlanner(self)
+            cached = None
+            if self.calibration_cache is not None:
+                cached = self.calibration_cache.lookup(self.port)
+            if cached is not None:
+                self.IDN = cached[0]
+                self.spans = np.array(cached[1])
+                self.offsets = np.array(cached[2])
+                print(f'IDN: {self.IDN} (cached)')
+                threading.Thread(target=self.revalidate_calibration, daemon=True).start()
+            else:
+                self.get_ID()
+                print(f'IDN: {self.IDN}')
+                self.get_calibration(0)
+                if self.calibration_cache is not None:
+                    self.calibration_cache.store(self.port, self.IDN, self.spans, self.offsets)
+            if self.fast_mode:
+                self.set_display('AUTO')
+                self.planner.single_commands = ('CH',)
+
+    def instrument(self):
+        """Looks up the metrics of this supply once and hooks them into the command engine."""
+        labels = dict(self.metrics_labels)
+        self._metric = {'timeouts': self.metrics.counter('hv500_timeouts_total', labels),
+                        'writes': self.metrics.counter('hv500_writes_total', labels),
+                        'ack_failures': self.metrics.counter('hv500_ack_failures_total', labels),
+                        'overloads': self.metrics.counter('hv500_overload_total', labels),
+                        'malformed': self.metrics.counter('hv500_malformed_readback_total', labels)}
+        self.metrics.gauge('hv500_queued', labels, fn=lambda: self.engine.queued if self.engine else 0)
+        self.metrics.gauge('hv500_in_flight', labels, fn=lambda: self.engine.in_flight if self.engine else 0)
+        self.engine.on_response = self._record_response
+
+    def _record_response(self, packet, seconds, response):
+        # Runs on the engine's reader thread for every completed command
+        command = command_name(packet)
+        if command in WRITE_COMMANDS:
+            self._metric['writes'].inc()
+        if not response:
+            self._metric['timeouts'].inc()
+            return
+        histogram = self._metric.get(command)
+        if histogram is None:
+            histogram = self._metric[command] = self.metrics.histogram('hv500_round_trip_seconds', dict(self.metrics_labels, command=command))
+        histogram.observe(seconds)
+
+    def _count(self, name):
+        if self.metrics is not None and name in self._metric:
+            self._metric[name].inc()
+
+    def revalidate_calibration(self):
+        """
+        Reads IDN and calibration from the device and compares them with the values in use.
+        On a mismatch a warning is printed and the device values are adopted and cached.
+
+        Returns:
+            bool, True if the values in use were correct.
+        """
+        try:
+            IDN = self.read_ID()
+            spans, offsets = self.read_calibration(0, IDN)
+        except Exception as e:
+            print(f'Warning: could not revalidate calibration of {self.port}: {e}')
+            return False
+        valid = IDN == self.IDN and spans.shape == self.spans.shape \
+            and np.allclose(spans, self.spans, rtol=0, atol=1e-6) and np.allclose(offsets, self.offsets, rtol=0, atol=1e-6)
+        if not valid:
+            print(f'Warning: cached calibration of {self.port} ({self.IDN}) does not match the device ({IDN}), using device values')
+            with self._bulk_lock:
+                self.IDN = IDN
+                self.spans = spans
+                self.offsets = offsets
+            self.planner.invalidate()
+            if self.calibration_cache is not None:
+                self.calibration_cache.store(self.port, IDN, spans, offsets)
+        self.calibration_valid = valid
+        return valid
+
+    def close(self):
+        """Restores the normal display mode and closes the connection."""
+        if self.engine is not None:
+            if self.fast_mode:
+                self.set_display(self.normal_display)
+            # A failed write must not keep the engine and port open
+            try:
+                self.wait_for_acks()
+            except Exception as e:
+                print(f'Error waiting for the last ACK: {e}')
+            self.engine.stop()
+            self.engine = None
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+    def set_display(self, mode):
+        """
+        Sets the display mode of the device.
+
+        Args:
+            mode: str, 'ON', 'OFF' or 'AUTO'.
+        """
+        self.complete(self.send_command(f'{self.IDN} DIS {mode}\r'))
 
     def channel_to_str(self, channel):
         _channel = str(channel)
@@ -50,26 +218,146 @@ class HV500Server():
         return f'{x:.6f}'
 
     def voltage_to_hex(self, v, ch):
+        if not abs(v) <= self.vmax:
+            raise ValueError("Voltage setpoint out of bounds.")
         x = v/(2*self.vmax)+0.5
         DAC = int(x*self.spans[ch]*62500 + self.offsets[ch]*65535)
-        return f'{DAC:0x}'.upper()
-    
+        return f'{min(max(DAC, 0), 0xFFFF):04X}'
+
+    def dac_coefficients(self):
+        """
+        Returns (gain, offset) such that DAC = voltage*gain + offset for every channel.
+        Recomputed only when the calibration arrays are replaced.
+        """
+        if self._dac_coefficients[0] is not self.spans or self._dac_coefficients[1] is not self.offsets:
+            gain = self.spans*62500/(2*self.vmax)
+            offset = 0.5*self.spans*62500 + self.offsets*65535
+            self._dac_coefficients = (self.spans, self.offsets, gain, offset)
+        return self._dac_coefficients[2], self._dac_coefficients[3]
+
+    def voltages_to_hex_array(self, voltages, out=None):
+        """
+        Vectorized encoder for the bulk 'A' command.
+
+        Args:
+            voltages: array of floats, one frame of shape (16,) or a batch of frames of shape (n, 16).
+            out: optional uint8 array of shape voltages.shape + (4,) to write the ASCII hex into.
+
+        Returns:
+            uint8 array of shape voltages.shape + (4,) with 4 upper case hex digits per channel.
+
+        Raises:
+            ValueError: if any voltage is NaN, infinite or beyond +/-vmax.
+        """
+        gain, offset = self.dac_coefficients()
+        voltages = np.asarray(voltages, dtype=float)
+        if voltages.ndim == 1 and voltages.shape == gain.shape:
+            # Single frame: everything happens in preallocated scratch arrays
+            if self._dac_scratch is None or self._dac_scratch[0].shape != gain.shape:
+                self._dac_scratch = (np.empty(gain.shape), np.empty(gain.shape, dtype=np.uint16),
+                                     np.empty(gain.shape + (4,), dtype=np.uint16))
+            x, DAC, nibbles = self._dac_scratch
+            # NaN compares False, so it is rejected along with out of range values
+            np.abs(voltages, out=x)
+            if not x.max() <= self.vmax:
+                raise ValueError("Voltage setpoint out of bounds.")
+            np.multiply(voltages, gain, out=x)
+            x += offset
+        else:
+            if voltages.size and not np.abs(voltages).max() <= self.vmax:
+                raise ValueError("Voltage setpoint out of bounds.")
+            x = voltages*gain + offset
+            DAC = np.empty(x.shape, dtype=np.uint16)
+            nibbles = np.empty(x.shape + (4,), dtype=np.uint16)
+        # Clipping keeps every channel at exactly 4 digits so the packet can never misframe
+        np.clip(x, 0, 0xFFFF, out=x)
+        np.copyto(DAC, x, casting='unsafe')
+        np.right_shift(DAC[..., None], NIBBLE_SHIFTS, out=nibbles)
+        nibbles &= 0xF
+        if out is None:
+            out = np.empty(nibbles.shape, dtype=np.uint8)
+        np.take(HEX_DIGITS, nibbles, out=out)
+        return out
+
     def voltages_to_hex(self, voltages):
-        x = voltages/(2*self.vmax)+0.5
-        DAC = (x*self.spans*62500 + self.offsets*65535).astype(int)
-        DAC = np.array([f'{entry:0x}'.upper() for entry in DAC])
-        DAC = ''.join(DAC)
-        return DAC
+        return self.voltages_to_hex_array(voltages).tobytes().decode()
 
-    def get_ID(self):
+    def bulk_packet(self, voltages):
         """
-        Returns device identification number e.g. 'HV264 500 16 b'.
+        Builds the complete bulk 'A' packet in a reusable buffer.
+        The buffer is overwritten by the next call, so it must be written out first.
+
+        Returns:
+            bytearray, the packet including the trailing '\r'.
+
+        Raises:
+            ValueError: if any voltage is NaN, infinite or beyond +/-vmax. The buffer is
+                left unchanged.
+        """
+        prefix = f'{self.IDN} A '.encode()
+        n = len(self.spans)
+        if self._bulk_packet is None or not self._bulk_packet.startswith(prefix) or len(self._bulk_packet) != len(prefix) + 4*n + 1:
+            self._bulk_packet = bytearray(prefix + b'0'*4*n + b'\r')
+            self._bulk_digits = np.frombuffer(self._bulk_packet, dtype=np.uint8)[len(prefix):-1].reshape(n, 4)
+        self.voltages_to_hex_array(voltages, out=self._bulk_digits)
+        return self._bulk_packet
+
+    def bulk_packets(self, frames):
+        """
+        Encodes a batch of frames (e.g. a voltage ramp) into bulk 'A' packets in one pass.
+
+        Args:
+            frames: array of floats of shape (n, 16), voltages in volts.
+
+        Returns:
+            uint8 array of shape (n, packet length); row i is the complete packet of frame i.
+
+        Raises:
+            ValueError: if any voltage is NaN, infinite or beyond +/-vmax.
+        """
+        frames = np.asarray(frames, dtype=float)
+        if not np.all(np.abs(frames) <= self.vmax):
+            raise ValueError("Voltage setpoint out of bounds.")
+        prefix = np.frombuffer(f'{self.IDN} A '.encode(), dtype=np.uint8)
+        n_frames, n = frames.shape
+        packets = np.empty((n_frames, len(prefix) + 4*n + 1), dtype=np.uint8)
+        packets[:, :len(prefix)] = prefix
+        packets[:, -1] = ord('\r')
+        self.voltages_to_hex_array(frames, out=packets[:, len(prefix):-1].reshape(n_frames, n, 4))
+        return packets
+
+    def read_ID(self):
+        """
+        Reads device identification number e.g. 'HV264 500 16 b'.
         First string 'HV264' is the IDN necessary to address device.
+
+        Returns:
+            str, the IDN.
         """
-        self.ser.write(b'IDN\r')
-        response = self.ser.readline()
+        response = self.engine.query(b'IDN\r').result()
         print(response)
-        self.IDN = repr(response).split(' ')[0].split("'")[1]
+        return repr(response).split(' ')[0].split("'")[1]
+
+    def get_ID(self):
+        self.IDN = self.read_ID()
+
+    def parse_voltage(self, response):
+        response = response.decode().split('V')[0]
+
+        # exception to catch serial overload
+        if response != '':
+            return float(response)
+        else:
+            self._count('overloads')
+            return 99999 # will not update client
+
+    def get_voltage_async(self, channel):
+        """
+        Same as get_voltage, but returns a future instead of waiting for the reading.
+        """
+        ch_str = self.channel_to_str(channel)
+        packet = f'{self.IDN} U{ch_str}\r'
+        return chain(self.engine.query(packet.encode(), LOW), self.parse_voltage)
 
     def get_voltage(self, channel):
         """
@@ -81,16 +369,77 @@ class HV500Server():
         Returns:
             float, voltage in volts.
         """
-        ch_str = self.channel_to_str(channel)
-        packet = f'{self.IDN} U{ch_str}\r'
-        self.ser.write(packet.encode())
-        response = self.ser.readline().decode().split('V')[0]
+        return self.get_voltage_async(channel).result()
 
-        # exception to catch serial overload
-        if response != '':
-            return float(response)
+    def send_command(self, packet):
+        """
+        Writes a command answered with ACK/NAK.
+
+        Returns:
+            future resolving to True if the device acknowledged the command.
+        """
+        if isinstance(packet, str):
+            packet = packet.encode()
+        # Copy, as the packet may live in a reusable buffer
+        command = bytes(packet)
+
+        def check(response):
+            accepted = response == b'\x06\r'
+            if not accepted:
+                self._ack_failed(command.decode().strip())
+            return accepted
+
+        # Setpoint writes are sent ahead of queued readbacks
+        future = chain(self.engine.command(packet, HIGH), check)
+        self._last_ack = future
+        return future
+
+    def _ack_failed(self, command):
+        self.ack_failures += 1
+        self._count('ack_failures')
+        if self.on_ack_failure is not None:
+            self.on_ack_failure(self, command)
         else:
-            return 99999 # will not update client
+            print('Command not accepted')
+
+    def complete(self, future):
+        """
+        Waits for the ACK of a set command, unless ACKs are verified in the background.
+
+        A NAK or a missing answer does not raise: the future resolves to False and the
+        rejection is counted in ack_failures (and passed to on_ack_failure). Only an
+        error of the write itself (e.g. the port failed) raises, in synchronous mode and
+        in deferred mode once the future has resolved.
+
+        Returns:
+            bool, True if the command was acknowledged, False if it was rejected; None
+            in deferred mode while the ACK is still outstanding.
+        """
+        if not self.deferred_ack or future.done():
+            return future.result()
+
+    def wait_for_acks(self, timeout=None):
+        """
+        Waits until every command sent so far has been acknowledged (or timed out).
+        The device answers in order, so it is enough to wait for the last one.
+
+        Returns:
+            int, total number of rejected commands.
+        """
+        if self._last_ack is not None:
+            self._last_ack.result(timeout)
+        return self.ack_failures
+
+    def set_voltage_legacy_async(self, channel, voltage):
+        """
+        Same as set_voltage_legacy, but returns a future resolving to True if the command was accepted.
+        """
+        if not abs(voltage) <= self.vmax:
+            raise ValueError("Voltage setpoint out of bounds.")
+        ch_str = self.channel_to_str(channel)
+        volt_str = self.voltage_to_kw(voltage)
+        packet = f'{self.IDN} CH{ch_str} {volt_str}\r'
+        return self.send_command(packet)
 
     def set_voltage_legacy(self, channel, voltage):
         """
@@ -102,34 +451,50 @@ class HV500Server():
             channel: int, channel between 1 and 16.
             voltage: float, voltage in volts.
         """
-        if voltage > self.vmax or voltage < -self.vmax:
+        self.complete(self.set_voltage_legacy_async(channel, voltage))
+
+    def set_voltage_async(self, channel, voltage):
+        """
+        Same as set_voltage, but returns a future resolving to True if the command was accepted.
+        """
+        if self.fast_mode:
+            return self.set_voltage_legacy_async(channel, voltage)
+        if not abs(voltage) <= self.vmax:
             raise ValueError("Voltage setpoint out of bounds.")
-        else:
-            ch_str = self.channel_to_str(channel)
-            volt_str = self.voltage_to_kw(voltage)
-            packet = f'{self.IDN} CH{ch_str} {volt_str}\r'
-            self.ser.write(packet.encode())
-            if self.ser.read(2) != b'\x06\r':
-                print('Command not accepted')
-    
+        ch_str = self.channel_to_str(channel)
+        packet = f'{self.IDN} SET{ch_str} {voltage}\r'
+        return self.send_command(packet)
+
     def set_voltage(self, channel, voltage):
         """
-        Sets voltage on the specified channel.
+        Sets voltage on the specified channel. Uses the legacy 'CH' command in fast-update mode.
 
         Args:
             channel: int, channel between 1 and 16.
             voltage: float, voltage in volts.
         """
-        if voltage > self.vmax or voltage < -self.vmax:
-            raise ValueError("Voltage setpoint out of bounds.")
-        else:
-            ch_str = self.channel_to_str(channel)
-            packet = f'{self.IDN} SET{ch_str} {voltage}\r'
-            self.ser.write(packet.encode())
+        self.complete(self.set_voltage_async(channel, voltage))
 
-            # Commented out this check because it costs 1 second to read back the 'ACK'
-            if self.ser.read(2) != b'\x06\r':
-                print('Command not accepted')
+    def read_calibration(self, channel, IDN=None):
+        """
+        Reads calibration on the specified channel as "span +/-offset".
+
+        Args:
+            channel: int, channel between 1 and 16, or 0 for all channels.
+            IDN: str, device to address. Defaults to self.IDN.
+
+        Returns:
+            (spans, offsets), arrays of floats.
+        """
+        ch_str = self.channel_to_str(channel)
+        packet = f'{IDN or self.IDN} RCORR{ch_str}\r'
+        response = self.engine.query(packet.encode()).result().decode().split(',')
+        spans = []
+        offsets = []
+        for entry in response:
+            spans.append(float(entry.split(' ')[0]))
+            offsets.append(float(entry.split(' ')[1]))
+        return np.array(spans), np.array(offsets)
 
     def get_calibration(self, channel):
         """
@@ -138,17 +503,18 @@ class HV500Server():
         Args:
             channel: int, channel between 1 and 16.
         """
-        ch_str = self.channel_to_str(channel)
-        packet = f'{self.IDN} RCORR{ch_str}\r'
-        self.ser.write(packet.encode())
-        response = self.ser.readline().decode().split(',')
-        self.spans = []
-        self.offsets = []
-        for entry in response:
-            self.spans.append(float(entry.split(' ')[0]))
-            self.offsets.append(float(entry.split(' ')[1]))
-        self.spans = np.array(self.spans)
-        self.offsets = np.array(self.offsets)
+        self.spans, self.offsets = self.read_calibration(channel)
+
+    def set_all_voltages_async(self, voltages):
+        """
+        Same as set_all_voltages, but returns a future resolving to True if the command was accepted.
+        """
+        if not np.all(np.abs(voltages) <= self.vmax):
+            raise ValueError("Voltage setpoint out of bounds.")
+
+        # The packet buffer is shared, so it is held until the engine has written it
+        with self._bulk_lock:
+            return self.send_command(self.bulk_packet(voltages))
 
     def set_all_voltages(self,voltages):
         """
@@ -157,19 +523,33 @@ class HV500Server():
         Args:
             voltages: array of floats, voltages in volts.
         """
-        mask = np.abs(voltages) > self.vmax
-        if np.any(mask):
-            raise ValueError("Voltage setpoint out of bounds.")
-        else:
-            voltage_str = self.voltages_to_hex(voltages)
-        
-        packet = f'{self.IDN} A {voltage_str}\r'
+        self.complete(self.set_all_voltages_async(voltages))
 
-        self.ser.write(packet.encode())
+    def write_voltages_async(self, voltages):
+        """
+        Writes only the channels whose setpoint changed since the last write, using
+        whichever of the single-channel or bulk commands the planner finds cheaper.
 
-        # Commented out this check because it costs 1 second to read back the 'ACK'
-        if self.ser.read(2) != b'\x06\r':
-            print('Command not accepted')
+        Args:
+            voltages: array of floats, setpoints of all channels in volts.
+
+        Returns:
+            future resolving to True if every command was accepted.
+        """
+        return self.planner.apply(voltages)
+
+    def parse_all_voltages(self, reading):
+        voltages = reading.decode().split(",")
+        for i in range(0,len(voltages)):
+            voltages[i] = float(voltages[i].split("V")[0])
+        return voltages
+
+    def get_all_voltages_async(self):
+        """
+        Same as get_all_voltages, but returns a future instead of waiting for the reading.
+        """
+        packet = f'{self.IDN} U00\r'
+        return chain(self.engine.query(packet.encode(), LOW), self.parse_all_voltages)
 
     def get_all_voltages(self):
         """
@@ -178,16 +558,62 @@ class HV500Server():
         Returns:
             voltages: array of floats, voltages in volts.
         """
+        return self.get_all_voltages_async().result()
+
+    def parse_all_voltages_into(self, reading, out, mask):
+        """
+        Parses a 'U00' reading such as b'12.34V,-0.01V,...\r\n' straight from the received
+        bytes into preallocated arrays, without decoding it to str.
+
+        Args:
+            reading: bytes, raw response. Empty if the device did not answer.
+            out: array of floats, receives the voltage of each channel (NaN if invalid).
+            mask: array of bools, set True for every channel that could not be read.
+
+        Returns:
+            int, number of channels read successfully.
+        """
+        try:
+            # Fast path: NumPy converts the byte fields to floats in C
+            out[:] = reading.translate(None, b'V\r\n').split(b',')
+            mask[:] = False
+            return len(out)
+        except ValueError:
+            pass
+
+        # A field is missing or malformed, so the fields are parsed one at a time
+        self.readback_errors += 1
+        self._count('malformed' if reading else 'overloads')
+        out[:] = np.nan
+        mask[:] = True
+        valid = 0
+        for i, field in enumerate(reading.split(b',')[:len(out)]):
+            unit = field.find(b'V')
+            try:
+                if unit >= 0:
+                    out[i] = float(field[:unit])
+                    mask[i] = False
+                    valid += 1
+            except ValueError:
+                pass
+        return valid
+
+    def read_all_voltages_async(self):
+        """
+        Reads all voltages into self.readback and self.readback_mask.
+
+        Returns:
+            future resolving to the number of channels read successfully.
+        """
         packet = f'{self.IDN} U00\r'
-        self.ser.write(packet.encode())
-        reading = self.ser.readline()
-        voltages = reading.decode().split(",")
-        for i in range(0,len(voltages)):
-            voltages[i] = float(voltages[i].split("V")[0])
-        return voltages
+        return chain(self.engine.query(packet.encode(), LOW),
+                     lambda reading: self.parse_all_voltages_into(reading, self.readback, self.readback_mask))
 
 
 if __name__ == "__main__":
+    print('Available ports:')
+    print(list_ports())
+
     server1 = HV500Server()
     server1.port = "COM15"
     server1.initServer()
@@ -0,0 +1,414 @@
+#HV500 Simulator
+#
+#Function:  Software stand-in for the HV500-16 low noise voltage supply. It answers the
+#           same ASCII protocol that HV500Server speaks, either over a pseudo terminal
+#           (so the real driver can open it like a COM port) or over an in-process
+#           loopback transport. Link speed, processing time, readback noise and
+#           overload drops are configurable so the control loop can be benchmarked
+#           and regression-tested without the real supplies.
+
+
+import argparse
+import collections
+import os
+import random
+import select
+import threading
+import time
+
+ACK = b'\x06\r'
+NAK = b'\x15\r'
+
+
+class _Wire():
+    """
+    One direction of an emulated serial link.
+
+    Bytes written to the wire only become readable once they would have been clocked
+    out at the configured baud rate (10 bits per byte for 8N1 framing).
+    """
+
+    def __init__(self, baudrate):
+        self.byte_time = 10/baudrate if baudrate else 0
+        self.closed = False
+        self._chunks = collections.deque()
+        self._buffer = bytearray()
+        self._busy_until = 0
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        with self._cond:
+            start = max(time.monotonic(), self._busy_until)
+            self._busy_until = start + len(data)*self.byte_time
+            self._chunks.append((self._busy_until, bytes(data)))
+            self._cond.notify_all()
+        return len(data)
+
+    def _collect(self, now):
+        while self._chunks and self._chunks[0][0] <= now:
+            self._buffer += self._chunks.popleft()[1]
+
+    def in_waiting(self):
+        with self._cond:
+            self._collect(time.monotonic())
+            return len(self._buffer)
+
+    def clear(self):
+        with self._cond:
+            self._chunks.clear()
+            self._buffer.clear()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def read(self, size, timeout, terminator=None):
+        """
+        Reads like pyserial: returns as soon as `size` bytes (or the terminator) are
+        available, otherwise whatever arrived before the timeout expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._collect(now)
+                if terminator is not None:
+                    index = self._buffer.find(terminator)
+                    if index >= 0:
+                        n = index + len(terminator)
+                        if size is None or size < 0 or n <= size:
+                            break
+                if size is not None and size >= 0 and len(self._buffer) >= size:
+                    n = size
+                    break
+                if self.closed or (deadline is not None and now >= deadline):
+                    n = len(self._buffer) if size is None or size < 0 else min(size, len(self._buffer))
+                    break
+                wait = None if deadline is None else deadline - now
+                if self._chunks:
+                    ready = self._chunks[0][0] - now
+                    wait = ready if wait is None else min(wait, ready)
+                self._cond.wait(wait)
+            data = bytes(self._buffer[:n])
+            del self._buffer[:n]
+            return data
+
+
+class LoopbackSerial():
+    """
+    In-process replacement for serial.Serial that is wired to an HV500Simulator.
+    Implements the subset of the pyserial API used by HV500Server.
+    """
+
+    def __init__(self, simulator, timeout=1):
+        self.simulator = simulator
+        self.port = 'loop://' + simulator.IDN
+        self.baudrate = simulator.baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self._tx = _Wire(simulator.baudrate)
+        self._rx = _Wire(simulator.baudrate)
+        self._device = threading.Thread(target=self._device_loop, daemon=True)
+        self._device.start()
+
+    def _device_loop(self):
+        while True:
+            line = self._tx.read(-1, None, b'\r')
+            if not line.endswith(b'\r'):
+                return
+            response = self.simulator.process(line)
+            if response:
+                self._rx.write(response)
+
+    @property
+    def in_waiting(self):
+        return self._rx.in_waiting()
+
+    def write(self, data):
+        if not self.is_open:
+            raise OSError('Loopback port is closed')
+        return self._tx.write(data)
+
+    def read(self, size=1):
+        return self._rx.read(size, self.timeout)
+
+    def readline(self, size=-1):
+        return self._rx.read(size, self.timeout, b'\n')
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self._rx.clear()
+
+    def close(self):
+        self.is_open = False
+        self._tx.close()
+        self._rx.close()
+
+
+class HV500Simulator():
+    """
+    Software model of the HV500-16.
+
+    Args:
+        IDN: str, device identification used to address commands.
+        vmax: float, output range is +/- vmax volts.
+        channels: int, number of output channels.
+        baudrate: int, emulated link speed. 0 disables wire-time emulation.
+        command_delay: float, processing time of the device for each command in seconds.
+        display_delay: float, extra time spent refreshing the display after a set command.
+            Skipped for the legacy 'CH' command while the display is in 'AUTO' mode.
+        noise: float, standard deviation of the readback noise in volts.
+        overload_rate: float, probability that a readback command gets no response at all.
+        slew_rate: float or None, output slew rate in V/s. None settles instantly.
+        seed: int or None, seed for the noise, overload and calibration generator.
+    """
+
+    def __init__(self, IDN='HV264', vmax=500, channels=16, baudrate=9600, command_delay=0.002,
+                 display_delay=0.0, noise=0.0, overload_rate=0.0, slew_rate=None, seed=None):
+        self.IDN = IDN
+        self.vmax = vmax
+        self.channels = channels
+        self.baudrate = baudrate
+        self.command_delay = command_delay
+        self.display_delay = display_delay
+        self.noise = noise
+        self.overload_rate = overload_rate
+        self.slew_rate = slew_rate
+        self.display = 'ON'
+        self.rng = random.Random(seed)
+        self.spans = [round(1 + self.rng.uniform(-0.002, 0.002), 6) for i in range(channels)]
+        self.offsets = [round(0.02 + self.rng.uniform(-0.001, 0.001), 6) for i in range(channels)]
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._targets = [0.0]*channels
+        self._starts = [0.0]*channels
+        self._t_set = [0.0]*channels
+        self._pty = None
+        self._running = False
+
+    # Output state
+    def output(self, channel, now=None):
+        """Returns the true (noise free) output voltage of a channel between 1 and 16."""
+        i = channel - 1
+        if self.slew_rate is None:
+            return self._targets[i]
+        if now is None:
+            now = time.monotonic()
+        step = self.slew_rate*(now - self._t_set[i])
+        delta = self._targets[i] - self._starts[i]
+        if abs(delta) <= step:
+            return self._targets[i]
+        return self._starts[i] + step*(1 if delta > 0 else -1)
+
+    def setpoints(self):
+        """Returns a copy of the currently programmed setpoints in volts."""
+        return list(self._targets)
+
+    def _program(self, channel, voltage):
+        now = time.monotonic()
+        self._starts[channel-1] = self.output(channel, now)
+        self._targets[channel-1] = voltage
+        self._t_set[channel-1] = now
+
+    def _readback(self, channel):
+        v = self.output(channel)
+        if self.noise:
+            v += self.rng.gauss(0, self.noise)
+        # the device digitizes readings to 10s of mV
+        return f'{round(v, 2):.2f}V'
+
+    def _dac_to_voltage(self, dac, channel):
+        x = (dac - self.offsets[channel-1]*65535)/(self.spans[channel-1]*62500)
+        return (x - 0.5)*2*self.vmax
+
+    # Protocol
+    def process(self, line):
+        """
+        Handles one command line (bytes, terminated by '\\r') and returns the response
+        bytes, or None when the device stays silent.
+        """
+        text = line.decode('ascii', 'replace').strip()
+        delay = self.command_delay
+        if self.display_delay and (' SET' in text or ' A ' in text or (' CH' in text and self.display != 'AUTO')):
+            delay += self.display_delay
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            if text == 'IDN':
+                self.counts['IDN'] += 1
+                return f'{self.IDN} {self.vmax} {self.channels} b\r\n'.encode()
+            address, _, command = text.partition(' ')
+            if address != self.IDN:
+                return None
+            try:
+                return self._dispatch(command)
+            except (ValueError, IndexError):
+                self.counts['NAK'] += 1
+                return NAK
+
+    def _channel(self, field, allow_all=False):
+        channel = int(field)
+        if channel == 0 and allow_all:
+            return 0
+        if channel < 1 or channel > self.channels:
+            raise ValueError(f'Channel {field} out of range')
+        return channel
+
+    def _dispatch(self, command):
+        if command.startswith('U'):
+            self.counts['U'] += 1
+            channel = self._channel(command[1:], allow_all=True)
+            if self.overload_rate and self.rng.random() < self.overload_rate:
+                self.counts['overload'] += 1
+                return None
+            if channel == 0:
+                readings = [self._readback(ch) for ch in range(1, self.channels+1)]
+                return (','.join(readings) + '\r\n').encode()
+            return (self._readback(channel) + '\r\n').encode()
+
+        elif command.startswith('SET'):
+            self.counts['SET'] += 1
+            ch_str, value = command[3:].split(' ')
+            channel = self._channel(ch_str)
+            voltage = float(value)
+            if abs(voltage) > self.vmax:
+                raise ValueError('Voltage setpoint out of bounds')
+            self._program(channel, voltage)
+            return ACK
+
+        elif command.startswith('CH'):
+            self.counts['CH'] += 1
+            ch_str, value = command[2:].split(' ')
+            channel = self._channel(ch_str)
+            x = float(value)
+            if x < 0 or x > 1:
+                raise ValueError('Voltage setpoint out of bounds')
+            self._program(channel, (x - 0.5)*2*self.vmax)
+            return ACK
+
+        elif command.startswith('A '):
+            self.counts['A'] += 1
+            data = command[2:]
+            if len(data) != 4*self.channels:
+                raise ValueError('Misframed bulk packet')
+            voltages = []
+            for i in range(self.channels):
+                voltage = self._dac_to_voltage(int(data[4*i:4*i+4], 16), i+1)
+                if abs(voltage) > self.vmax*1.001:
+                    raise ValueError('Voltage setpoint out of bounds')
+                voltages.append(voltage)
+            for i, voltage in enumerate(voltages):
+                self._program(i+1, voltage)
+            return ACK
+
+        elif command.startswith('RCORR'):
+            self.counts['RCORR'] += 1
+            channel = self._channel(command[5:], allow_all=True)
+            if channel == 0:
+                entries = [f'{s:.6f} {o:+.6f}' for s, o in zip(self.spans, self.offsets)]
+            else:
+                entries = [f'{self.spans[channel-1]:.6f} {self.offsets[channel-1]:+.6f}']
+            return (','.join(entries) + '\r\n').encode()
+
+        elif command.startswith('DIS '):
+            self.counts['DIS'] += 1
+            mode = command[4:]
+            if mode not in ('ON', 'OFF', 'AUTO'):
+                raise ValueError(f'Unknown display mode {mode}')
+            self.display = mode
+            return ACK
+
+        raise ValueError(f'Unknown command {command}')
+
+    # Transports
+    def loopback(self, timeout=1):
+        """Returns a serial-like object connected to this simulator."""
+        return LoopbackSerial(self, timeout)
+
+    def connect(self, server=None, timeout=1):
+        """
+        Attaches an HV500Server to this simulator through the loopback transport and
+        initializes it. A new server is created if none is given. The calibration cache
+        is disabled, since a simulated supply is not a physical device.
+        """
+        from hv500_server import HV500Server
+        if server is None:
+            server = HV500Server()
+        server.calibration_cache = None
+        server.baudrate = self.baudrate
+        server.ser = self.loopback(timeout)
+        server.port = server.ser.port
+        server.initServer()
+        return server
+
+    def serve_pty(self):
+        """
+        Serves the simulator on a pseudo terminal (POSIX only).
+
+        Returns:
+            str, device path that can be used as the port of an HV500Server.
+        """
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self._pty = (master, slave)
+        self._running = True
+        thread = threading.Thread(target=self._pty_loop, args=(master,), daemon=True)
+        thread.start()
+        return os.ttyname(slave)
+
+    def _pty_loop(self, master):
+        byte_time = 10/self.baudrate if self.baudrate else 0
+        buffer = bytearray()
+        while self._running:
+            ready, _, _ = select.select([master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                buffer += os.read(master, 1024)
+            except OSError:
+                return
+            while b'\r' in buffer:
+                index = buffer.index(b'\r') + 1
+                line = bytes(buffer[:index])
+                del buffer[:index]
+                # bytes arrive instantly on a pty, so the receive time is emulated here
+                time.sleep(len(line)*byte_time)
+                response = self.process(line)
+                if response:
+                    time.sleep(len(response)*byte_time)
+                    os.write(master, response)
+
+    def close(self):
+        self._running = False
+        if self._pty is not None:
+            for fd in self._pty:
+                os.close(fd)
+            self._pty = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serves a simulated HV500-16 on a pseudo terminal.')
+    parser.add_argument('--idn', default='HV264')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--delay', type=float, default=0.002, help='per-command processing delay in seconds')
+    parser.add_argument('--display-delay', type=float, default=0.0, help='display refresh time after a set command')
+    parser.add_argument('--noise', type=float, default=0.0, help='readback noise in volts (1 sigma)')
+    parser.add_argument('--overload', type=float, default=0.0, help='probability of a dropped readback')
+    parser.add_argument('--slew', type=float, default=None, help='output slew rate in V/s')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    simulator = HV500Simulator(IDN=args.idn, baudrate=args.baud, command_delay=args.delay,
+                               display_delay=args.display_delay, noise=args.noise,
+                               overload_rate=args.overload, slew_rate=args.slew, seed=args.seed)
+    port = simulator.serve_pty()
+    print(f'Simulated {args.idn} listening on {port}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.close()
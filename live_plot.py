@@ -0,0 +1,124 @@
+#Live Voltage Plot
+#
+#Function:  Strip chart of the set and actual voltages of selected electrodes over the
+#           last minutes, drawn with matplotlib in a Tk frame. Each redraw reduces the
+#           recorded samples in the ring buffer of the telemetry recorder to one bin per
+#           pixel of the plot (minimum and maximum of the actual voltage, mean of the
+#           setpoint), so its cost depends on the plot width and not on how long the
+#           session has run. Redraws run on the Tk thread at a capped frame rate and only
+#           when there are new samples; the ring buffer is read without locking, so the
+#           I/O threads are never held up by the plot.
+#
+#           matplotlib is imported when the first plot is created.
+
+
+import time
+
+import numpy as np
+
+
+class LivePlot():
+    """
+    Live plot of set and actual voltages.
+
+    Args:
+        parent: Tk widget the figure and its toolbar are packed into.
+        ring: TelemetryRing holding the recorded samples.
+        names: list of electrode names, in the column order of the ring.
+        window: float, seconds of history shown.
+        max_fps: float, highest redraw rate.
+    """
+
+    def __init__(self, parent, ring, names, window=60.0, max_fps=10.0):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+
+        self.parent = parent
+        self.ring = ring
+        self.names = list(names)
+        self.columns = {name: i for i, name in enumerate(self.names)}
+        self.window = window
+        self.interval_ms = int(1000/max_fps)
+        # Redraws are skipped while this returns False, e.g. while the tab is hidden
+        self.visible = lambda: True
+
+        self.fig = Figure(figsize=(12, 7), dpi=100)
+        self.ax = self.fig.add_subplot(111)
+        self.ax.set_xlabel('Time (s)')
+        self.ax.set_ylabel('Voltage (V)')
+        self.ax.grid(True, alpha=0.3)
+        self.canvas = FigureCanvasTkAgg(self.fig, master=parent)
+        self.toolbar = NavigationToolbar2Tk(self.canvas, parent, pack_toolbar=False)
+        self.toolbar.update()
+        self.toolbar.pack(side='bottom', fill='x')
+        self.canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
+
+        self.selected = []
+        self.lines = {}
+        self.drawn = None
+        self.frame_time = 0.0
+        self._after = None
+
+    def select(self, names):
+        """Shows the electrodes in names (unknown names are ignored)."""
+        for actual, setpoint in self.lines.values():
+            actual.remove()
+            setpoint.remove()
+        self.selected = [name for name in names if name in self.columns]
+        self.lines = {}
+        for k, name in enumerate(self.selected):
+            color = f'C{k % 10}'
+            actual, = self.ax.plot([], [], color=color, linewidth=1, label=name)
+            setpoint, = self.ax.plot([], [], color=color, linewidth=1, linestyle='--')
+            self.lines[name] = (actual, setpoint)
+        if self.selected:
+            self.ax.legend(loc='upper left', fontsize=8)
+        elif self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
+        self.drawn = None
+        self.canvas.draw_idle()
+
+    def start(self):
+        if self._after is None:
+            self._after = self.parent.after(0, self._tick)
+
+    def stop(self):
+        if self._after is not None:
+            self.parent.after_cancel(self._after)
+            self._after = None
+
+    def _tick(self):
+        t0 = time.perf_counter()
+        key = (self.ring.written, tuple(self.selected))
+        if key != self.drawn and self.visible():
+            self.redraw()
+            self.drawn = key
+        self.frame_time = time.perf_counter() - t0
+        # A redraw slower than the frame interval stretches the interval, so the plot
+        # never takes more than half of the Tk thread
+        elapsed_ms = int(self.frame_time*1e3)
+        self._after = self.parent.after(max(self.interval_ms - elapsed_ms, elapsed_ms, 1), self._tick)
+
+    def redraw(self):
+        """Reduces the newest window of samples to the plot width and redraws the lines."""
+        t1 = self.ring.last_time()
+        if t1 is None or not self.selected:
+            return
+        points = max(50, int(self.ax.bbox.width))
+        columns = [self.columns[name] for name in self.selected]
+        centres, low, high, _ = self.ring.decimate(columns, t1 - self.window, t1, points, 'actual')
+        _, _, _, setpoint = self.ring.decimate(columns, t1 - self.window, t1, points, 'set')
+        x = centres - t1
+        # Minimum and maximum of each bin drawn as a vertical stroke keep spikes visible
+        envelope_x = np.repeat(x, 2)
+        for k, name in enumerate(self.selected):
+            actual, setline = self.lines[name]
+            actual.set_data(envelope_x, np.column_stack((low[:, k], high[:, k])).ravel())
+            setline.set_data(x, setpoint[:, k])
+        self.ax.set_xlim(-self.window, 0)
+        bottom = np.nanmin([np.nanmin(low, initial=np.inf), np.nanmin(setpoint, initial=np.inf)])
+        top = np.nanmax([np.nanmax(high, initial=-np.inf), np.nanmax(setpoint, initial=-np.inf)])
+        if np.isfinite(bottom) and np.isfinite(top):
+            pad = max(0.05*(top - bottom), 0.5)
+            self.ax.set_ylim(bottom - pad, top + pad)
+        self.canvas.draw()
@@ -0,0 +1,294 @@
+#Metrics
+#
+#Function:  Counters, gauges and latency histograms for the serial links and control
+#           loops, collected in a registry that can be written to a snapshot file at a
+#           fixed interval and served as text on a local HTTP port. Histograms use fixed
+#           logarithmic buckets, so p50/p99 over a whole shift take constant memory and
+#           recording a value costs the same after one sample or ten million.
+
+
+import json
+import math
+import os
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.thorium_control', 'metrics.json')
+
+
+class Counter():
+    """A count that only goes up (commands sent, ACK failures, ...)."""
+
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+class Gauge():
+    """
+    A value that goes up and down. If fn is given the value is read from it whenever a
+    snapshot is taken, so nothing has to be updated on the hot path.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.fn is not None:
+            try:
+                self.value = self.fn()
+            except Exception:
+                self.value = None
+        return {'value': self.value}
+
+
+class Histogram():
+    """
+    Distribution of durations in seconds with logarithmic buckets.
+
+    Args:
+        low: float, upper edge of the first bucket; smaller values fall into it.
+        high: float, values above this fall into the last bucket.
+        per_decade: int, buckets per factor of 10. 20 gives percentiles within 12%.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, low=1e-5, high=100.0, per_decade=20):
+        self.low = math.log10(low)
+        self.per_decade = per_decade
+        self.size = int(math.ceil((math.log10(high) - self.low)*per_decade)) + 2
+        self.buckets = [0]*self.size
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = int(math.ceil((math.log10(value) - self.low)*self.per_decade)) if value > 0 else 0
+        i = min(max(i, 0), self.size - 1)
+        with self._lock:
+            self.buckets[i] += 1
+            self.count += 1
+            self.total += value
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def upper_edge(self, i):
+        return 10**(self.low + i/self.per_decade)
+
+    def percentile(self, q):
+        """
+        Returns the value below which a fraction q of the observations fall,
+        interpolated geometrically within its bucket.
+        """
+        with self._lock:
+            buckets = list(self.buckets)
+            count = self.count
+            lowest, highest = self.min, self.max
+        if not count:
+            return None
+        rank = q*count
+        seen = 0
+        for i, n in enumerate(buckets):
+            if n and seen + n >= rank:
+                lower, upper = self.upper_edge(i - 1), self.upper_edge(i)
+                # The last bucket holds everything above high, up to the largest value seen
+                if i == self.size - 1:
+                    upper = max(upper, highest)
+                value = lower*(upper/lower)**((rank - seen)/n)
+                return min(max(value, lowest), highest)
+            seen += n
+        return highest
+
+    @property
+    def mean(self):
+        return self.total/self.count if self.count else None
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'mean': self.mean,
+                'min': self.min if self.count else None,
+                'max': self.max if self.count else None,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99)}
+
+
+class Registry():
+    """
+    All metrics of the program, by name and labels.
+
+    Metrics are created on first use and the same object is returned on every later
+    call with the same name and labels, so callers can look them up once and keep them.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, labels, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(**kwargs)
+        if not isinstance(metric, cls):
+            raise TypeError(f'Metric {name} is a {metric.kind}, not a {cls.kind}')
+        return metric
+
+    def counter(self, name, labels=None):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, labels=None, fn=None):
+        gauge = self._get(Gauge, name, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, labels=None):
+        return self._get(Histogram, name, labels)
+
+    def snapshot(self):
+        """Returns a JSON-serializable dictionary of every metric."""
+        with self._lock:
+            items = sorted(self._metrics.items())
+        metrics = {}
+        for (name, labels), metric in items:
+            entry = dict(labels=dict(labels), type=metric.kind, **metric.snapshot())
+            metrics.setdefault(name, []).append(entry)
+        return {'time': time.time(), 'uptime': time.time() - self.started, 'metrics': metrics}
+
+    def text(self):
+        """Returns the metrics as text, one 'name{labels} value' line per value."""
+        lines = []
+        for name, entries in self.snapshot()['metrics'].items():
+            for entry in entries:
+                labels = ','.join(f'{key}="{value}"' for key, value in entry['labels'].items())
+                labels = f'{{{labels}}}' if labels else ''
+                if entry['type'] == 'histogram':
+                    for field in ('count', 'sum', 'min', 'p50', 'p90', 'p99', 'max'):
+                        if entry[field] is not None:
+                            lines.append(f'{name}_{field}{labels} {entry[field]:.6g}')
+                elif entry['value'] is not None:
+                    lines.append(f'{name}{labels} {entry["value"]:.6g}')
+        return '\n'.join(lines) + '\n'
+
+
+class SnapshotWriter():
+    """
+    Writes the metrics to a JSON file every interval seconds. The file is replaced
+    atomically, so a reader never sees a partial snapshot.
+
+    Args:
+        registry: Registry to write.
+        path: str, snapshot file.
+        interval: float, seconds between snapshots.
+    """
+
+    def __init__(self, registry, path=DEFAULT_PATH, interval=10.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name='metrics-snapshot')
+            self._thread.start()
+
+    def stop(self):
+        """Stops the writer after a last snapshot."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(self.registry.snapshot(), f, indent=1)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print(f'Could not write metrics to {self.path}: {e}')
+
+
+class MetricsServer():
+    """
+    Serves Registry.text() over HTTP (e.g. http://127.0.0.1:9105/metrics) and the JSON
+    snapshot at /metrics.json. Binds to the local machine only by default.
+
+    Args:
+        registry: Registry to serve.
+        port: int, TCP port; 0 picks a free one (see self.port after start()).
+        host: str, address to bind to.
+    """
+
+    def __init__(self, registry, port=9105, host='127.0.0.1'):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        import http.server
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics.json':
+                    body, kind = json.dumps(registry.snapshot()).encode(), 'application/json'
+                else:
+                    body, kind = registry.text().encode(), 'text/plain; charset=utf-8'
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name='metrics-http')
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._thread = None
@@ -0,0 +1,246 @@
+#Voltage Ramp Engine
+#
+#Function:  Moves any set of electrodes from their current setpoints to new targets along
+#           a linear, cosine or rate-limited profile. All frames of a ramp are computed
+#           and encoded into bulk 'A' packets up front, then streamed to the supplies on
+#           a fixed schedule at the fastest frame rate the serial links sustain. Frames
+#           whose deadline has passed are skipped so a late ramp catches up instead of
+#           stretching out, and every missed deadline is counted.
+
+
+import math
+import time
+from concurrent.futures import wait
+
+import numpy as np
+
+PROFILES = ('linear', 'cosine', 'rate')
+
+
+def ramp_frames(start, target, times, profile='linear', duration=None, rate=None):
+    """
+    Computes the electrode voltages of every frame of a ramp.
+
+    Args:
+        start: array of floats, voltages at t = 0.
+        target: array of floats, voltages at the end of the ramp.
+        times: array of floats, time of each frame in seconds.
+        profile: str, 'linear', 'cosine' (smooth start and stop) or 'rate' (every
+            electrode moves at rate volts per second until it reaches its target).
+        duration: float, length of the ramp in seconds ('linear' and 'cosine').
+        rate: float, slew rate in volts per second ('rate').
+
+    Returns:
+        array of shape (len(times), len(start)).
+    """
+    start = np.asarray(start, dtype=float)
+    delta = np.asarray(target, dtype=float) - start
+    times = np.asarray(times, dtype=float)[:, None]
+    if profile == 'rate':
+        step = np.minimum(rate*times, np.abs(delta))
+        return start + np.sign(delta)*step
+    fraction = np.clip(times/duration, 0, 1) if duration > 0 else np.ones_like(times)
+    if profile == 'cosine':
+        fraction = 0.5 - 0.5*np.cos(np.pi*fraction)
+    elif profile != 'linear':
+        raise ValueError(f'Unknown ramp profile {profile}, expected one of {PROFILES}')
+    return start + fraction*delta
+
+
+class Ramp():
+    """
+    A planned ramp: frame times and, for each supply involved, the encoded packets.
+
+    Attributes:
+        electrodes: array of the electrode ids being ramped.
+        target: array of their final voltages.
+        times: array of the frame times in seconds from the start of the ramp.
+        frames: array (frames, electrodes) of the ramped electrode voltages.
+        packets: dict of supply number -> uint8 array (frames, packet length).
+        final: dict of supply number -> channel vector of the last frame.
+    """
+
+    def __init__(self, electrodes, target, times, frames, packets, final):
+        self.electrodes = electrodes
+        self.target = target
+        self.times = times
+        self.frames = frames
+        self.packets = packets
+        self.final = final
+
+    @property
+    def duration(self):
+        return float(self.times[-1]) if len(self.times) else 0.0
+
+    def __repr__(self):
+        return f'Ramp({len(self.electrodes)} electrodes, {len(self.times)} frames, {self.duration:.3f} s, supplies {sorted(self.packets)})'
+
+
+class RampReport():
+    """Outcome of streaming a ramp to one supply."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.sent = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.max_lateness = 0.0
+        self.elapsed = 0.0
+        # True if the supply had not finished the ramp when the caller stopped waiting
+        self.timed_out = False
+
+    @property
+    def ok(self):
+        return self.rejected == 0 and not self.timed_out
+
+    def __repr__(self):
+        return (f'sent {self.sent}/{self.frames} frames, {self.skipped} skipped, {self.rejected} rejected, '
+                f'max lateness {self.max_lateness*1e3:.1f} ms, {self.elapsed:.3f} s'
+                + (' (timed out)' if self.timed_out else ''))
+
+
+class RampEngine():
+    """
+    Plans and runs ramps on the supplies of a SupplyPool.
+
+    Args:
+        pool: SupplyPool the ramps are streamed through.
+        state: ElectrodeState with the current setpoints; ramped electrodes are held at
+            their targets when the ramp ends.
+        margin: float, factor applied to the measured time of an 'A' command to get the
+            frame interval.
+        lead: float, seconds between starting a ramp and its first frame, so all supplies
+            start on the same schedule.
+    """
+
+    def __init__(self, pool, state, margin=1.1, lead=0.02):
+        self.pool = pool
+        self.state = state
+        self.margin = margin
+        self.lead = lead
+
+    def frame_interval(self, supplies):
+        """
+        Shortest interval between frames that every supply involved can sustain,
+        from the cost model of each supply's write planner.
+        """
+        return self.margin*max(self.pool.servers[supply].planner.costs.cost('A') for supply in supplies)
+
+    def plan(self, targets, duration=None, profile='linear', rate=None):
+        """
+        Computes and encodes all frames of a ramp from the current setpoints.
+
+        Args:
+            targets: dict of electrode name -> final voltage.
+            duration: float, seconds ('linear' and 'cosine'). For 'rate' it is the
+                shortest duration; the ramp lasts until the largest step is complete.
+            profile: str, one of PROFILES.
+            rate: float, volts per second, required for 'rate'.
+
+        Returns:
+            Ramp.
+        """
+        if profile not in PROFILES:
+            raise ValueError(f'Unknown ramp profile {profile}, expected one of {PROFILES}')
+        names = list(targets)
+        unwired = self.state.unwired(names)
+        if unwired:
+            raise ValueError(f'Cannot ramp electrodes without a supply channel: {unwired}')
+        electrodes = self.state.electrodes(names)
+        target = np.array([targets[name] for name in names], dtype=float)
+        with self.state.lock:
+            start = self.state.setpoint[electrodes]
+            # Unramped channels keep the setpoints of the same moment as the start
+            setpoints = {supply: self.state.scatter(supply, out=np.zeros(self.state.channels[supply]))
+                         for supply in self.state.supplies}
+
+        if profile == 'rate':
+            if not rate or rate <= 0:
+                raise ValueError('A rate-limited ramp needs a positive rate in volts per second')
+            duration = max(duration or 0.0, float(np.max(np.abs(target - start), initial=0.0))/rate)
+        elif duration is None or duration < 0:
+            raise ValueError('A ramp needs a duration in seconds')
+
+        supplies = [supply for supply in self.state.supplies
+                    if np.isin(electrodes, self.state.electrode_index[supply]).any()]
+        interval = self.frame_interval(supplies)
+        n = max(1, int(math.floor(duration/interval)))
+        times = np.linspace(duration/n, duration, n)
+        frames = ramp_frames(start, target, times, profile, duration, rate)
+        frames[-1] = target
+
+        # Electrode frames -> channel frames of each supply; unramped channels keep their setpoints
+        column = {electrode: i for i, electrode in enumerate(electrodes.tolist())}
+        packets = {}
+        final = {}
+        for supply in supplies:
+            ramped = np.isin(self.state.electrode_index[supply], electrodes)
+            channels = self.state.channel_index[supply][ramped]
+            columns = [column[electrode] for electrode in self.state.electrode_index[supply][ramped].tolist()]
+            channel_frames = np.repeat(setpoints[supply][None, :], n, axis=0)
+            channel_frames[:, channels] = frames[:, columns]
+            packets[supply] = self.pool.servers[supply].bulk_packets(channel_frames)
+            final[supply] = channel_frames[-1].copy()
+        return Ramp(electrodes, target, times, frames, packets, final)
+
+    def run(self, ramp):
+        """
+        Streams a planned ramp to its supplies and waits until it is complete. Routine
+        reads and writes of those supplies are paused meanwhile. When the ramp ends the
+        ramped electrodes are held at their targets.
+
+        Returns:
+            dict of supply number -> RampReport.
+        """
+        supplies = list(ramp.packets)
+        self.pool.busy.update(supplies)
+        try:
+            t0 = time.perf_counter() + self.lead
+            futures = {supply: self.pool.workers[supply].submit('ramp', lambda server, supply=supply:
+                                                                self._stream(server, ramp.packets[supply], ramp.times, t0))
+                       for supply in supplies}
+            # A supply that is still streaming long after the last frame counts as failed
+            done = self.pool.wait(futures, self.lead + ramp.duration + self.pool.timeout)
+            reports = {}
+            for supply in supplies:
+                if supply in done:
+                    reports[supply] = done[supply].result()
+                else:
+                    reports[supply] = RampReport(len(ramp.times))
+                    reports[supply].timed_out = True
+            for supply in supplies:
+                planner = self.pool.servers[supply].planner
+                if reports[supply].ok:
+                    planner.committed[:] = ramp.final[supply]
+                else:
+                    planner.invalidate()
+            self.state.hold(ramp.electrodes, ramp.target)
+        finally:
+            self.pool.busy.difference_update(supplies)
+        return reports
+
+    def ramp(self, targets, duration=None, profile='linear', rate=None):
+        """Plans and runs a ramp, see plan() and run()."""
+        return self.run(self.plan(targets, duration, profile, rate))
+
+    def _stream(self, server, packets, times, t0):
+        # Runs on the supply's worker thread
+        report = RampReport(len(times))
+        acks = []
+        k = 0
+        while k < len(times):
+            now = time.perf_counter() - t0
+            if now < times[k]:
+                time.sleep(times[k] - now)
+                continue
+            # Newest frame that is already due; older ones are skipped to stay on schedule
+            j = max(k, int(np.searchsorted(times, now, side='right')) - 1)
+            report.skipped += j - k
+            report.max_lateness = max(report.max_lateness, now - times[j])
+            acks.append(server.send_command(packets[j].tobytes()))
+            report.sent += 1
+            k = j + 1
+        wait(acks)
+        report.rejected = sum(1 for ack in acks if ack.exception() is not None or not ack.result())
+        report.elapsed = time.perf_counter() - t0
+        return report
@@ -0,0 +1,303 @@
+#Recipe Runner
+#
+#Function:  Runs loading, transfer and extraction cycles as recipes: timed lists of steps
+#           (set, ramp, wait_settle, hold) read from a JSON file or built in a script.
+#           Steps are scheduled against the monotonic clock from the start of each cycle,
+#           so delays do not accumulate, and the planned and actual time of every step is
+#           recorded to report the timing jitter of each step across cycles.
+
+
+import json
+import threading
+import time
+
+import numpy as np
+
+from ramp_engine import PROFILES
+
+STEP_TYPES = ('set', 'ramp', 'wait_settle', 'hold')
+
+
+class RecipeError(ValueError):
+    """Raised when a recipe is malformed or refers to unknown electrodes."""
+
+
+class Recipe():
+    """
+    A named list of steps, run repeat times. Each step is a dictionary with a 'type':
+
+        {"type": "set", "voltages": {"U_TL1_loading": 50, ...}}
+        {"type": "ramp", "voltages": {...}, "duration": 0.5, "profile": "cosine"}
+        {"type": "ramp", "voltages": {...}, "profile": "rate", "rate": 100}
+        {"type": "wait_settle", "electrodes": [...], "tolerance": 0.5, "timeout": 10}
+        {"type": "hold", "duration": 1.0}
+
+    A step starts when the previous one has finished, or at "at" seconds after the start
+    of the cycle if given. wait_settle defaults to the electrodes set so far in the cycle.
+    With "period" set, cycle k starts period*k seconds after the first one.
+
+    Args:
+        steps: list of step dictionaries.
+        name: str, name used in reports.
+        repeat: int, number of cycles.
+        period: float, optional cycle period in seconds.
+    """
+
+    def __init__(self, steps, name='recipe', repeat=1, period=None):
+        self.steps = [dict(step) for step in steps]
+        self.name = name
+        self.repeat = int(repeat)
+        self.period = period
+        for i, step in enumerate(self.steps):
+            self._check_step(i, step)
+
+    @staticmethod
+    def _check_step(i, step):
+        # Every parameter is checked here, so a bad recipe fails before any voltage is set
+        kind = step.get('type')
+        if kind not in STEP_TYPES:
+            raise RecipeError(f'Step {i}: unknown type {kind!r}, expected one of {STEP_TYPES}')
+
+        def number(key, required=False, positive=False):
+            if key not in step:
+                if required:
+                    raise RecipeError(f'Step {i}: {kind} needs "{key}"')
+                return
+            value = step[key]
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not np.isfinite(value) \
+                    or value < 0 or (positive and value == 0):
+                raise RecipeError(f'Step {i}: "{key}" must be a {"positive" if positive else "non-negative"} number, not {value!r}')
+
+        number('at')
+        if kind in ('set', 'ramp'):
+            if not step.get('voltages') or not isinstance(step['voltages'], dict):
+                raise RecipeError(f'Step {i}: {kind} needs "voltages"')
+            for name, voltage in step['voltages'].items():
+                if isinstance(voltage, bool) or not isinstance(voltage, (int, float)) or not np.isfinite(voltage):
+                    raise RecipeError(f'Step {i}: voltage of {name} must be a number, not {voltage!r}')
+        if kind == 'ramp':
+            profile = step.get('profile', 'linear')
+            if profile not in PROFILES:
+                raise RecipeError(f'Step {i}: unknown ramp profile {profile!r}, expected one of {PROFILES}')
+            if profile == 'rate':
+                number('rate', required=True, positive=True)
+                number('duration')
+            else:
+                number('duration', required=True)
+        elif kind == 'wait_settle':
+            number('tolerance', positive=True)
+            number('timeout')
+        elif kind == 'hold':
+            number('duration', required=True)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a recipe from a JSON file with "steps" and optional "name", "repeat" and "period"."""
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise RecipeError(f'Could not read recipe {path}: {e}')
+        if 'steps' not in data:
+            raise RecipeError(f'Recipe {path} has no "steps"')
+        return cls(data['steps'], data.get('name', path), data.get('repeat', 1), data.get('period'))
+
+    def electrodes(self):
+        """Returns the names of all electrodes the recipe refers to."""
+        names = []
+        for step in self.steps:
+            names += list(step.get('voltages', {})) + list(step.get('electrodes', []))
+        return list(dict.fromkeys(names))
+
+
+class RecipeReport():
+    """
+    Planned and actual times (seconds from the start of the run) of every step of every
+    cycle, in the arrays cycle, step, planned, start and end. ok is False for a step
+    that failed (a rejected write or a wait_settle that timed out).
+    """
+
+    def __init__(self, recipe):
+        self.recipe = recipe
+        self.cycle = []
+        self.step = []
+        self.planned = []
+        self.start = []
+        self.end = []
+        self.ok = []
+        self.aborted = False
+
+    def add(self, cycle, step, planned, start, end, ok):
+        self.cycle.append(cycle)
+        self.step.append(step)
+        self.planned.append(planned)
+        self.start.append(start)
+        self.end.append(end)
+        self.ok.append(ok)
+
+    def jitter(self):
+        """Returns an array of actual minus planned start time of every step run."""
+        return np.array(self.start) - np.array(self.planned)
+
+    def summary(self):
+        """Returns a text table of the start jitter and duration of each step across cycles."""
+        jitter = self.jitter()*1e3
+        durations = (np.array(self.end) - np.array(self.start))*1e3
+        steps = np.array(self.step)
+        lines = [f'{self.recipe.name}: {len(set(self.cycle))} cycles, {self.ok.count(False)} failed steps'
+                 + (' (aborted)' if self.aborted else '')]
+        lines.append(f'{"step":>4} {"type":<12} {"jitter mean":>12} {"std":>8} {"max":>8} {"duration mean":>14} {"std":>8}')
+        for i, step in enumerate(self.recipe.steps):
+            sel = steps == i
+            if not sel.any():
+                continue
+            lines.append(f'{i:>4} {step["type"]:<12} {jitter[sel].mean():>9.2f} ms {jitter[sel].std():>5.2f} ms '
+                         f'{np.abs(jitter[sel]).max():>5.2f} ms {durations[sel].mean():>11.2f} ms {durations[sel].std():>5.2f} ms')
+        if len(set(self.cycle)) > 1:
+            cycles = np.array(self.cycle)
+            lengths = np.array([max(np.array(self.end)[cycles == c]) - min(np.array(self.start)[cycles == c])
+                                for c in sorted(set(self.cycle))])*1e3
+            lines.append(f'cycle length mean {lengths.mean():.2f} ms std {lengths.std():.2f} ms')
+        return '\n'.join(lines)
+
+
+class RecipeRunner():
+    """
+    Runs recipes against the electrode state and supplies of the control interface.
+
+    Args:
+        pool: SupplyPool the setpoints are written through.
+        state: ElectrodeState; electrodes set by a recipe are held at their values.
+        ramps: RampEngine used for ramp steps.
+        on_change: optional callable run after every change of the setpoints, e.g. to
+            wake the data reader.
+        read: optional callable run before every check of the actual voltages while
+            waiting for settling, to read them into the state when no control loop does.
+        poll_interval: float, seconds between checks of the actual voltages while waiting
+            for settling.
+    """
+
+    def __init__(self, pool, state, ramps, on_change=None, read=None, poll_interval=0.05):
+        self.pool = pool
+        self.state = state
+        self.ramps = ramps
+        self.on_change = on_change
+        self.read = read
+        self.poll_interval = poll_interval
+        self.report = None
+        self._stop = threading.Event()
+        self._running = threading.Lock()
+
+    @property
+    def running(self):
+        return self._running.locked()
+
+    def stop(self):
+        """Aborts the running recipe after the current step."""
+        self._stop.set()
+
+    def check(self, recipe):
+        """Raises RecipeError if the recipe refers to electrodes that cannot be driven."""
+        unknown = self.state.unwired(recipe.electrodes())
+        if unknown:
+            raise RecipeError(f'{recipe.name}: unknown or unassigned electrodes {unknown}')
+
+    def run(self, recipe):
+        """
+        Runs all cycles of a recipe and blocks until it is done or stopped. If it is
+        stopped or fails, the electrodes it set are released back to the GUI.
+
+        Returns:
+            RecipeReport, also kept in self.report.
+        """
+        self.check(recipe)
+        if not self._running.acquire(blocking=False):
+            raise RuntimeError('A recipe is already running')
+        held = []
+        finished = False
+        try:
+            self._stop.clear()
+            self.report = report = RecipeReport(recipe)
+            t0 = time.monotonic()
+            cycle_start = 0.0
+            for cycle in range(recipe.repeat):
+                if recipe.period is not None:
+                    cycle_start = cycle*recipe.period
+                    self._sleep_until(t0 + cycle_start)
+                else:
+                    cycle_start = time.monotonic() - t0
+                planned = cycle_start
+                touched = []
+                for i, step in enumerate(recipe.steps):
+                    if self._stop.is_set():
+                        report.aborted = True
+                        return report
+                    if step['type'] in ('set', 'ramp'):
+                        held += list(step['voltages'])
+                    if 'at' in step:
+                        planned = cycle_start + step['at']
+                    self._sleep_until(t0 + planned)
+                    start = time.monotonic() - t0
+                    ok, planned_end = self._run_step(step, touched, t0, planned)
+                    end = time.monotonic() - t0
+                    report.add(cycle, i, planned, start, end, ok)
+                    # Steps of unknown length (wait_settle) re-anchor the schedule at their end
+                    planned = end if planned_end is None else planned_end
+            # A stop during the last step (e.g. a hold cut short) aborts the run as well
+            report.aborted = self._stop.is_set()
+            finished = not report.aborted
+            return report
+        finally:
+            if not finished and held:
+                self.state.release(self.state.electrodes(list(dict.fromkeys(held))))
+                self._changed()
+            self._running.release()
+
+    def _sleep_until(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            self._stop.wait(remaining)
+
+    def _run_step(self, step, touched, t0, planned):
+        # Returns (ok, planned end time or None if it depends on the hardware)
+        kind = step['type']
+        if kind == 'set':
+            names = list(step['voltages'])
+            touched += names
+            self.state.hold(self.state.electrodes(names), [step['voltages'][name] for name in names])
+            futures = self.pool.write(self.state)
+            done = self.pool.wait(futures)
+            self._changed()
+            return len(done) == len(futures) and all(f.exception() is None and f.result() for f in done.values()), planned
+        if kind == 'ramp':
+            touched += list(step['voltages'])
+            ramp = self.ramps.plan(step['voltages'], step.get('duration'), step.get('profile', 'linear'), step.get('rate'))
+            reports = self.ramps.run(ramp)
+            self._changed()
+            return all(report.ok for report in reports.values()), planned + self.ramps.lead + ramp.duration
+        if kind == 'wait_settle':
+            return self._wait_settle(step.get('electrodes', touched), step.get('tolerance', 0.5), step.get('timeout', 10.0)), None
+        self._sleep_until(t0 + planned + step['duration'])
+        return True, planned + step['duration']
+
+    def _wait_settle(self, names, tolerance, timeout):
+        # The actual voltages come from the readbacks of the control loop, or from read if
+        # there is none; reading the supplies here as well would race with the control loop
+        # for the shared readback buffers
+        electrodes = self.state.electrodes(list(dict.fromkeys(names)))
+        deadline = time.monotonic() + timeout
+        self._changed()
+        while not self._stop.is_set():
+            if self.read is not None:
+                self.read()
+            if np.all(np.abs(self.state.actual[electrodes] - self.state.setpoint[electrodes]) <= tolerance):
+                return True
+            if time.monotonic() >= deadline:
+                print(f'Recipe: electrodes did not settle within {timeout} s')
+                return False
+            self._stop.wait(self.poll_interval)
+        return False
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
@@ -1,11 +1,12 @@
 from Thorium_Control_Interface import *
 
-supply1_port = 'COM15'      # COM port for the HV500 power supply labeled "Supply 1" (previously labeled "Loading")
-supply2_port = 'COM16'      # COM port for the HV500 power supply labeled "Supply 2" (previously labeled "Bender")
+# The COM port of each HV500 power supply and the electrodes wired to it are set in hardware_map.json
+# Supply 1 was previously labeled "Loading", Supply 2 was previously labeled "Bender"
+hardware_map = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hardware_map.json')
 
 #Initializes the program
 if __name__ == '__main__':
-    instance = Thorium()
-    instance.connect(supply1_port, supply2_port)
+    instance = Thorium(hardware_map)
+    instance.connect()
     instance.makeGui()
     
\ No newline at end of file
@@ -0,0 +1,373 @@
+#HV500 Supply Pool
+#
+#Function:  Owns the HV500Server of every power supply in the hardware map, each with its
+#           own worker thread, and runs reads and writes on all supplies in parallel, so
+#           one pass over N supplies takes as long as the slowest supply rather than the
+#           sum of all of them. Keeps health and latency counters for every supply and
+#           stops waiting on a supply that keeps failing until it is due for a retry.
+
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, wait
+
+from hv500_server import HV500Server
+
+
+class TimingStats():
+    """Running timing statistics (in seconds) for one kind of operation."""
+
+    def __init__(self):
+        self.count = 0
+        self.last = 0
+        self.total = 0
+        self.min = float('inf')
+        self.max = 0
+
+    def add(self, dt):
+        self.count += 1
+        self.last = dt
+        self.total += dt
+        self.min = min(self.min, dt)
+        self.max = max(self.max, dt)
+
+    @property
+    def mean(self):
+        return self.total/self.count if self.count else 0
+
+    def __repr__(self):
+        return f'n={self.count} last={self.last*1e3:.1f} ms mean={self.mean*1e3:.1f} ms max={self.max*1e3:.1f} ms'
+
+
+class SupplyWorker():
+    """
+    Worker thread of one supply. Jobs run in order on the worker, so a supply that
+    blocks (waiting for a reply, a full command window or a slow connect) never holds
+    up the others.
+
+    A job is called with the HV500Server and may return a value or a future. It counts
+    as failed if it raises or its result is False or 0 (e.g. no channel read back).
+
+    Args:
+        number: int, supply number.
+        server: HV500Server of the supply.
+        label: str, name of the supply used in messages.
+        max_failures: int, consecutive failures after which the supply is unhealthy.
+        retry_interval: float, seconds between attempts while the supply is unhealthy.
+        metrics: optional metrics.Registry receiving the job times, failures and health.
+    """
+
+    def __init__(self, number, server, label=None, max_failures=3, retry_interval=5.0, metrics=None):
+        self.number = number
+        self.server = server
+        self.label = label or f'Supply {number}'
+        self.max_failures = max_failures
+        self.retry_interval = retry_interval
+        self.stats = {'connect': TimingStats(), 'get': TimingStats(), 'set': TimingStats()}
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_success = None
+        self.last_attempt = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._thread = None
+        # Futures of jobs counted as failed because the caller stopped waiting for them
+        self._expired = set()
+        self._job_times = {}
+        self._failures = None
+        if metrics is not None:
+            labels = {'supply': str(number)}
+            self._job_times = {kind: metrics.histogram('supply_job_seconds', dict(labels, kind=kind)) for kind in self.stats}
+            self._failures = metrics.counter('supply_failures_total', labels)
+            metrics.gauge('supply_healthy', labels, fn=lambda: int(self.healthy))
+
+    @property
+    def healthy(self):
+        return self.consecutive_failures < self.max_failures
+
+    def due(self):
+        """True if jobs should be sent: the supply is healthy or it is time to retry it."""
+        return self.healthy or self.last_attempt is None \
+            or time.monotonic() - self.last_attempt >= self.retry_interval
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name=f'supply-{self.number}')
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join(1.0)
+            self._thread = None
+
+    def disable(self, error):
+        """Marks the supply unhealthy (e.g. it could not be connected) until it is due for a retry."""
+        with self._lock:
+            self.consecutive_failures = max(self.consecutive_failures, self.max_failures)
+            self.last_error = error
+            self.last_attempt = time.monotonic()
+
+    def expire(self, future):
+        """
+        Counts a job that is still pending when its caller stops waiting for it as a
+        failure. If the job completes later, only a success is counted.
+        """
+        with self._lock:
+            if future.done() or future in self._expired:
+                return
+            self._expired.add(future)
+            self._fail('timed out')
+
+    def submit(self, kind, job):
+        """
+        Queues a job on the worker.
+
+        Args:
+            kind: str, 'connect', 'get' or 'set' selects the latency counter. Jobs of any
+                other kind (e.g. 'close') are not counted.
+            job: callable taking the HV500Server.
+
+        Returns:
+            future resolving to the job's result (the result of its future if it returns one).
+        """
+        future = Future()
+        self.last_attempt = time.monotonic()
+        self._jobs.put((kind, job, future, time.perf_counter()))
+        return future
+
+    def _run(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                return
+            kind, job, future, t0 = item
+            try:
+                result = job(self.server)
+            except Exception as e:
+                self._finish(kind, future, t0, exception=e)
+                continue
+            if isinstance(result, Future):
+                result.add_done_callback(lambda f, kind=kind, future=future, t0=t0: self._resolve(kind, future, t0, f))
+            else:
+                self._finish(kind, future, t0, result)
+
+    def _resolve(self, kind, future, t0, inner):
+        if inner.exception() is not None:
+            self._finish(kind, future, t0, exception=inner.exception())
+        else:
+            self._finish(kind, future, t0, inner.result())
+
+    def _finish(self, kind, future, t0, result=None, exception=None):
+        failed = exception is not None or (result is not None and not result)
+        if kind not in self.stats:
+            self._set_result(future, result, exception)
+            return
+        dt = time.perf_counter() - t0
+        if kind in self._job_times:
+            self._job_times[kind].observe(dt)
+        with self._lock:
+            expired = future in self._expired
+            self._expired.discard(future)
+            self.stats[kind].add(dt)
+            self.requests += 1
+            if failed:
+                if not expired:
+                    self._fail(f'{kind}: {exception!r}' if exception is not None else f'{kind}: {result!r}')
+            else:
+                if not self.healthy:
+                    print(f'{self.label} on {self.server.port} is responding again')
+                self.consecutive_failures = 0
+                self.last_success = time.monotonic()
+        self._set_result(future, result, exception)
+
+    def _fail(self, error):
+        # Called with the lock held
+        self.failures += 1
+        if self._failures is not None:
+            self._failures.inc()
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.consecutive_failures == self.max_failures:
+            print(f'Warning: {self.label} on {self.server.port} is not responding, retrying every {self.retry_interval} s')
+
+    def _set_result(self, future, result, exception):
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def health(self):
+        """Returns a dictionary with the health and latency counters of the supply."""
+        with self._lock:
+            return {'label': self.label,
+                    'port': self.server.port,
+                    'healthy': self.healthy,
+                    'requests': self.requests,
+                    'failures': self.failures,
+                    'consecutive_failures': self.consecutive_failures,
+                    'last_error': self.last_error,
+                    'latency': {kind: repr(stats) for kind, stats in self.stats.items()}}
+
+
+class SupplyPool():
+    """
+    All HV500 supplies of a hardware map, one worker each.
+
+    Args:
+        hardware_map: HardwareMap listing the supplies.
+        ports: optional dict of supply number -> port, overriding the ports in the map.
+        fast_mode: bool, selects the 'DIS AUTO' + 'CH' fast-update mode of the supplies.
+        metrics: optional metrics.Registry for the serial and worker metrics of every supply.
+        timeout: float, default longest wait in seconds for the reads and writes of a pass.
+    """
+
+    def __init__(self, hardware_map, ports=None, fast_mode=False, metrics=None, timeout=2.0):
+        ports = ports or {}
+        self.timeout = timeout
+        self.servers = {}
+        self.workers = {}
+        # Supplies taken over by a long job (e.g. a ramp); routine reads and writes skip them
+        self.busy = set()
+        for supply, config in sorted(hardware_map.supplies.items()):
+            server = HV500Server()
+            server.port = ports.get(supply, config['port'])
+            if 'baudrate' in config:
+                server.baudrate = config['baudrate']
+            server.fast_mode = fast_mode
+            server.metrics = metrics
+            server.metrics_labels = {'supply': str(supply)}
+            self.servers[supply] = server
+            self.workers[supply] = SupplyWorker(supply, server, config['label'], metrics=metrics)
+
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+
+    def run(self, kind, job, supplies=None):
+        """
+        Starts a job on every supply that is due.
+
+        Args:
+            kind: str, 'connect', 'get' or 'set'.
+            job: callable taking (supply number, HV500Server).
+            supplies: optional list of supply numbers, by default all supplies that are not busy.
+
+        Returns:
+            dict of supply number -> future of the job.
+        """
+        if supplies is None:
+            supplies = [supply for supply in self.workers if supply not in self.busy]
+        futures = {}
+        for supply in supplies:
+            worker = self.workers[supply]
+            if not worker.due():
+                continue
+            # A supply that could not be connected is connected again before its next job
+            if kind != 'connect' and self.servers[supply].engine is None:
+                worker.submit('connect', self._connect)
+            futures[supply] = worker.submit(kind, lambda server, supply=supply: self._call(kind, job, supply, server))
+        return futures
+
+    def _call(self, kind, job, supply, server):
+        # Runs on the worker
+        if kind != 'connect' and server.engine is None:
+            raise ConnectionError(f'{server.port} is not connected')
+        return job(supply, server)
+
+    def _connect(self, server):
+        # Runs on the worker; False (a failure) if the supply has no running command engine
+        server.initServer()
+        return server.engine is not None
+
+    def connect(self, timeout=30.0):
+        """
+        Initializes all supplies in parallel and waits until they are done, at most timeout
+        seconds. A supply that fails or is not done by then is marked unhealthy, so reads
+        and writes skip it until it is due for a retry, which connects it again.
+        """
+        self.start()
+        futures = self.run('connect', lambda supply, server: self._connect(server))
+        wait(futures.values(), timeout)
+        for supply, future in futures.items():
+            if future.done() and future.exception() is None and future.result():
+                continue
+            if not future.done():
+                error = f'connect: no answer within {timeout} s'
+            elif future.exception() is not None:
+                error = f'connect: {future.exception()!r}'
+            else:
+                error = 'connect: no command engine'
+            self.workers[supply].disable(error)
+            print(f'Error connecting to {self.workers[supply].label} on {self.servers[supply].port}')
+
+    def close(self, timeout=5.0):
+        """Closes every supply (restoring their display mode) and stops the workers."""
+        futures = [worker.submit('close', lambda server: server.close()) for worker in self.workers.values()]
+        wait(futures, timeout)
+        for supply, future in zip(self.workers, futures):
+            if not future.done() or future.exception() is not None:
+                print(f'Error disconnecting from {self.workers[supply].label}')
+        for worker in self.workers.values():
+            worker.stop()
+
+    def read(self, state, timeout=None):
+        """
+        Reads all voltages of every supply in parallel and gathers them into the
+        electrode state. Channels that no longer read back what was written are
+        rewritten on the next write; channels written while the reading was under way
+        are left alone.
+
+        Args:
+            state: ElectrodeState receiving the actual voltages.
+            timeout: float, longest time to wait for the slowest supply, self.timeout by
+                default. A supply that has not answered by then counts as failed.
+
+        Returns:
+            dict of supply number -> future resolving to the number of channels read.
+        """
+        requested = time.monotonic()
+        futures = self.run('get', lambda supply, server: server.read_all_voltages_async())
+        done = self.wait(futures, timeout)
+        for supply, future in done.items():
+            if future.exception() is None and future.result():
+                server = self.servers[supply]
+                state.gather(supply, server.readback, server.readback_mask)
+                server.planner.reconcile(server.readback, since=requested)
+        return futures
+
+    def write(self, state):
+        """
+        Writes the setpoints of the electrode state to every supply in parallel.
+        Only channels that changed are sent (see WritePlanner).
+
+        Returns:
+            dict of supply number -> future resolving to True if every command was acknowledged.
+            Pass it to wait() to block until the writes are done.
+        """
+        return self.run('set', lambda supply, server: server.write_voltages_async(state.scatter(supply)))
+
+    def wait(self, futures, timeout=None):
+        """
+        Waits for the jobs returned by run(), read() or write(), at most timeout seconds
+        (self.timeout by default). Jobs still pending then are counted as failures of
+        their supply, so a supply that stopped answering is skipped after max_failures.
+
+        Returns:
+            dict of supply number -> future of the jobs that are done.
+        """
+        wait(futures.values(), self.timeout if timeout is None else timeout)
+        done = {}
+        for supply, future in futures.items():
+            if future.done():
+                done[supply] = future
+            else:
+                self.workers[supply].expire(future)
+        return done
+
+    def health(self):
+        """Returns the health and latency counters of every supply."""
+        return {supply: worker.health() for supply, worker in self.workers.items()}
@@ -0,0 +1,373 @@
+#Telemetry Recorder
+#
+#Function:  Records the set and actual voltages of all electrodes on every readback.
+#           Samples go into a fixed-size in-memory ring buffer (no allocation per
+#           sample) and a background thread appends them to chunked, memory-mapped
+#           binary log files, rotating to a new file when one is full and deleting the
+#           oldest files beyond a limit. Each file starts with a header describing the
+#           electrode map, so a log can be read back without the program.
+#
+#           File layout: 8 byte magic, uint64 sample count, uint32 header length, the
+#           header as JSON padded to a multiple of HEADER_BLOCK bytes, then the samples
+#           as records of (t float64, set float32[n], actual float32[n]), little endian.
+
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b'THTELEM1'
+HEADER_BLOCK = 4096
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.thorium_control', 'telemetry')
+
+
+def sample_dtype(n):
+    """Record layout of one sample of n electrodes."""
+    return np.dtype([('t', '<f8'), ('set', '<f4', (n,)), ('actual', '<f4', (n,))])
+
+
+def header_size(length):
+    """Offset of the first sample in a file whose JSON header is length bytes long."""
+    return -(-(20 + length)//HEADER_BLOCK)*HEADER_BLOCK
+
+
+class BinReducer():
+    """
+    Minimum, maximum and mean of samples in equal time bins, accumulated over any number
+    of time-ordered blocks (e.g. log files or the two halves of a wrapped ring buffer).
+
+    Args:
+        t0, t1: float, start and end of the binned time range; t1 falls in the last bin.
+        points: int, number of bins.
+        columns: int, number of values per sample, or None for one value.
+    """
+
+    def __init__(self, t0, t1, points, columns=None):
+        self.edges = np.linspace(t0, t1, points + 1)
+        shape = (points,) if columns is None else (points, columns)
+        self.minimum = np.full(shape, np.nan)
+        self.maximum = np.full(shape, np.nan)
+        self.total = np.zeros(shape)
+        self.count = np.zeros(points)
+
+    def add(self, t, values, offset=0.0):
+        """
+        Adds a block of samples.
+
+        Args:
+            t: sorted array of sample times.
+            values: array (samples,) or (samples, columns).
+            offset: float, added to t to get the time scale of the bins.
+        """
+        bounds = np.searchsorted(t, self.edges - offset)
+        bounds[-1] = np.searchsorted(t, self.edges[-1] - offset, 'right')
+        sizes = np.diff(bounds)
+        filled = sizes > 0
+        if not filled.any():
+            return
+        # reduceat runs each bin up to the start of the next filled one, or the end of values
+        starts = bounds[:-1][filled]
+        values = values[:bounds[-1]]
+        self.minimum[filled] = np.fmin(self.minimum[filled], np.minimum.reduceat(values, starts, axis=0))
+        self.maximum[filled] = np.fmax(self.maximum[filled], np.maximum.reduceat(values, starts, axis=0))
+        self.total[filled] += np.add.reduceat(values, starts, axis=0, dtype=float)
+        self.count += sizes
+
+    def result(self):
+        """
+        Returns:
+            (bin centre times, minimum, maximum, mean); bins without samples are NaN.
+        """
+        count = self.count.reshape((-1,) + (1,)*(self.total.ndim - 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, self.total/count, np.nan)
+        return 0.5*(self.edges[:-1] + self.edges[1:]), self.minimum, self.maximum, mean
+
+
+class TelemetryRing():
+    """
+    Fixed-size ring buffer of the most recent samples.
+
+    Written by one thread (record) and read by others through the counter `written`:
+    sample k lives in row k % capacity until it is overwritten capacity samples later.
+
+    Args:
+        n: int, number of electrodes.
+        capacity: int, number of samples kept.
+    """
+
+    def __init__(self, n, capacity=65536):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=sample_dtype(n))
+        self.t = self.data['t']
+        self.set = self.data['set']
+        self.actual = self.data['actual']
+        self.written = 0
+
+    def record(self, setpoint, actual, t):
+        i = self.written % self.capacity
+        self.t[i] = t
+        self.set[i] = setpoint
+        self.actual[i] = actual
+        self.written += 1
+
+    def latest(self, count=None):
+        """
+        Returns a copy of the newest samples in time order (at most capacity).
+
+        Args:
+            count: int, number of samples, default all samples held.
+        """
+        written = self.written
+        count = min(written, self.capacity) if count is None else min(count, written, self.capacity)
+        start = written - count
+        rows = (np.arange(start, written) % self.capacity) if count else np.zeros(0, dtype=np.intp)
+        return self.data[rows]
+
+    def last_time(self):
+        """Returns the time of the newest sample, or None if there is none."""
+        return float(self.t[(self.written - 1) % self.capacity]) if self.written else None
+
+    def segments(self, margin=64):
+        """
+        Returns the slices of the buffer holding the samples in time order, oldest
+        first, without copying. The margin oldest rows are left out, since the writer
+        may overwrite them while they are read.
+        """
+        written = self.written
+        count = min(written, self.capacity - min(margin, self.capacity//2))
+        if count == 0:
+            return []
+        start = (written - count) % self.capacity
+        end = written % self.capacity
+        if start < end:
+            return [slice(start, end)]
+        return [slice(start, self.capacity), slice(0, end)]
+
+    def decimate(self, columns, t0, t1, points, field='actual'):
+        """
+        Reduces the samples between t0 and t1 of some electrodes to points time bins.
+        Only reads the rows in the time range; never blocks the writer.
+
+        Args:
+            columns: list of electrode indices.
+            t0, t1: float, time range (same clock as the recorded times).
+            points: int, number of bins.
+            field: str, 'set' or 'actual'.
+
+        Returns:
+            (bin centre times, minimum, maximum, mean), the last three of shape (points, len(columns)).
+        """
+        reducer = BinReducer(t0, t1, points, len(columns))
+        voltages = self.set if field == 'set' else self.actual
+        for rows in self.segments():
+            t = self.t[rows]
+            lo = int(np.searchsorted(t, t0))
+            hi = int(np.searchsorted(t, t1, 'right'))
+            if hi > lo:
+                reducer.add(t[lo:hi], voltages[rows][lo:hi, columns])
+        return reducer.result()
+
+
+class TelemetryLog():
+    """
+    Append-only log of samples in memory-mapped chunk files with rotation.
+
+    Args:
+        directory: str, folder of the log files.
+        header: dict, JSON-serializable description written at the start of every file.
+        n: int, number of electrodes.
+        chunk_samples: int, samples per file.
+        max_files: int, oldest files beyond this number are deleted (None keeps all).
+    """
+
+    def __init__(self, directory, header, n, chunk_samples=65536, max_files=48):
+        self.directory = directory
+        self.header = dict(header)
+        self.dtype = sample_dtype(n)
+        self.chunk_samples = chunk_samples
+        self.max_files = max_files
+        self.files = []
+        self.sequence = 0
+        self.path = None
+        self._records = None
+        self._count = None
+        self.position = 0
+
+    def _open_chunk(self):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        self.path = os.path.join(self.directory, f'telemetry_{stamp}_{self.sequence:04d}.bin')
+        self.sequence += 1
+        header = dict(self.header, created=time.time(), created_monotonic=time.monotonic(),
+                      dtype=self.dtype.descr, chunk_samples=self.chunk_samples)
+        text = json.dumps(header).encode()
+        offset = header_size(len(text))
+        with open(self.path, 'wb') as f:
+            f.write(MAGIC + np.uint64(0).tobytes() + np.uint32(len(text)).tobytes() + text)
+            f.truncate(offset + self.chunk_samples*self.dtype.itemsize)
+        self._count = np.memmap(self.path, dtype='<u8', mode='r+', offset=len(MAGIC), shape=(1,))
+        self._records = np.memmap(self.path, dtype=self.dtype, mode='r+', offset=offset, shape=(self.chunk_samples,))
+        self.position = 0
+        self.files.append(self.path)
+        self._rotate()
+
+    def _rotate(self):
+        while self.max_files is not None and len(self.files) > self.max_files:
+            oldest = self.files.pop(0)
+            try:
+                os.remove(oldest)
+            except OSError:
+                print(f'Could not delete old telemetry file {oldest}')
+
+    def _close_chunk(self):
+        if self._records is not None:
+            self._records.flush()
+            self._count.flush()
+            self._records = None
+            self._count = None
+
+    def append(self, samples):
+        """Appends an array of samples, opening new files as they fill up."""
+        done = 0
+        while done < len(samples):
+            if self._records is None or self.position == self.chunk_samples:
+                self._close_chunk()
+                self._open_chunk()
+            n = min(len(samples) - done, self.chunk_samples - self.position)
+            self._records[self.position:self.position + n] = samples[done:done + n]
+            self.position += n
+            done += n
+            # Count is updated after the records so a reader never sees unwritten samples
+            self._count[0] = self.position
+
+    def flush(self):
+        if self._records is not None:
+            self._records.flush()
+            self._count.flush()
+
+    def close(self):
+        self._close_chunk()
+
+
+def read_header(path):
+    """
+    Reads the header of a telemetry file.
+
+    Returns:
+        (header dict, number of samples written, sample dtype, offset of the first sample)
+    """
+    with open(path, 'rb') as f:
+        start = f.read(20)
+        if start[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a telemetry file')
+        count = int(np.frombuffer(start[8:16], dtype='<u8')[0])
+        length = int(np.frombuffer(start[16:20], dtype='<u4')[0])
+        header = json.loads(f.read(length))
+    dtype = np.dtype([(name, kind) if len(rest) == 0 else (name, kind, tuple(rest[0]))
+                      for name, kind, *rest in header['dtype']])
+    return header, count, dtype, header_size(length)
+
+
+def read_count(path):
+    """Returns the number of samples written so far to a telemetry file."""
+    with open(path, 'rb') as f:
+        f.seek(len(MAGIC))
+        return int(np.frombuffer(f.read(8), dtype='<u8')[0])
+
+
+def read_log(path):
+    """
+    Opens a telemetry file read-only.
+
+    Returns:
+        (header dict, memory-mapped array of the samples written so far)
+    """
+    header, count, dtype, offset = read_header(path)
+    if count == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+class TelemetryRecorder():
+    """
+    Ring buffer plus background flusher into a TelemetryLog.
+
+    Args:
+        names: list of electrode names, in the order of the state arrays.
+        locations: dict of electrode name -> (supply, channel) or None.
+        supplies: optional dict of supply number -> settings (port, label, ...) for the header.
+        directory: str, folder of the log files; None keeps the history in memory only.
+        capacity: int, samples kept in memory. Must hold at least flush_interval
+            seconds of samples, otherwise the oldest unflushed samples are lost.
+        flush_interval: float, seconds between flushes to the log.
+        chunk_samples: int, samples per log file.
+        max_files: int, number of log files kept.
+    """
+
+    def __init__(self, names, locations, supplies=None, directory=DEFAULT_DIRECTORY, capacity=65536,
+                 flush_interval=1.0, chunk_samples=65536, max_files=48):
+        self.names = list(names)
+        self.ring = TelemetryRing(len(self.names), capacity)
+        self.flush_interval = flush_interval
+        self.log = None
+        if directory is not None:
+            header = {'electrodes': self.names,
+                      'locations': {name: locations.get(name) for name in self.names},
+                      'supplies': {str(number): supply for number, supply in (supplies or {}).items()},
+                      'clock': 'time.monotonic'}
+            self.log = TelemetryLog(directory, header, len(self.names), chunk_samples, max_files)
+        self.flushed = 0
+        self.dropped = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._flush_lock = threading.Lock()
+
+    def record(self, setpoint, actual, t=None):
+        """Adds a sample; t defaults to time.monotonic()."""
+        self.ring.record(setpoint, actual, time.monotonic() if t is None else t)
+
+    def start(self):
+        if self.log is not None and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name='telemetry')
+            self._thread.start()
+
+    def stop(self):
+        """Stops the flusher after writing all samples recorded so far."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self.log is not None:
+            self.flush()
+            self.log.close()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'Telemetry flush failed: {e}')
+
+    def flush(self):
+        """Appends the samples recorded since the last flush to the log."""
+        with self._flush_lock:
+            written = self.ring.written
+            capacity = self.ring.capacity
+            if written - self.flushed > capacity:
+                # The ring wrapped before these samples were flushed
+                self.dropped += written - self.flushed - capacity
+                self.flushed = written - capacity
+            start = self.flushed % capacity
+            end = start + (written - self.flushed)
+            if end <= capacity:
+                self.log.append(self.ring.data[start:end])
+            else:
+                self.log.append(self.ring.data[start:])
+                self.log.append(self.ring.data[:end - capacity])
+            self.flushed = written
+            self.log.flush()
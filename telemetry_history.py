@@ -0,0 +1,231 @@
+#Telemetry History
+#
+#Function:  Looks up recorded telemetry by time without loading whole log files. Each log
+#           file keeps a sparse index of every stride-th timestamp, so the samples between
+#           two times are found by bisection, reading only a few pages of the file, and
+#           returned as memory-mapped slices (no copy). Long windows can be reduced to a
+#           given number of points with the minimum, maximum and mean of each bin.
+#
+#           Times are wall-clock seconds (time.time()); each file's header relates its
+#           monotonic timestamps to the wall clock.
+
+
+import bisect
+import glob
+import os
+
+import numpy as np
+
+from telemetry import DEFAULT_DIRECTORY, BinReducer, read_count, read_header
+
+FIELDS = ('set', 'actual')
+
+
+class HistoryChunk():
+    """
+    One telemetry file and its sparse time index. The file is only memory-mapped while
+    a query uses it, so the recorder can still delete it when it rotates.
+
+    Args:
+        path: str, telemetry file.
+        stride: int, rows between entries of the sparse index.
+    """
+
+    def __init__(self, path, stride=256):
+        self.path = path
+        self.stride = stride
+        self.header, count, self.dtype, self.offset = read_header(path)
+        # Wall-clock time = monotonic timestamp + clock_offset
+        self.clock_offset = self.header['created'] - self.header['created_monotonic']
+        self.columns = {name: i for i, name in enumerate(self.header['electrodes'])}
+        self.capacity = self.header['chunk_samples']
+        self.count = 0
+        self.index = np.zeros(0)
+        self.last = None
+        self._extend(count)
+
+    @property
+    def first(self):
+        return self.index[0] + self.clock_offset if self.count else None
+
+    @property
+    def complete(self):
+        return self.count == self.capacity
+
+    def records(self):
+        """Returns the samples written so far, memory-mapped read-only."""
+        if self.count == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.offset, shape=(self.count,))
+
+    def update(self):
+        """Picks up samples appended since the last call; returns True if there were any."""
+        if self.complete:
+            return False
+        count = read_count(self.path)
+        if count == self.count:
+            return False
+        self._extend(count)
+        return True
+
+    def _extend(self, count):
+        self.count = count
+        if count == 0:
+            return
+        t = self.records()['t']
+        self.index = np.concatenate([self.index, t[len(self.index)*self.stride::self.stride]])
+        self.last = float(t[-1]) + self.clock_offset
+
+    def find(self, t, records, side='left'):
+        """
+        Returns the first row whose time is >= t ('left') or > t ('right'). Only the
+        rows between two entries of the sparse index are read.
+        """
+        t -= self.clock_offset
+        k = int(np.searchsorted(self.index, t, side))
+        lo = max(k - 1, 0)*self.stride
+        hi = min(k*self.stride + 1, self.count)
+        return lo + int(np.searchsorted(records['t'][lo:hi], t, side))
+
+
+class HistorySlice():
+    """
+    Samples of one telemetry file within a time window.
+
+    Attributes:
+        records: memory-mapped structured array with fields 't' (monotonic), 'set', 'actual'.
+        chunk: HistoryChunk the samples come from.
+    """
+
+    def __init__(self, records, chunk):
+        self.records = records
+        self.chunk = chunk
+
+    def __len__(self):
+        return len(self.records)
+
+    def times(self):
+        """Returns the wall-clock times of the samples."""
+        return self.records['t'] + self.chunk.clock_offset
+
+    def column(self, name, field='actual'):
+        """Returns a view of one electrode's set or actual voltages, or None if it was not recorded."""
+        if name not in self.chunk.columns:
+            return None
+        return self.records[field][:, self.chunk.columns[name]]
+
+
+class TelemetryHistory():
+    """
+    Time-indexed access to the telemetry files in a directory.
+
+    Args:
+        directory: str, folder of the log files written by TelemetryRecorder.
+        stride: int, rows between entries of the sparse time index of each file.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, stride=256):
+        self.directory = directory
+        self.stride = stride
+        self.chunks = []
+        self._paths = {}
+        self._unreadable = set()
+
+    def refresh(self):
+        """
+        Indexes new files, extends the index of files still being written and forgets
+        files that were deleted by rotation. Called by every query.
+        """
+        paths = sorted(glob.glob(os.path.join(self.directory, 'telemetry_*.bin')))
+        existing = set(paths)
+        for path in list(self._paths):
+            if path not in existing:
+                del self._paths[path]
+        for path in paths:
+            chunk = self._paths.get(path)
+            if chunk is None:
+                # A file is retried on the next refresh, it may have been caught while being created
+                try:
+                    self._paths[path] = HistoryChunk(path, self.stride)
+                except (OSError, ValueError, KeyError) as e:
+                    if path not in self._unreadable:
+                        print(f'Skipping telemetry file {path}: {e}')
+                        self._unreadable.add(path)
+            elif not chunk.complete:
+                chunk.update()
+        self.chunks = sorted((chunk for chunk in self._paths.values() if chunk.count),
+                             key=lambda chunk: chunk.first)
+
+    def span(self):
+        """Returns the wall-clock times (first, last) of the recorded samples, or None."""
+        self.refresh()
+        if not self.chunks:
+            return None
+        return self.chunks[0].first, max(chunk.last for chunk in self.chunks)
+
+    def electrodes(self):
+        """Returns the names of all electrodes found in the recorded files."""
+        self.refresh()
+        return list(dict.fromkeys(name for chunk in self.chunks for name in chunk.header['electrodes']))
+
+    def select(self, t0=None, t1=None):
+        """
+        Finds the samples with t0 <= time <= t1 (wall clock, either may be None).
+
+        Returns:
+            list of HistorySlice, oldest first; the records are memory-mapped, not copied.
+        """
+        self.refresh()
+        t0 = -np.inf if t0 is None else t0
+        t1 = np.inf if t1 is None else t1
+        lasts = [chunk.last for chunk in self.chunks]
+        firsts = [chunk.first for chunk in self.chunks]
+        slices = []
+        for chunk in self.chunks[bisect.bisect_left(lasts, t0):bisect.bisect_right(firsts, t1)]:
+            records = chunk.records()
+            lo = chunk.find(t0, records, 'left')
+            hi = chunk.find(t1, records, 'right')
+            if hi > lo:
+                slices.append(HistorySlice(records[lo:hi], chunk))
+        return slices
+
+    def series(self, name, t0=None, t1=None, field='actual'):
+        """
+        Returns (times, voltages) of one electrode between t0 and t1 as arrays.
+        Files that did not record the electrode are skipped.
+        """
+        if field not in FIELDS:
+            raise ValueError(f'Unknown field {field}, expected one of {FIELDS}')
+        times = []
+        values = []
+        for part in self.select(t0, t1):
+            column = part.column(name, field)
+            if column is not None:
+                times.append(part.times())
+                values.append(np.asarray(column, dtype=float))
+        if not times:
+            return np.zeros(0), np.zeros(0)
+        return np.concatenate(times), np.concatenate(values)
+
+    def decimate(self, name, t0=None, t1=None, points=1000, field='actual'):
+        """
+        Reduces one electrode's voltages between t0 and t1 to points equal time bins.
+
+        Returns:
+            (bin centre times, minimum, maximum, mean) arrays of length points; bins
+            without samples are NaN.
+        """
+        if field not in FIELDS:
+            raise ValueError(f'Unknown field {field}, expected one of {FIELDS}')
+        slices = self.select(t0, t1)
+        if t0 is None or t1 is None:
+            t0 = slices[0].times()[0] if t0 is None and slices else t0
+            t1 = slices[-1].times()[-1] if t1 is None and slices else t1
+        if t0 is None or t1 is None:
+            return tuple(np.zeros(0) for _ in range(4))
+        reducer = BinReducer(t0, t1, points)
+        for part in slices:
+            column = part.column(name, field)
+            if column is not None:
+                reducer.add(part.records['t'], column, part.chunk.clock_offset)
+        return reducer.result()
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hardware_map import HardwareMap
+from hv500_server import HV500Server
+from hv500_simulator import HV500Simulator
+from supply_pool import SupplyPool
+
+
+@pytest.fixture
+def server():
+    """An HV500Server with an ideal calibration and no connection, for the encoders."""
+    server = HV500Server()
+    server.IDN = 'HV264'
+    server.spans = np.ones(16)
+    server.offsets = np.zeros(16)
+    return server
+
+
+@pytest.fixture
+def pool():
+    """A SupplyPool of two simulated supplies (in pool.simulators), a and b wired to one channel each."""
+    hardware = HardwareMap({'1': {'port': 'COM1'}, '2': {'port': 'COM2'}}, {'a': [1, 1], 'b': [2, 16]})
+    pool = SupplyPool(hardware, timeout=0.2)
+    pool.simulators = {}
+    for supply, server in pool.servers.items():
+        pool.simulators[supply] = HV500Simulator(IDN=f'HV{300 + supply}', baudrate=0, command_delay=0)
+        pool.simulators[supply].connect(server)
+    pool.start()
+    yield pool
+    pool.close()
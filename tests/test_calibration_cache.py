@@ -0,0 +1,81 @@
+import time
+
+import numpy as np
+import pytest
+
+from calibration_cache import CalibrationCache
+from hv500_server import HV500Server
+from hv500_simulator import HV500Simulator
+
+SPANS = [1.0]*16
+OFFSETS = [0.02]*16
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CalibrationCache(str(tmp_path / 'cache' / 'hv500_calibration.json'))
+
+
+def test_empty_or_unreadable_cache(cache):
+    assert cache.lookup('COM15') is None
+    cache.store('COM15', 'HV264', SPANS, OFFSETS)
+    with open(cache.path, 'w') as f:
+        f.write('{not json')
+    assert cache.lookup('COM15') is None
+    cache.store('COM15', 'HV264', SPANS, OFFSETS)
+    assert cache.lookup('COM15') == ('HV264', SPANS, OFFSETS)
+
+
+def test_calibration_is_keyed_by_idn_not_port(cache):
+    cache.store('COM15', 'HV264', SPANS, OFFSETS)
+    cache.store('COM16', 'HV300', [1.001]*16, [0.019]*16)
+    # The supplies were swapped between the ports
+    cache.store('COM15', 'HV300', [1.001]*16, [0.019]*16)
+    assert cache.lookup('COM15') == ('HV300', [1.001]*16, [0.019]*16)
+    assert cache.lookup('COM16') == ('HV300', [1.001]*16, [0.019]*16)
+    cache.store('COM16', 'HV264', SPANS, OFFSETS)
+    assert cache.lookup('COM16') == ('HV264', SPANS, OFFSETS)
+
+
+def connect(simulator, cache):
+    server = HV500Server()
+    server.calibration_cache = cache
+    server.ser = simulator.loopback()
+    server.port = 'COM15'
+    server.initServer()
+    return server
+
+
+def wait_for_revalidation(server, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while server.calibration_valid is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return server.calibration_valid
+
+
+def test_server_stores_then_starts_from_the_cache(cache):
+    simulator = HV500Simulator(IDN='HV301', baudrate=0, command_delay=0, seed=3)
+    server = connect(simulator, cache)
+    server.close()
+    assert cache.lookup('COM15') == ('HV301', simulator.spans, simulator.offsets)
+
+    server = connect(simulator, cache)
+    try:
+        assert server.IDN == 'HV301'
+        np.testing.assert_array_equal(server.spans, simulator.spans)
+        assert wait_for_revalidation(server) is True
+    finally:
+        server.close()
+
+
+def test_stale_cache_is_replaced_by_the_device_values(cache):
+    simulator = HV500Simulator(IDN='HV302', baudrate=0, command_delay=0, seed=4)
+    cache.store('COM15', 'HV264', SPANS, OFFSETS)
+    server = connect(simulator, cache)
+    try:
+        assert wait_for_revalidation(server) is False
+        assert server.IDN == 'HV302'
+        np.testing.assert_array_equal(server.spans, simulator.spans)
+        assert cache.lookup('COM15') == ('HV302', simulator.spans, simulator.offsets)
+    finally:
+        server.close()
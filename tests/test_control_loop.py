@@ -0,0 +1,47 @@
+import threading
+import time
+
+import pytest
+
+from control_loop import AdaptivePoller, LoopScheduler
+
+
+def woken_then_next(reanchor):
+    # Returns the times (from start) at which a woken wait and the wait after it end
+    scheduler = LoopScheduler(period=0.2, reanchor=reanchor)
+    scheduler.start()
+    t0 = time.monotonic()
+    threading.Timer(0.05, scheduler.wake.set).start()
+    scheduler.wait()
+    woken = time.monotonic() - t0
+    scheduler.wait()
+    return woken, time.monotonic() - t0
+
+
+def test_wake_restarts_grid_when_reanchoring():
+    woken, following = woken_then_next(True)
+    assert woken == pytest.approx(0.05, abs=0.04)
+    assert following == pytest.approx(0.25, abs=0.04)
+
+
+def test_wake_keeps_grid_with_fixed_period():
+    woken, following = woken_then_next(False)
+    assert woken == pytest.approx(0.05, abs=0.04)
+    assert following == pytest.approx(0.4, abs=0.04)
+
+
+def test_overrun_skips_missed_deadlines():
+    scheduler = LoopScheduler(period=0.1, policy='skip')
+    scheduler.start()
+    time.sleep(0.35)
+    assert scheduler.wait() == 3
+    assert scheduler.overruns == 1 and scheduler.skipped == 3
+
+
+def test_poller_backs_off_until_poked():
+    poller = AdaptivePoller(min_interval=0.1, max_interval=0.5, backoff=2, activity_hold=0)
+    assert [poller.next_interval(False) for _ in range(4)] == [0.2, 0.4, 0.5, 0.5]
+    assert poller.next_interval(True) == 0.1
+    poller.next_interval(False)
+    poller.poke()
+    assert poller.interval == 0.1 and poller.wake.is_set()
@@ -0,0 +1,54 @@
+import threading
+
+import numpy as np
+
+from electrode_state import ElectrodeState
+
+V_LOCATION = {'A': (1, 1), 'B': (1, 3), 'C': (2, 16), 'D': None}
+
+
+def test_gather_and_scatter_follow_the_wiring():
+    state = ElectrodeState(V_LOCATION)
+    state.setpoint[:] = [1.0, 2.0, 3.0, 4.0]
+    assert state.scatter(1).tolist() == [1.0, 0, 2.0] + [0]*13
+    assert state.scatter(2)[15] == 3.0
+    readback = np.arange(16, dtype=float)
+    mask = np.zeros(16, dtype=bool)
+    mask[2] = True
+    state.gather(1, readback, mask)
+    assert state.actual.tolist() == [0.0, 0.0, 0.0, 0.0]
+    state.gather(1, readback)
+    assert state.actual.tolist() == [0.0, 2.0, 0.0, 0.0]
+    assert state.unwired(['A', 'D', 'X']) == ['D', 'X']
+
+
+def test_publish_keeps_held_setpoints():
+    state = ElectrodeState(V_LOCATION)
+    state.hold(state.electrodes(['B']), [50.0])
+    state.draft[:] = 7.0
+    state.publish()
+    assert state.setpoint.tolist() == [7.0, 50.0, 7.0, 7.0]
+    state.release()
+    state.publish(np.full(4, 8.0))
+    assert state.setpoint.tolist() == [8.0]*4
+
+
+def test_scatter_never_sees_gui_value_of_held_electrode():
+    state = ElectrodeState(V_LOCATION)
+    held = state.electrodes(['B'])
+    state.hold(held, [50.0])
+    stop = threading.Event()
+
+    def gui():
+        while not stop.is_set():
+            state.draft[:] = -1.0
+            state.publish()
+
+    thread = threading.Thread(target=gui)
+    thread.start()
+    try:
+        seen = {float(state.scatter(1)[2]) for _ in range(20000)}
+    finally:
+        stop.set()
+        thread.join()
+    assert seen == {50.0}
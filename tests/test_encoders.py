@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+
+def test_bulk_packet_matches_scalar_encoder(server):
+    voltages = np.linspace(-500, 500, 16)
+    expected = ''.join(server.voltage_to_hex(v, ch) for ch, v in enumerate(voltages))
+    assert server.bulk_packet(voltages) == f'HV264 A {expected}\r'.encode()
+    assert server.voltages_to_hex(voltages) == expected
+
+
+def test_codes_below_0x1000_are_zero_padded(server):
+    # -480 V is DAC code 1250 (0x04E2), which used to be sent as 3 digits
+    voltages = np.full(16, -480.0)
+    assert server.voltage_to_hex(-480.0, 0) == '04E2'
+    assert server.voltages_to_hex(voltages) == '04E2'*16
+    assert server.voltages_to_hex(np.full(16, -500.0)) == '0000'*16
+    assert len(server.bulk_packet(voltages)) == len('HV264 A ') + 4*16 + 1
+
+
+def test_bulk_packets_batch_matches_single_frames(server):
+    frames = np.linspace(-499, 499, 5*16).reshape(5, 16)
+    packets = server.bulk_packets(frames)
+    for frame, packet in zip(frames, packets):
+        assert packet.tobytes() == bytes(server.bulk_packet(frame))
+
+
+@pytest.mark.parametrize('bad', [np.nan, np.inf, -np.inf, 500.5, -501])
+def test_encoders_reject_non_finite_and_out_of_range(server, bad):
+    voltages = np.zeros(16)
+    voltages[3] = bad
+    with pytest.raises(ValueError):
+        server.voltages_to_hex(voltages)
+    with pytest.raises(ValueError):
+        server.bulk_packet(voltages)
+    with pytest.raises(ValueError):
+        server.bulk_packets(np.tile(voltages, (3, 1)))
+    with pytest.raises(ValueError):
+        server.set_all_voltages_async(voltages)
+    with pytest.raises(ValueError):
+        server.set_voltage_async(4, bad)
+    with pytest.raises(ValueError):
+        server.set_voltage_legacy_async(4, bad)
+    with pytest.raises(ValueError):
+        server.voltage_to_hex(bad, 3)
+
+
+def test_rejected_frame_leaves_packet_buffer_unchanged(server):
+    packet = bytes(server.bulk_packet(np.full(16, 100.0)))
+    with pytest.raises(ValueError):
+        server.bulk_packet(np.full(16, np.nan))
+    assert bytes(server._bulk_packet) == packet
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from hardware_map import HardwareMap, HardwareMapError
+
+SUPPLIES = {'1': {'port': 'COM1'}, '2': {'port': 'COM2', 'channels': 8}}
+
+
+def test_valid_map_with_unwired_electrode(capsys):
+    hardware = HardwareMap(SUPPLIES, {'a': [1, 1], 'b': [1, 16], 'c': [2, 8], 'd': None})
+    assert hardware.electrodes['a'] == (1, 1)
+    assert hardware.unassigned() == ['d']
+    assert hardware.channels() == {1: 16, 2: 8}
+    assert 'd is not assigned' in capsys.readouterr().out
+
+
+def test_collisions_are_reported_with_both_owners():
+    with pytest.raises(HardwareMapError) as error:
+        HardwareMap(SUPPLIES, {'a': [1, 9], 'b': [1, 9], 'c': [2, 1], 'd': [2, 1]})
+    message = str(error.value)
+    assert 'b: supply 1 channel 9 is already assigned to a' in message
+    assert 'd: supply 2 channel 1 is already assigned to c' in message
+
+
+@pytest.mark.parametrize('location, problem', [([3, 1], 'unknown supply 3'),
+                                               ([2, 9], 'supply 2 has no channel 9'),
+                                               ([1, 0], 'supply 1 has no channel 0'),
+                                               ([1], 'location must be [supply, channel]')])
+def test_invalid_locations(location, problem):
+    with pytest.raises(HardwareMapError, match=problem.replace('[', r'\[').replace(']', r'\]')):
+        HardwareMap(SUPPLIES, {'a': location})
+
+
+def test_every_problem_is_listed():
+    with pytest.raises(HardwareMapError) as error:
+        HardwareMap(SUPPLIES, {'a': [3, 1], 'b': [2, 9], 'c': [1, 1], 'd': [1, 1]})
+    assert len(str(error.value).splitlines()) == 4
+
+
+def test_load_requires_both_sections(tmp_path):
+    path = tmp_path / 'map.json'
+    path.write_text(json.dumps({'supplies': SUPPLIES}))
+    with pytest.raises(HardwareMapError, match='needs "supplies" and "electrodes"'):
+        HardwareMap.load(str(path))
+    with pytest.raises(HardwareMapError, match='Could not read'):
+        HardwareMap.load(str(tmp_path / 'missing.json'))
+
+
+def test_shipped_map_is_valid():
+    hardware = HardwareMap.load()
+    assert set(hardware.supplies) == {1, 2}
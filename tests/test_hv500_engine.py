@@ -0,0 +1,155 @@
+import threading
+import time
+
+import pytest
+
+from hv500_engine import ACK, HIGH, LOW, NAK, CommandEngine, ResponseParser
+from hv500_simulator import HV500Simulator
+
+
+class FakeSerial():
+    """Serial port whose received bytes are fed by the test."""
+
+    def __init__(self):
+        self.timeout = None
+        self.written = []
+        self._rx = bytearray()
+        self._cond = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        with self._cond:
+            if not self._rx:
+                self._cond.wait(self.timeout)
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+            return data
+
+    def feed(self, *chunks):
+        for chunk in chunks:
+            with self._cond:
+                self._rx += chunk
+                self._cond.notify_all()
+            time.sleep(0.01)
+
+    def wait_written(self, count, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        while len(self.written) < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+        assert len(self.written) >= count
+
+
+@pytest.fixture
+def port():
+    return FakeSerial()
+
+
+@pytest.fixture
+def engine(port):
+    engine = CommandEngine(port, timeout=0.2, poll_interval=0.01)
+    engine.start()
+    yield engine
+    engine.stop()
+
+
+def test_parser_frames_any_chunking():
+    stream = b'12.34V,-5.00V\r\n\x06\r\x15\r0.00V\r\n'
+    expected = [('line', b'12.34V,-5.00V\r\n'), ('ack', ACK), ('nak', NAK), ('line', b'0.00V\r\n')]
+    for size in (1, 2, 3, 7, len(stream)):
+        parser = ResponseParser()
+        frames = []
+        for i in range(0, len(stream), size):
+            frames += parser.feed(stream[i:i+size])
+        assert frames == expected
+
+
+def test_responses_are_matched_in_order(engine, port):
+    reading = engine.query(b'HV264 U01\r')
+    ack = engine.command(b'HV264 SET01 1\r')
+    nak = engine.command(b'HV264 SET01 999\r')
+    port.wait_written(3)
+    port.feed(b'12.', b'34V\r', b'\n\x06', b'\r\x15\r')
+    assert reading.result(1) == b'12.34V\r\n'
+    assert ack.result(1) == ACK
+    assert nak.result(1) == NAK
+    assert engine.timeouts == 0
+
+
+def test_only_one_reading_in_flight(engine, port):
+    first = engine.query(b'HV264 U01\r')
+    second = engine.query(b'HV264 U02\r')
+    port.wait_written(1)
+    time.sleep(0.05)
+    assert port.written == [b'HV264 U01\r']
+    port.feed(b'1.00V\r\n')
+    port.wait_written(2)
+    port.feed(b'2.00V\r\n')
+    assert (first.result(1), second.result(1)) == (b'1.00V\r\n', b'2.00V\r\n')
+
+
+def test_dropped_reading_resolves_empty_before_ack(engine, port):
+    # An overloaded device drops the reading and answers the next command
+    reading = engine.query(b'HV264 U00\r')
+    ack = engine.command(b'HV264 SET01 1\r')
+    port.wait_written(2)
+    port.feed(ACK)
+    assert reading.result(1) == b''
+    assert ack.result(1) == ACK
+    assert engine.timeouts == 1
+
+
+def test_unanswered_request_times_out_and_late_reading_is_unsolicited(engine, port):
+    reading = engine.query(b'HV264 U00\r')
+    assert reading.result(2) == b''
+    assert engine.timeouts == 1
+    port.feed(b'1.00V\r\n')
+    time.sleep(0.05)
+    assert engine.unsolicited == 1
+
+
+def test_high_priority_goes_ahead_of_queued_readbacks(engine, port):
+    first = engine.query(b'HV264 U01\r', LOW)
+    port.wait_written(1)
+    second = engine.query(b'HV264 U02\r', LOW)
+    ack = engine.command(b'HV264 SET01 1\r', HIGH)
+    # The write does not wait for the reading on the wire or the one queued behind it
+    port.wait_written(2)
+    assert port.written[1] == b'HV264 SET01 1\r'
+    port.feed(b'1.00V\r\n', ACK)
+    port.wait_written(3)
+    port.feed(b'2.00V\r\n')
+    assert (first.result(1), ack.result(1), second.result(1)) == (b'1.00V\r\n', ACK, b'2.00V\r\n')
+
+
+def test_submit_fails_when_engine_is_not_running(port):
+    engine = CommandEngine(port)
+    with pytest.raises(RuntimeError):
+        engine.query(b'IDN\r').result(0)
+    engine.start()
+    engine.stop()
+    with pytest.raises(RuntimeError):
+        engine.command(b'HV264 SET01 1\r').result(0)
+
+
+def test_simulator_overload_masks_readback_and_keeps_writing():
+    simulator = HV500Simulator(baudrate=0, command_delay=0, overload_rate=1.0, seed=1)
+    server = simulator.connect()
+    server.engine.timeout = 0.1
+    try:
+        assert server.read_all_voltages_async().result(2) == 0
+        assert server.readback_mask.all()
+        assert server.get_voltage(1) == 99999
+        assert server.set_voltage_async(1, 12.5).result(2) is True
+        assert simulator.setpoints()[0] == 12.5
+        simulator.overload_rate = 0.0
+        assert server.read_all_voltages_async().result(2) == 16
+        assert server.readback[0] == 12.5 and not server.readback_mask.any()
+    finally:
+        server.close()
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from hv500_simulator import HV500Simulator
+
+
+def readback_arrays():
+    return np.full(16, -1.0), np.zeros(16, dtype=bool)
+
+
+def test_parse_all_voltages_into_reads_every_channel(server):
+    voltages = np.linspace(-450, 450, 16)
+    reading = (','.join(f'{v:.2f}V' for v in voltages) + '\r\n').encode()
+    out, mask = readback_arrays()
+    mask[:] = True
+    assert server.parse_all_voltages_into(reading, out, mask) == 16
+    np.testing.assert_allclose(out, np.round(voltages, 2))
+    assert not mask.any()
+    assert server.readback_errors == 0
+
+
+def test_parse_all_voltages_into_masks_malformed_fields(server):
+    fields = [f'{ch}.00V' for ch in range(16)]
+    fields[3] = '3.0'           # unit missing
+    fields[7] = 'xV'            # not a number
+    reading = (','.join(fields[:15]) + '\r\n').encode()   # last channel missing
+    out, mask = readback_arrays()
+    assert server.parse_all_voltages_into(reading, out, mask) == 13
+    assert np.flatnonzero(mask).tolist() == [3, 7, 15]
+    assert np.isnan(out[mask]).all()
+    np.testing.assert_array_equal(out[~mask], np.arange(16.0)[~mask])
+    assert server.readback_errors == 1
+
+
+def test_parse_all_voltages_into_masks_everything_without_answer(server):
+    out, mask = readback_arrays()
+    assert server.parse_all_voltages_into(b'', out, mask) == 0
+    assert mask.all() and np.isnan(out).all()
+    assert server.readback_errors == 1
+
+
+def test_parse_all_voltages_into_agrees_with_parse_all_voltages(server):
+    reading = b'1.50V,-2.25V,' + b','.join(b'0.00V' for _ in range(14)) + b'\r\n'
+    out, mask = readback_arrays()
+    server.parse_all_voltages_into(reading, out, mask)
+    np.testing.assert_array_equal(out, server.parse_all_voltages(reading))
+
+
+@pytest.fixture
+def simulated():
+    simulator = HV500Simulator(baudrate=0, command_delay=0.02)
+    server = simulator.connect()
+    yield server, simulator
+    server.close()
+
+
+def test_synchronous_set_waits_for_the_ack(simulated):
+    server, simulator = simulated
+    rejected = []
+    server.on_ack_failure = lambda server, command: rejected.append(command)
+    assert server.complete(server.set_voltage_async(3, 12.5)) is True
+    assert simulator.setpoints()[2] == 12.5
+    # Channel 99 does not exist, so the device answers with NAK
+    assert server.complete(server.send_command(f'{server.IDN} SET99 1\r')) is False
+    assert server.ack_failures == 1
+    assert rejected == [f'{server.IDN} SET99 1']
+
+
+def test_deferred_ack_returns_before_the_answer(simulated):
+    server, simulator = simulated
+    rejected = []
+    server.on_ack_failure = lambda server, command: rejected.append(command)
+    server.deferred_ack = True
+    futures = [server.set_voltage_async(ch, float(ch)) for ch in range(1, 6)]
+    futures.append(server.send_command(f'{server.IDN} SET99 1\r'))
+    assert [server.complete(future) for future in futures] == [None]*6
+    assert server.wait_for_acks(2) == 1
+    assert all(future.done() for future in futures)
+    assert simulator.setpoints()[:5] == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert rejected == [f'{server.IDN} SET99 1']
+    # Once resolved, complete() reports the outcome
+    assert server.complete(futures[0]) is True and server.complete(futures[-1]) is False
+
+
+def test_write_errors_raise(simulated):
+    server, _ = simulated
+    def broken(packet):
+        raise OSError('port gone')
+    server.ser.write = broken
+    with pytest.raises(OSError):
+        server.complete(server.set_voltage_async(1, 1.0))
+    server.close()
+    assert server.engine is None and server.ser is None
@@ -0,0 +1,79 @@
+import time
+
+import numpy as np
+import pytest
+
+from hv500_server import HV500Server
+from hv500_simulator import ACK, NAK, HV500Simulator
+
+
+def test_process_answers_the_protocol():
+    sim = HV500Simulator(IDN='HV264', command_delay=0)
+    assert sim.process(b'IDN\r') == b'HV264 500 16 b\r\n'
+    assert sim.process(b'HV264 SET3 120.5\r') == ACK
+    assert sim.process(b'HV264 U3\r') == b'120.50V\r\n'
+    assert sim.process(b'HV264 CH1 0.75\r') == ACK
+    assert sim.output(1) == pytest.approx(250)
+    assert sim.process(b'HV264 SET17 1\r') == NAK
+    assert sim.process(b'HV264 SET1 600\r') == NAK
+    assert sim.process(b'HV999 U1\r') is None
+    assert sim.counts['NAK'] == 2
+
+
+def test_overloaded_readbacks_stay_silent():
+    sim = HV500Simulator(command_delay=0, overload_rate=1)
+    assert sim.process(b'HV264 U0\r') is None
+    assert sim.counts['overload'] == 1
+
+
+def test_slew_rate_limits_the_output():
+    sim = HV500Simulator(command_delay=0, slew_rate=1000)
+    sim.process(b'HV264 SET1 100\r')
+    t_set = sim._t_set[0]
+    assert sim.output(1, t_set + 0.05) == pytest.approx(50)
+    assert sim.output(1, t_set + 0.2) == 100
+
+
+def test_loopback_emulates_wire_time():
+    sim = HV500Simulator(baudrate=9600, command_delay=0)
+    ser = sim.loopback()
+    try:
+        t0 = time.monotonic()
+        ser.write(b'HV264 U0\r')
+        response = ser.readline()
+        elapsed = time.monotonic() - t0
+    finally:
+        ser.close()
+    assert response.count(b',') == 15
+    # command and 16 readings clocked at 10 bits per byte
+    assert elapsed >= (9 + len(response))*10/9600*0.9
+
+
+def test_server_round_trip_over_loopback():
+    sim = HV500Simulator(baudrate=0, command_delay=0, seed=1)
+    server = sim.connect()
+    try:
+        assert server.IDN == 'HV264'
+        np.testing.assert_allclose(server.spans, sim.spans)
+        server.set_voltage(5, -42.0)
+        assert sim.output(5) == -42.0
+        assert server.get_all_voltages()[4] == pytest.approx(-42.0)
+    finally:
+        server.close()
+
+
+def test_server_round_trip_over_pty():
+    pytest.importorskip('serial')
+    sim = HV500Simulator(IDN='HV301', baudrate=0, command_delay=0)
+    server = HV500Server()
+    server.calibration_cache = None
+    server.port = sim.serve_pty()
+    try:
+        server.initServer()
+        assert server.IDN == 'HV301'
+        server.set_voltage(2, 75.0)
+        assert sim.output(2) == 75.0
+        assert server.get_voltage(2) == pytest.approx(75.0)
+    finally:
+        server.close()
+        sim.close()
@@ -0,0 +1,81 @@
+import json
+import urllib.request
+
+import numpy as np
+import pytest
+
+from metrics import Histogram, MetricsServer, Registry, SnapshotWriter
+
+
+def test_histogram_percentiles_are_within_a_bucket():
+    histogram = Histogram()
+    values = np.random.default_rng(1).lognormal(np.log(0.01), 1.0, 20000)
+    for value in values:
+        histogram.observe(value)
+    for q in (0.5, 0.9, 0.99):
+        # 20 buckets per decade: a bucket spans a factor of 10**(1/20), about 12%
+        assert histogram.percentile(q) == pytest.approx(np.quantile(values, q), rel=0.125)
+    assert histogram.count == len(values)
+    assert histogram.mean == pytest.approx(values.mean())
+    assert (histogram.min, histogram.max) == (values.min(), values.max())
+
+
+def test_histogram_edges():
+    histogram = Histogram(low=1e-3, high=1.0)
+    assert histogram.percentile(0.5) is None and histogram.mean is None
+    for value in (0.0, 1e-6, 5.0):
+        histogram.observe(value)
+    # Values outside the range fall into the first or last bucket; percentiles stay within min and max
+    assert histogram.buckets[0] == 2 and histogram.buckets[-1] == 1
+    assert histogram.percentile(0.0) >= 0.0 and histogram.percentile(1.0) == 5.0
+    histogram = Histogram()
+    histogram.observe(0.02)
+    assert histogram.percentile(0.5) == histogram.percentile(0.99) == 0.02
+
+
+def test_registry_returns_the_same_metric_per_name_and_labels():
+    registry = Registry()
+    counter = registry.counter('writes_total', {'supply': '1'})
+    assert registry.counter('writes_total', {'supply': '1'}) is counter
+    assert registry.counter('writes_total', {'supply': '2'}) is not counter
+    with pytest.raises(TypeError):
+        registry.histogram('writes_total', {'supply': '1'})
+
+
+def test_text_export():
+    registry = Registry()
+    registry.counter('writes_total', {'supply': '1'}).inc(3)
+    registry.gauge('queued', fn=lambda: 2)
+    registry.gauge('broken', fn=lambda: 1/0)
+    histogram = registry.histogram('round_trip_seconds', {'command': 'U'})
+    histogram.observe(0.01)
+    lines = registry.text().splitlines()
+    assert 'writes_total{supply="1"} 3' in lines
+    assert 'queued 2' in lines
+    assert not any(line.startswith('broken') for line in lines)
+    assert 'round_trip_seconds_count{command="U"} 1' in lines
+    assert 'round_trip_seconds_p50{command="U"} 0.01' in lines
+    snapshot = registry.snapshot()['metrics']
+    assert snapshot['broken'][0]['value'] is None
+    assert snapshot['round_trip_seconds'][0]['labels'] == {'command': 'U'}
+
+
+def test_snapshot_file_and_http_endpoint(tmp_path):
+    registry = Registry()
+    registry.counter('writes_total').inc()
+    path = str(tmp_path / 'metrics' / 'metrics.json')
+    writer = SnapshotWriter(registry, path, interval=60)
+    writer.start()
+    writer.stop()
+    with open(path) as f:
+        assert json.load(f)['metrics']['writes_total'][0]['value'] == 1
+
+    server = MetricsServer(registry, port=0)
+    server.start()
+    try:
+        url = f'http://127.0.0.1:{server.port}'
+        assert urllib.request.urlopen(url + '/metrics', timeout=5).read().decode() == 'writes_total 1\n'
+        snapshot = json.loads(urllib.request.urlopen(url + '/metrics.json', timeout=5).read())
+        assert snapshot['metrics']['writes_total'][0]['value'] == 1
+    finally:
+        server.stop()
@@ -0,0 +1,98 @@
+import time
+import types
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+from electrode_state import ElectrodeState
+from ramp_engine import RampEngine, ramp_frames
+
+
+@pytest.fixture
+def state():
+    return ElectrodeState({'a': (1, 1), 'b': (2, 16), 'c': (1, 2)})
+
+
+def test_profiles():
+    times = np.linspace(0, 1, 5)
+    linear = ramp_frames([0, 10], [100, -10], times, 'linear', duration=1.0)
+    np.testing.assert_allclose(linear[:, 0], [0, 25, 50, 75, 100])
+    cosine = ramp_frames([0], [100], times, 'cosine', duration=1.0)[:, 0]
+    np.testing.assert_allclose(cosine[[0, 2, 4]], [0, 50, 100])
+    assert cosine[1] < 25 and cosine[3] > 75
+    rate = ramp_frames([0, 0], [10, -100], times, 'rate', rate=40)
+    np.testing.assert_allclose(rate[:, 0], [0, 10, 10, 10, 10])
+    np.testing.assert_allclose(rate[:, 1], [0, -10, -20, -30, -40])
+
+
+def test_plan_uses_the_frame_rate_the_link_sustains(pool, state):
+    engine = RampEngine(pool, state)
+    state.setpoint[:] = [0.0, 0.0, 7.0]
+    ramp = engine.plan({'a': 100.0}, duration=0.5)
+    interval = engine.frame_interval([1])
+    assert len(ramp.times) == int(0.5/interval)
+    assert ramp.times[-1] == pytest.approx(0.5)
+    assert list(ramp.packets) == [1]
+    # The unramped channel of the same supply keeps its setpoint in every frame
+    assert ramp.final[1][0] == 100.0 and ramp.final[1][1] == 7.0
+    ramp = engine.plan({'a': 100.0, 'b': -50.0}, profile='rate', rate=400)
+    assert ramp.duration == pytest.approx(0.25) and sorted(ramp.packets) == [1, 2]
+    with pytest.raises(ValueError):
+        engine.plan({'a': 1.0}, profile='rate')
+    with pytest.raises(ValueError):
+        engine.plan({'a': 1.0}, duration=-1)
+
+
+def test_ramp_streams_on_schedule_and_holds_its_targets(pool, state):
+    engine = RampEngine(pool, state)
+    t0 = time.perf_counter()
+    reports = engine.ramp({'a': 100.0, 'b': -50.0}, duration=0.2)
+    elapsed = time.perf_counter() - t0
+    assert 0.2 <= elapsed < 0.2 + pool.timeout
+    for report in reports.values():
+        assert report.ok and report.sent + report.skipped == report.frames
+    assert pool.simulators[1].setpoints()[0] == pytest.approx(100.0, abs=0.02)
+    assert pool.simulators[2].setpoints()[15] == pytest.approx(-50.0, abs=0.02)
+    assert not pool.busy
+    # Recomputing the setpoints from the GUI does not revert the ramped electrodes
+    state.draft[:] = 0.0
+    state.publish()
+    assert state.setpoint.tolist() == [100.0, -50.0, 0.0]
+    state.release()
+    state.publish(np.zeros(3))
+    assert state.setpoint.tolist() == [0.0, 0.0, 0.0]
+
+
+def test_late_frames_are_skipped_and_the_last_frame_is_sent(pool, state):
+    engine = RampEngine(pool, state)
+    sent = []
+
+    def send_command(packet):
+        # Each write takes three frame intervals
+        sent.append(packet)
+        time.sleep(0.03)
+        future = Future()
+        future.set_result(True)
+        return future
+
+    packets = np.arange(20, dtype=np.uint8)[:, None]
+    times = np.linspace(0.01, 0.2, 20)
+    report = engine._stream(types.SimpleNamespace(send_command=send_command), packets, times, time.perf_counter())
+    assert report.skipped > 0 and report.sent + report.skipped == 20
+    assert sent[-1] == bytes([19])
+    assert report.elapsed < 0.3
+
+
+def test_supply_that_does_not_finish_is_timed_out_and_rewritten(pool, state):
+    engine = RampEngine(pool, state)
+    pool.simulators[2].command_delay = 0.1
+    reports = engine.ramp({'a': 100.0, 'b': -50.0}, duration=0.1)
+    assert reports[1].ok
+    assert reports[2].timed_out and not reports[2].ok
+    # The planner of the failed supply forgets what it wrote, so the next write sends everything
+    assert np.isnan(pool.servers[2].planner.committed).all()
+    assert pool.servers[1].planner.committed[0] == 100.0
+    assert not pool.busy
+    # The targets are still held, so the next write finishes the ramp
+    assert state.setpoint.tolist()[:2] == [100.0, -50.0]
@@ -0,0 +1,78 @@
+import pytest
+
+from recipe_runner import Recipe, RecipeError
+
+VOLTAGES = {'U_TL1_loading': 10}
+
+
+@pytest.mark.parametrize('step', [
+    {'type': 'jump'},
+    {'type': 'set'},
+    {'type': 'set', 'voltages': {'U_TL1_loading': 'high'}},
+    {'type': 'set', 'voltages': {'U_TL1_loading': float('nan')}},
+    {'type': 'ramp', 'voltages': VOLTAGES},
+    {'type': 'ramp', 'voltages': VOLTAGES, 'profile': 'cosine', 'duration': -1},
+    {'type': 'ramp', 'voltages': VOLTAGES, 'profile': 'rate'},
+    {'type': 'ramp', 'voltages': VOLTAGES, 'profile': 'rate', 'rate': 0},
+    {'type': 'ramp', 'voltages': VOLTAGES, 'profile': 'sine', 'duration': 1},
+    {'type': 'wait_settle', 'tolerance': 0},
+    {'type': 'hold'},
+    {'type': 'hold', 'duration': '1'},
+    {'type': 'hold', 'duration': 1, 'at': -0.5},
+])
+def test_invalid_steps_are_rejected_at_load(step):
+    with pytest.raises(RecipeError):
+        Recipe([{'type': 'hold', 'duration': 0.1}, step])
+
+
+def test_valid_recipe_is_accepted():
+    # Without a data reader the actual voltages are only read by the recipe while it waits
+    recipe = Recipe([{'type': 'set', 'voltages': VOLTAGES},
+                     {'type': 'ramp', 'voltages': VOLTAGES, 'duration': 0.5, 'profile': 'cosine'},
+                     {'type': 'ramp', 'voltages': VOLTAGES, 'profile': 'rate', 'rate': 100},
+                     {'type': 'wait_settle', 'electrodes': ['U_TL1_loading'], 'tolerance': 0.5, 'timeout': 10},
+                     {'type': 'hold', 'duration': 1.0, 'at': 2}], repeat=3)
+    assert recipe.electrodes() == ['U_TL1_loading']
+
+
+@pytest.fixture
+def scripted(tmp_path, monkeypatch):
+    """A Thorium connected to simulated supplies on pseudo terminals, without GUI or loops."""
+    pytest.importorskip('serial')
+    import hv500_server
+    import Thorium_Control_Interface as control
+    from hv500_simulator import HV500Simulator
+    from telemetry import TelemetryRecorder
+
+    monkeypatch.setattr(hv500_server, 'CalibrationCache', lambda: None)
+    simulators = {supply: HV500Simulator(IDN=f'HV{300 + supply}', baudrate=0, command_delay=0)
+                  for supply in (1, 2)}
+    ports = [simulators[supply].serve_pty() for supply in (1, 2)]
+    thorium = control.Thorium()
+    thorium.telemetry = TelemetryRecorder(thorium.state.names, thorium.v_location, directory=None)
+    thorium.metrics_file.path = str(tmp_path / 'metrics.json')
+    # A voltage left on a supply from before the program was started
+    supply, channel = thorium.v_location['U_TR1_loading']
+    simulators[supply].process(f'HV{300 + supply} SET{channel:02d} 50\r'.encode())
+    try:
+        thorium.connect(*ports)
+        yield thorium, simulators
+    finally:
+        thorium.disconnect()
+        for simulator in simulators.values():
+            simulator.close()
+
+
+def test_recipe_from_a_script_settles_and_keeps_other_electrodes(scripted):
+    thorium, simulators = scripted
+    assert thorium.set_voltages['U_TR1_loading'] == pytest.approx(50, abs=0.5)
+    # Without a data reader the actual voltages are only read by the recipe while it waits
+    recipe = Recipe([{'type': 'set', 'voltages': {'U_TL1_loading': 20}},
+                     {'type': 'wait_settle', 'tolerance': 0.5, 'timeout': 3},
+                     {'type': 'hold', 'duration': 0.05}])
+    report = thorium.runRecipe(recipe)
+    assert all(report.ok) and not report.aborted
+    assert thorium.actual_voltages['U_TL1_loading'] == pytest.approx(20, abs=0.5)
+    # The set step writes every channel of the supply; the others keep what they had
+    supply, channel = thorium.v_location['U_TR1_loading']
+    assert simulators[supply].setpoints()[channel-1] == pytest.approx(50, abs=0.05)
@@ -0,0 +1,106 @@
+import threading
+import time
+import types
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+from electrode_state import ElectrodeState
+from hardware_map import HardwareMap
+from supply_pool import SupplyPool, SupplyWorker
+
+
+@pytest.fixture
+def worker():
+    worker = SupplyWorker(1, types.SimpleNamespace(port='COM1'), max_failures=3, retry_interval=0.2)
+    worker.start()
+    yield worker
+    worker.stop()
+
+
+def fail(server):
+    raise OSError('no answer')
+
+
+def test_repeated_failures_make_a_supply_unhealthy_until_it_answers(worker):
+    for i in range(3):
+        with pytest.raises(OSError):
+            worker.submit('get', fail).result(1)
+    assert not worker.healthy and not worker.due()
+    assert worker.health()['last_error'] == "get: OSError('no answer')"
+    time.sleep(0.25)
+    assert worker.due()
+    assert worker.submit('get', lambda server: 16).result(1) == 16
+    assert worker.healthy and worker.consecutive_failures == 0
+    assert (worker.requests, worker.failures) == (4, 3)
+
+
+def test_false_results_and_failed_futures_count_as_failures(worker):
+    assert worker.submit('get', lambda server: 0).result(1) == 0
+    inner = Future()
+    future = worker.submit('set', lambda server: inner)
+    inner.set_exception(OSError('port gone'))
+    with pytest.raises(OSError):
+        future.result(1)
+    assert worker.consecutive_failures == 2
+    # Jobs that are not reads, writes or connects are not counted
+    worker.submit('close', fail).exception(1)
+    assert worker.requests == 2 and worker.consecutive_failures == 2
+
+
+def test_expired_job_counts_once_and_a_late_success_still_counts(worker):
+    release = threading.Event()
+    slow = worker.submit('get', lambda server: release.wait(1) and 16)
+    worker.expire(slow)
+    worker.expire(slow)
+    assert worker.consecutive_failures == 1
+    release.set()
+    assert slow.result(1) == 16
+    assert worker.consecutive_failures == 0
+
+    release.clear()
+    late = worker.submit('get', lambda server: release.wait(1) and fail(server))
+    worker.expire(late)
+    release.set()
+    late.exception(1)
+    assert worker.consecutive_failures == 1 and worker.failures == 2
+
+
+def test_read_and_write_every_supply(pool):
+    state = ElectrodeState({'a': (1, 1), 'b': (2, 16)})
+    state.setpoint[:] = [12.0, -34.0]
+    done = pool.wait(pool.write(state))
+    assert sorted(done) == [1, 2] and all(future.result() for future in done.values())
+    # Both channels change, so each supply gets a bulk 'A' packet with calibrated DAC codes
+    assert pool.simulators[1].setpoints()[0] == pytest.approx(12.0, abs=0.02)
+    assert pool.simulators[2].setpoints()[15] == pytest.approx(-34.0, abs=0.02)
+    pool.read(state)
+    np.testing.assert_allclose(state.actual, [12.0, -34.0], atol=0.02)
+
+
+def test_silent_supply_times_out_and_is_skipped(pool):
+    state = ElectrodeState({'a': (1, 1), 'b': (2, 16)})
+    # Supply 2 drops every reading, which the engine only gives up on after its own timeout
+    pool.simulators[2].overload_rate = 1.0
+    for i in range(3):
+        t0 = time.monotonic()
+        futures = pool.read(state)
+        assert time.monotonic() - t0 < 0.4
+        assert futures[1].result(1) == 16 and not futures[2].done()
+    assert not pool.workers[2].healthy
+    assert list(pool.run('get', lambda supply, server: True)) == [1]
+    assert pool.health()[2]['healthy'] is False and pool.health()[1]['healthy'] is True
+
+
+def test_unreachable_supply_is_disabled_on_connect(capsys):
+    hardware = HardwareMap({'1': {'port': '/dev/does-not-exist'}}, {'a': [1, 1]})
+    pool = SupplyPool(hardware, timeout=0.2)
+    try:
+        pool.connect(timeout=5)
+        assert not pool.workers[1].healthy
+        assert 'Error connecting' in capsys.readouterr().out
+        # Reads skip it until it is due for a retry, and do not raise
+        assert pool.read(ElectrodeState({'a': (1, 1)})) == {}
+    finally:
+        pool.close()
@@ -0,0 +1,91 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+from telemetry import TelemetryRecorder, TelemetryRing, read_header, read_log
+
+NAMES = ['a', 'b', 'c']
+LOCATIONS = {'a': (1, 1), 'b': (2, 5), 'c': None}
+
+
+def fill(target, first, count):
+    """Records samples first .. first+count-1, whose voltages are their index."""
+    for k in range(first, first + count):
+        target.record(np.full(3, k), np.full(3, -k), float(k))
+
+
+def test_ring_wraps_and_keeps_the_newest_samples_in_order():
+    ring = TelemetryRing(3, capacity=100)
+    assert ring.latest().size == 0 and ring.last_time() is None and ring.segments() == []
+    fill(ring, 0, 250)
+    np.testing.assert_array_equal(ring.latest()['t'], np.arange(150, 250))
+    np.testing.assert_array_equal(ring.latest(10)['set'][:, 0], np.arange(240, 250))
+    assert ring.last_time() == 249.0
+    # The oldest margin rows are left out, the rest is read in time order without copying
+    times = np.concatenate([ring.t[rows] for rows in ring.segments(margin=20)])
+    np.testing.assert_array_equal(times, np.arange(170, 250))
+
+
+def test_ring_decimate_over_the_wrap_matches_brute_force():
+    ring = TelemetryRing(3, capacity=100)
+    fill(ring, 0, 250)
+    # The window reaches across the wrap at row 0 (sample 200)
+    centres, low, high, mean = ring.decimate([0, 2], 200.5 - 10, 240.5, 5, 'actual')
+    np.testing.assert_allclose(centres, 195.5 + 10*np.arange(5))
+    # Only samples outside the margin of the oldest rows (the newest 50 here) are read,
+    # so the first bin has sample 200 but not 191 to 199
+    assert low[0, 0] == high[0, 0] == mean[0, 0] == -200
+    low, high, mean = low[1:], high[1:], mean[1:]
+    expected = -np.arange(201, 241).reshape(4, 10)
+    np.testing.assert_array_equal(low[:, 0], expected.min(axis=1))
+    np.testing.assert_array_equal(high[:, 1], expected.max(axis=1))
+    np.testing.assert_allclose(mean[:, 0], expected.mean(axis=1))
+
+
+def test_unflushed_samples_overwritten_by_the_ring_are_counted(tmp_path):
+    recorder = TelemetryRecorder(NAMES, LOCATIONS, directory=str(tmp_path), capacity=50, chunk_samples=1000)
+    fill(recorder, 0, 30)
+    recorder.flush()
+    fill(recorder, 30, 80)
+    recorder.flush()
+    assert recorder.dropped == 30
+    recorder.stop()
+    header, samples = read_log(glob.glob(os.path.join(str(tmp_path), 'telemetry_*.bin'))[0])
+    np.testing.assert_array_equal(samples['t'], np.concatenate([np.arange(30), np.arange(60, 110)]))
+    np.testing.assert_array_equal(samples['actual'][:, 1], -samples['t'])
+
+
+def test_log_rotates_into_new_files_and_deletes_the_oldest(tmp_path):
+    recorder = TelemetryRecorder(NAMES, LOCATIONS, {1: {'port': 'COM15'}}, directory=str(tmp_path),
+                                 capacity=100, chunk_samples=10, max_files=3)
+    for first in range(0, 55, 11):
+        fill(recorder, first, min(11, 55 - first))
+        recorder.flush()
+    recorder.stop()
+    paths = sorted(glob.glob(os.path.join(str(tmp_path), 'telemetry_*.bin')))
+    assert len(paths) == 3
+    logs = [read_log(path) for path in paths]
+    np.testing.assert_array_equal(np.concatenate([samples['t'] for _, samples in logs]), np.arange(30, 55))
+    header = logs[0][0]
+    assert header['electrodes'] == NAMES
+    assert header['locations'] == {'a': [1, 1], 'b': [2, 5], 'c': None}
+    assert header['supplies'] == {'1': {'port': 'COM15'}}
+    assert header['chunk_samples'] == 10
+
+
+def test_recorder_without_directory_keeps_memory_only():
+    recorder = TelemetryRecorder(NAMES, LOCATIONS, directory=None, capacity=10)
+    fill(recorder, 0, 15)
+    recorder.start()
+    recorder.stop()
+    assert recorder.log is None
+    np.testing.assert_array_equal(recorder.ring.latest()['t'], np.arange(5, 15))
+
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / 'telemetry_bad.bin'
+    path.write_bytes(b'not telemetry at all')
+    with pytest.raises(ValueError):
+        read_header(str(path))
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from telemetry import TelemetryRecorder
+from telemetry_history import TelemetryHistory
+
+SAMPLES = 1000
+CHUNK = 128
+
+
+@pytest.fixture(scope='module')
+def history(tmp_path_factory):
+    """A log of 1000 samples spread over 8 files, 10 ms apart, with a sparse index every 16 rows."""
+    directory = str(tmp_path_factory.mktemp('telemetry'))
+    recorder = TelemetryRecorder(['a', 'b'], {'a': (1, 1), 'b': None}, directory=directory,
+                                 capacity=4096, chunk_samples=CHUNK, max_files=None)
+    for i in range(SAMPLES):
+        recorder.record(np.array([i, -i]), np.array([np.sin(i), np.cos(i)]), t=1000.0 + 0.01*i)
+        if i % 150 == 0:
+            recorder.flush()
+    recorder.stop()
+    return TelemetryHistory(directory, stride=16)
+
+
+@pytest.fixture(scope='module')
+def everything(history):
+    times, actual = history.series('a')
+    _, setpoint = history.series('a', field='set')
+    return times, actual, setpoint
+
+
+def test_whole_log_is_found_in_order(history, everything):
+    times, actual, setpoint = everything
+    assert len(history.chunks) == -(-SAMPLES//CHUNK)
+    assert len(times) == SAMPLES
+    assert (np.diff(times) > 0).all()
+    np.testing.assert_array_equal(setpoint, np.arange(SAMPLES))
+    np.testing.assert_allclose(actual, np.sin(np.arange(SAMPLES)), rtol=1e-6)
+    assert history.span() == (times[0], times[-1])
+    assert history.electrodes() == ['a', 'b']
+
+
+@pytest.mark.parametrize('first, last', [(0, 999), (5, 6), (100, 400), (127, 128), (128, 255), (640, 999), (300, 300)])
+def test_select_between_samples_matches_brute_force(history, everything, first, last):
+    times, actual, _ = everything
+    # Bounds half way between samples, so rounding of the clock offset cannot matter
+    t0, t1 = times[first] - 0.005, times[last] + 0.005
+    parts = history.select(t0, t1)
+    assert sum(len(part) for part in parts) == last - first + 1
+    found_times, found = history.series('a', t0, t1)
+    np.testing.assert_array_equal(found_times, times[first:last+1])
+    np.testing.assert_array_equal(found, actual[first:last+1])
+
+
+def test_select_includes_samples_on_the_bounds(history, everything):
+    times, _, _ = everything
+    found_times, _ = history.series('a', times[200], times[300])
+    assert len(found_times) == 101
+    assert found_times[0] == times[200] and found_times[-1] == times[300]
+
+
+def test_select_open_ended_and_empty_windows(history, everything):
+    times, _, _ = everything
+    assert len(history.series('a', None, times[9] + 0.005)[0]) == 10
+    assert len(history.series('a', times[990] - 0.005, None)[0]) == 10
+    assert history.select(times[-1] + 1, None) == []
+    assert history.select(None, times[0] - 1) == []
+    assert history.select(times[10] + 0.002, times[10] + 0.004) == []
+
+
+def test_unknown_electrode_and_field(history):
+    times, values = history.series('nope')
+    assert len(times) == len(values) == 0
+    with pytest.raises(ValueError):
+        history.series('a', field='current')
+
+
+@pytest.mark.parametrize('field', ['actual', 'set'])
+@pytest.mark.parametrize('first, last, points', [(0, 999, 50), (120, 520, 7), (10, 20, 37)])
+def test_decimate_matches_brute_force(history, everything, field, first, last, points):
+    times, actual, setpoint = everything
+    values = actual if field == 'actual' else setpoint
+    t0, t1 = times[first] - 0.005, times[last] + 0.005
+    centres, low, high, mean = history.decimate('a', t0, t1, points, field)
+
+    edges = np.linspace(t0, t1, points + 1)
+    np.testing.assert_allclose(centres, 0.5*(edges[:-1] + edges[1:]))
+    for k in range(points):
+        inside = (times >= edges[k]) & ((times < edges[k+1]) if k < points - 1 else (times <= edges[k+1]))
+        if inside.any():
+            assert low[k] == values[inside].min()
+            assert high[k] == values[inside].max()
+            assert mean[k] == pytest.approx(values[inside].mean())
+        else:
+            assert np.isnan(low[k]) and np.isnan(high[k]) and np.isnan(mean[k])
+
+
+def test_decimate_defaults_to_the_recorded_span(history, everything):
+    times, actual, _ = everything
+    centres, low, high, mean = history.decimate('a', points=10)
+    assert centres[0] > times[0] and centres[-1] < times[-1]
+    assert np.nanmin(low) == actual.min() and np.nanmax(high) == actual.max()
+    assert mean == pytest.approx(actual.reshape(10, -1).mean(axis=1), abs=1e-9)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import Thorium_Control_Interface as control
+
+SEGMENT_1 = ['U_TR1_loading', 'U_TL1_loading', 'U_BR1_loading', 'U_BL1_loading']
+
+
+@pytest.fixture
+def thorium():
+    """A Thorium without GUI or supplies; only its setpoint logic is used."""
+    return control.Thorium()
+
+
+def hold(thorium, names, voltage):
+    thorium.state.hold(thorium.state.electrodes(names), np.full(len(names), voltage))
+
+
+def test_power_button_off_releases_held_electrodes(thorium):
+    thorium.U_segment_1_bool = thorium.segment_1_mode_bool = True
+    hold(thorium, SEGMENT_1, 80.0)
+    hold(thorium, ['U_TL3_loading'], 30.0)
+    thorium.update_button_var('U_segment_1', False)
+    thorium.updateSetV()
+    assert [thorium.set_voltages[name] for name in SEGMENT_1] == [0, 0, 0, 0]
+    # Electrodes of other buttons stay held
+    assert thorium.set_voltages['U_TL3_loading'] == 30.0
+    assert thorium.write_request.is_set()
+
+
+def test_power_and_mode_buttons_return_electrodes_to_the_gui(thorium):
+    thorium.entry_voltages['U_exit_loading'] = 12.0
+    hold(thorium, ['U_exit_loading'], 90.0)
+    thorium.update_button_var('U_loading_plate', True)
+    thorium.updateSetV()
+    assert thorium.set_voltages['U_exit_loading'] == 12.0
+
+    thorium.U_segment_1_bool = True
+    thorium.U_segment_1, thorium.dU_segment_1 = 10.0, 1.0
+    hold(thorium, SEGMENT_1, 80.0)
+    thorium.update_button_var('segment_1_mode', False)
+    thorium.updateSetV()
+    assert [thorium.set_voltages[name] for name in SEGMENT_1] == [9.0, 11.0, 9.0, 11.0]
+
+
+def test_held_electrodes_survive_unrelated_buttons(thorium):
+    hold(thorium, SEGMENT_1, 80.0)
+    thorium.update_button_var('U_segment_2', True)
+    thorium.updateSetV()
+    assert [thorium.set_voltages[name] for name in SEGMENT_1] == [80.0]*4
@@ -0,0 +1,82 @@
+import types
+
+import numpy as np
+import pytest
+
+from hv500_simulator import HV500Simulator
+from write_planner import CommandCostModel, WritePlanner
+
+
+def planner(baudrate):
+    return WritePlanner(types.SimpleNamespace(baudrate=baudrate))
+
+
+def test_unknown_setpoints_are_written_in_bulk():
+    plans = planner(9600).plan(np.zeros(16))
+    assert [command for command, _ in plans] == ['A']
+    np.testing.assert_array_equal(plans[0][1], np.arange(16))
+
+
+def test_unchanged_setpoints_are_not_written():
+    writer = planner(9600)
+    writer.committed[:] = 5.0
+    assert writer.plan(np.full(16, 5.0 + 1e-4)) == []
+
+
+def test_few_changes_use_the_cheapest_single_channel_command():
+    writer = planner(9600)
+    writer.committed[:] = 0.0
+    voltages = np.zeros(16)
+    voltages[[2, 9]] = 10.0
+    # A 'CH' packet is one byte shorter than 'SET', so it is cheaper on the wire
+    plans = writer.plan(voltages)
+    assert [command for command, _ in plans] == ['CH', 'CH']
+    assert [channels.tolist() for _, channels in plans] == [[2], [9]]
+    writer.single_commands = ('SET',)
+    assert [command for command, _ in writer.plan(voltages)] == ['SET', 'SET']
+
+
+def test_many_changes_use_one_bulk_packet():
+    writer = planner(9600)
+    writer.committed[:] = 0.0
+    voltages = np.zeros(16)
+    voltages[:3] = 1.0
+    assert [command for command, _ in writer.plan(voltages)] == ['A']
+    assert [command for command, _ in writer.plan(np.arange(16.0))] == ['A']
+
+
+def test_measured_costs_move_the_decision():
+    writer = planner(9600)
+    writer.committed[:] = 0.0
+    voltages = np.zeros(16)
+    voltages[0] = 1.0
+    for _ in range(50):
+        writer.costs.observe('CH', 0.1)
+    assert [command for command, _ in writer.plan(voltages)] == ['SET']
+    for _ in range(50):
+        writer.costs.observe('SET', 0.1)
+    assert [command for command, _ in writer.plan(voltages)] == ['A']
+
+
+def test_cost_model_without_wire_time():
+    costs = CommandCostModel(0, overhead=0.005)
+    assert all(cost == pytest.approx(0.005) for cost in costs.costs.values())
+
+
+def test_apply_writes_only_the_changes():
+    simulator = HV500Simulator(baudrate=0, command_delay=0)
+    server = simulator.connect()
+    try:
+        writer = WritePlanner(server)
+        voltages = np.linspace(-100, 100, 16)
+        assert writer.apply(voltages).result(2) is True
+        assert simulator.counts['A'] == 1
+        voltages[5] = 42.0
+        writer.costs.costs['A'] = 1.0
+        assert writer.apply(voltages).result(2) is True
+        assert simulator.counts['SET'] == 1
+        assert writer.apply(voltages).result(2) is True
+        assert simulator.counts['A'] + simulator.counts['SET'] == 2
+        np.testing.assert_allclose(simulator.setpoints(), voltages, atol=0.02)
+    finally:
+        server.close()
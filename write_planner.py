@@ -0,0 +1,142 @@
+#HV500 Write Planner
+#
+#Function:  Decides how new setpoints are written to one HV500 supply. Only channels
+#           that differ from the last committed setpoints are written, either with
+#           one single-channel command per channel ('SET' or legacy 'CH') or with a
+#           single bulk 'A' packet, whichever the cost model says is cheaper.
+
+
+import time
+import numpy as np
+
+from hv500_engine import gather
+
+
+class CommandCostModel():
+    """
+    Cost (link occupancy in seconds) of each set command on one supply.
+
+    Costs start from the wire time of a typical packet plus its ACK at the supply's
+    baud rate and are refined with an exponential moving average of measured
+    service times.
+
+    Args:
+        baudrate: int, baud rate of the serial link (0 for a link without wire time,
+            e.g. the simulator's loopback without emulation).
+        overhead: float, assumed device processing time per command in seconds.
+        alpha: float, weight of a new measurement in the moving average.
+    """
+
+    # Typical packet lengths in bytes, including the terminating '\r' and the 2 byte ACK
+    packet_bytes = {'SET': len('HV264 SET01 -123.456\r') + 2,
+                    'CH': len('HV264 CH01 0.376544\r') + 2,
+                    'A': len('HV264 A \r') + 4*16 + 2}
+
+    def __init__(self, baudrate, overhead=0.005, alpha=0.2):
+        self.alpha = alpha
+        byte_time = 10/baudrate if baudrate else 0
+        self.costs = {kind: n*byte_time + overhead for kind, n in self.packet_bytes.items()}
+        self.samples = {kind: 0 for kind in self.packet_bytes}
+
+    def cost(self, kind):
+        return self.costs[kind]
+
+    def observe(self, kind, dt):
+        self.samples[kind] += 1
+        self.costs[kind] += self.alpha*(dt - self.costs[kind])
+
+
+class WritePlanner():
+    """
+    Delta-only setpoint writer for one HV500Server.
+
+    Args:
+        server: HV500Server the setpoints are written to.
+        channels: int, number of channels of the supply.
+        tolerance: float, setpoints closer than this (in volts) to the committed value are not rewritten.
+    """
+
+    def __init__(self, server, channels=16, tolerance=1e-3):
+        self.server = server
+        self.tolerance = tolerance
+        self.costs = CommandCostModel(server.baudrate)
+        # Last setpoints written to the device; NaN means unknown and forces a write
+        self.committed = np.full(channels, np.nan)
+        # Time (time.monotonic) each channel was last written
+        self.written = np.full(channels, -np.inf)
+        self.single_commands = ('SET', 'CH')
+
+    def invalidate(self, channels=None):
+        """Forgets the committed setpoints so they are rewritten on the next apply."""
+        if channels is None:
+            self.committed[:] = np.nan
+        else:
+            self.committed[channels] = np.nan
+
+    def reconcile(self, readback, tolerance=0.2, since=None):
+        """
+        Invalidates channels whose readback disagrees with the committed setpoint,
+        e.g. after the supply was reset or a write was lost.
+
+        Args:
+            readback: array of floats, voltages read from the supply.
+            tolerance: float, allowed difference in volts.
+            since: optional time (time.monotonic) the readback was requested. Channels
+                written after that are skipped, since the reading predates the write.
+        """
+        readback = np.asarray(readback, dtype=float)
+        stale = np.abs(readback - self.committed) > tolerance
+        if since is not None:
+            stale &= self.written < since
+        self.committed[stale] = np.nan
+
+    def plan(self, voltages):
+        """
+        Args:
+            voltages: array of floats, desired setpoints of all channels in volts.
+
+        Returns:
+            list of (command, channels) with command 'SET', 'CH' or 'A' and channels an
+            array of the zero based channel indices it writes. Empty if nothing changed.
+        """
+        voltages = np.asarray(voltages, dtype=float)
+        changed = np.flatnonzero(~(np.abs(voltages - self.committed) <= self.tolerance))
+        if changed.size == 0:
+            return []
+        single = min(self.single_commands, key=self.costs.cost)
+        if changed.size*self.costs.cost(single) < self.costs.cost('A'):
+            return [(single, changed[i:i+1]) for i in range(changed.size)]
+        return [('A', np.arange(self.committed.size))]
+
+    def apply(self, voltages):
+        """
+        Writes the channels that changed.
+
+        Returns:
+            future resolving to True if every command was acknowledged.
+        """
+        voltages = np.asarray(voltages, dtype=float)
+        futures = []
+        # Service time of each command is measured from when the link became free for it
+        previous_done = [0.0]
+        for command, channels in self.plan(voltages):
+            if command == 'A':
+                future = self.server.set_all_voltages_async(voltages)
+            elif command == 'SET':
+                future = self.server.set_voltage_async(int(channels[0])+1, float(voltages[channels[0]]))
+            else:
+                future = self.server.set_voltage_legacy_async(int(channels[0])+1, float(voltages[channels[0]]))
+            self.committed[channels] = voltages[channels]
+            self.written[channels] = time.monotonic()
+            future.add_done_callback(lambda f, command=command, channels=channels, t_submit=time.perf_counter():
+                                     self._done(f, command, channels, t_submit, previous_done))
+            futures.append(future)
+        return gather(futures, all)
+
+    def _done(self, future, command, channels, t_submit, previous_done):
+        now = time.perf_counter()
+        if future.exception() is None and future.result():
+            self.costs.observe(command, now - max(t_submit, previous_done[0]))
+        else:
+            self.committed[channels] = np.nan
+        previous_done[0] = now